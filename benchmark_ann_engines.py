@@ -0,0 +1,119 @@
+#%%
+"""
+Annoy forests versus HNSW graphs (hnsw_index.py) as the index engine of MultiMetricDatabase.
+
+For each catalog, metric and engine this reports:
+    - the build time of the index
+    - its size once saved, which is also what the workers memory-map
+    - recall@k against exact search and mean query latency, for several search parameters: search_k per
+      requested neighbour for Annoy, ef (candidates kept by a query, at least k) for HNSW
+
+Usage:
+    python benchmark_ann_engines.py
+    python benchmark_ann_engines.py --catalogs real 10000 --metrics euclidean angular --hnsw-ef 200 400
+"""
+import os
+import json
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from vector_database import MultiMetricDatabase, ExactSearchDatabase
+from benchmark_quantization import load_catalog
+
+
+def recall_at_k(distances, item_ids, neighbours, k):
+    """
+    Fraction of the k requested neighbours found at least as close as the exact k-th neighbour (robust to ties).
+    Annoy returns fewer than k neighbours when search_k is too small: the missing ones count as misses.
+    """
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+    tolerance = 1e-5 * np.maximum(1.0, np.abs(kth))
+    # Item ids -> columns of the exact distance matrix
+    return float(np.mean([np.sum(distances[row, np.searchsorted(item_ids, found)] <= kth[row] + tolerance[row]) / k
+                          for row, found in enumerate(neighbours)]))
+
+
+def build_and_save(engine, vectors, map_labels_to_indices, metric, n_trees, engine_options):
+    """Build the index of 'metric' with 'engine', save it, and return (database, build seconds, file bytes)."""
+    database = MultiMetricDatabase(dimensions=vectors.shape[1], metrics=[metric], n_trees=n_trees, engine=engine, engine_options=engine_options)
+    database.add_vectors(vectors, map_labels_to_indices)
+    start = time.perf_counter()
+    database.warm_up()
+    build_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.save(directory, 'benchmark')
+        file_bytes = os.path.getsize(database.index_path(directory, metric, 'benchmark'))
+    return database, build_seconds, file_bytes
+
+
+def run_benchmark(catalog, dimensions, metrics, k, n_trees, annoy_search_k, hnsw_options, hnsw_ef, n_queries, seed=42):
+    vectors, map_labels_to_indices = load_catalog(catalog, dimensions)
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(seed)
+
+    exact_db = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = exact_db.vectors[rng.choice(len(exact_db.vectors), size=min(n_queries, len(exact_db.vectors)), replace=False)]
+
+    results = {'catalog': catalog, 'n_fonts': len(exact_db.item_ids), 'k': k, 'n_queries': len(queries),
+               'n_trees': n_trees, 'hnsw_options': hnsw_options, 'engines': []}
+    settings = {'annoy': [int(np.ceil(per_neighbour * k)) for per_neighbour in annoy_search_k],
+                'hnsw': [max(ef, k) for ef in hnsw_ef]}
+
+    for metric in metrics:
+        distances = exact_db._distances(queries, metric)
+        for engine, options in [('annoy', None), ('hnsw', hnsw_options)]:
+            database, build_seconds, file_bytes = build_and_save(engine, vectors, map_labels_to_indices, metric, n_trees, options)
+            row = {'metric': metric, 'engine': engine, 'build_seconds': build_seconds, 'file_bytes': file_bytes, 'points': []}
+            for search_k in settings[engine]:
+                start = time.perf_counter()
+                neighbours = database.nearest_neighbors_batch(queries, metric, k, search_k=search_k)
+                query_ms = (time.perf_counter() - start) / len(queries) * 1e3
+                recall = recall_at_k(distances, exact_db.item_ids, neighbours, k)
+                row['points'].append({'search_k': search_k, 'recall': recall, 'query_ms': query_ms})
+            results['engines'].append(row)
+
+    return results
+
+
+def print_report(results):
+    print(f"\ncatalog {results['catalog']}: {results['n_fonts']} fonts, recall@{results['k']} over {results['n_queries']} queries")
+    for row in results['engines']:
+        parameter = 'ef' if row['engine'] == 'hnsw' else 'search_k'
+        print(f"  {row['metric']:>9} {row['engine']:>5}: built in {row['build_seconds']:7.2f}s, {row['file_bytes'] / 1024**2:8.2f} MB on disk")
+        for point in row['points']:
+            print(f"      {parameter} {point['search_k']:7d}  recall {point['recall']:.4f}  {point['query_ms']:.3f}ms per query")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalogs', nargs='+', default=['10000', '100000'], help="'real' or numbers of synthetic fonts")
+    parser.add_argument('--metrics', nargs='+', default=['euclidean'])
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--n-trees', type=int, default=30)
+    parser.add_argument('--annoy-search-k', type=float, nargs='+', default=[5, 20, 50], help='Per requested neighbour')
+    parser.add_argument('--hnsw-m', type=int, default=16)
+    parser.add_argument('--hnsw-ef-construction', type=int, default=64)
+    parser.add_argument('--hnsw-ef', type=int, nargs='+', default=[200, 400, 800])
+    parser.add_argument('--n-queries', type=int, default=200)
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--output', default=None, help='JSON report, data/benchmarks/ann_engines_<time>.json by default')
+    args = parser.parse_args()
+
+    hnsw_options = {'M': args.hnsw_m, 'ef_construction': args.hnsw_ef_construction}
+    all_results = []
+    for catalog in args.catalogs:
+        results = run_benchmark(catalog, args.dimensions, args.metrics, args.k, args.n_trees, args.annoy_search_k,
+                                hnsw_options, args.hnsw_ef, args.n_queries)
+        print_report(results)
+        all_results.append(results)
+
+    output = args.output or f"./data/benchmarks/ann_engines_{time.strftime('%Y%m%dT%H%M%S')}.json"
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(all_results, handle, indent=2)
+    print(f'\nReport written to {output}')
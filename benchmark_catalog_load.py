@@ -0,0 +1,72 @@
+"""
+Load-time benchmark: npz + pickled dictionary (plus the hand-inverted dictionary) vs the single font catalog file.
+
+Each variant is loaded in a fresh Python process, so import and allocation costs are not shared between runs,
+and the time to load the catalog and to answer a batch of index -> label and label -> index lookups is reported.
+
+Usage:
+    python font_catalog.py                       # convert the existing files first
+    python benchmark_catalog_load.py --repeats 20
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+
+load_legacy = """
+import time, json
+start = time.perf_counter()
+from utils import load_npz, load_data_dict
+font_embeddings_array = load_npz(file_path= {embeddings!r})
+dict_font_labels_to_indices = load_data_dict({dictionary!r})
+dict_font_indices_to_labels = {{v: k for k, v in dict_font_labels_to_indices.items()}}
+loaded = time.perf_counter()
+"""
+
+load_catalog = """
+import time, json
+start = time.perf_counter()
+from font_catalog import FontCatalog
+font_catalog = FontCatalog.open({catalog!r})
+font_embeddings_array = font_catalog.font_embeddings_array
+dict_font_labels_to_indices = font_catalog.dict_font_labels_to_indices
+dict_font_indices_to_labels = font_catalog.dict_font_indices_to_labels
+loaded = time.perf_counter()
+"""
+
+lookups = """
+labels = [dict_font_indices_to_labels[index] for index in range(len(font_embeddings_array))]
+lookup_start = time.perf_counter()
+for label in labels:
+    dict_font_indices_to_labels[dict_font_labels_to_indices[label]]
+lookup_end = time.perf_counter()
+print(json.dumps({{'load_ms': (loaded - start) * 1e3, 'lookup_us': (lookup_end - lookup_start) * 1e6 / len(labels)}}))
+"""
+
+
+def run(script, repeats):
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {key: float(np.median([result[key] for result in results])) for key in results[0]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--embeddings', default='./data/embeddings/all_font_embeddings.npz')
+    parser.add_argument('--dictionary', default='./data/embeddings/font_name_to_index.pickle')
+    parser.add_argument('--catalog', default='./data/embeddings/all_fonts.fontcat')
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    paths = {'embeddings': args.embeddings, 'dictionary': args.dictionary, 'catalog': args.catalog}
+    legacy = run((load_legacy + lookups).format(**paths), args.repeats)
+    catalog = run((load_catalog + lookups).format(**paths), args.repeats)
+
+    print(f'median of {args.repeats} fresh processes')
+    print(f"    npz + pickle:  load {legacy['load_ms']:8.2f}ms   label <-> index round trip {legacy['lookup_us']:6.2f}us")
+    print(f"    font catalog:  load {catalog['load_ms']:8.2f}ms   label <-> index round trip {catalog['lookup_us']:6.2f}us")
@@ -0,0 +1,53 @@
+"""
+Serialization benchmark for /graph responses: per-node dicts validated and encoded the way FastAPI does it
+(jsonable_encoder + stdlib json), vs the columnar format written out by fast_json (orjson when installed).
+
+Reports the time to build and serialize one 200-node graph and the resulting payload size, on the real catalog.
+
+Usage:
+    python benchmark_graph_serialization.py --repeats 500
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+
+import fast_json
+import main
+
+
+def time_per_call(function, repeats):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        payload = function()
+    return (time.perf_counter() - start) / repeats * 1e3, len(payload)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    snapshot = main.catalog_snapshots.current
+    font_label = next(iter(snapshot.dict_font_labels_to_indices))
+    list_of_font_candidate_indices = main.find_graph_candidates(snapshot, font_label)
+    reduced_data, _ = main.reduce_with_pca(data= snapshot.font_embeddings_array[list_of_font_candidate_indices, :], n_components= 2)
+
+    def nodes_format():
+        response = main.make_graph_response(snapshot, list_of_font_candidate_indices, reduced_data, 'nodes')
+        return json.dumps(jsonable_encoder(response)).encode('utf-8')
+
+    def columnar_format():
+        return fast_json.dumps(main.make_graph_response(snapshot, list_of_font_candidate_indices, reduced_data, 'columnar'))
+
+    nodes_ms, nodes_bytes = time_per_call(nodes_format, args.repeats)
+    columnar_ms, columnar_bytes = time_per_call(columnar_format, args.repeats)
+
+    encoder = 'orjson' if fast_json.orjson is not None else 'stdlib json'
+    print(f'{len(list_of_font_candidate_indices)}-node graph, mean of {args.repeats} calls')
+    print(f'    nodes + jsonable_encoder:   {nodes_ms:7.3f}ms   {nodes_bytes / 1024:6.1f}KB')
+    print(f'    columnar + {encoder:<16} {columnar_ms:7.3f}ms   {columnar_bytes / 1024:6.1f}KB')
+    print(f'    speed-up {nodes_ms / columnar_ms:.1f}x, payload {100 * (1 - columnar_bytes / nodes_bytes):.0f}% smaller')
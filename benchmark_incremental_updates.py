@@ -0,0 +1,78 @@
+#%%
+"""
+Cost of adding fonts to the Annoy backend incrementally (add_vector into the delta segment) versus a full rebuild.
+
+For each synthetic catalog size this measures:
+    - the time to add one font with add_vector, and with a full add_vectors + index build
+    - query latency with an empty delta and with --delta-sizes pending changes (half additions, half removals)
+    - the time of the background compaction that folds the delta back into the index
+
+Usage:
+    python benchmark_incremental_updates.py
+    python benchmark_incremental_updates.py --sizes 10000 100000 --delta-sizes 100 1000 --metric angular
+"""
+import argparse
+import time
+
+import numpy as np
+
+from vector_database import MultiMetricDatabase
+
+
+def query_ms(database, queries, metric, k):
+    start = time.perf_counter()
+    for query in queries:
+        database.nearest_neighbors(query, metric, k)
+    return (time.perf_counter() - start) / len(queries) * 1e3
+
+
+def run_benchmark(sizes, delta_sizes, dimensions, metric, k, n_trees, n_queries, seed=42):
+    rng = np.random.default_rng(seed)
+    for size in sizes:
+        vectors = rng.normal(size=(size, dimensions)).astype(np.float32)
+        map_labels_to_indices = {f'font_{i}': i for i in range(size)}
+        queries = rng.normal(size=(n_queries, dimensions)).astype(np.float32)
+
+        def build():
+            database = MultiMetricDatabase(dimensions=dimensions, metrics=[metric], n_trees=n_trees, delta_max_size=10**9, delta_max_age=float('inf'))
+            database.add_vectors(vectors, map_labels_to_indices)
+            database.warm_up()
+            return database
+
+        start = time.perf_counter()
+        database = build()
+        rebuild_ms = (time.perf_counter() - start) * 1e3
+        base_query_ms = query_ms(database, queries, metric, k)
+
+        print(f'\n{size} fonts: full rebuild {rebuild_ms:.1f}ms, query {base_query_ms:.3f}ms with an empty delta')
+        for delta_size in delta_sizes:
+            database = build()
+            start = time.perf_counter()
+            for i in range(delta_size // 2):
+                database.add_vector(f'new_font_{i}', rng.normal(size=dimensions))
+            add_ms = (time.perf_counter() - start) / max(delta_size // 2, 1) * 1e3
+            for i in range(delta_size - delta_size // 2):
+                database.remove_label(f'font_{i}')
+
+            delta_query_ms = query_ms(database, queries, metric, k)
+            start = time.perf_counter()
+            database.compact()
+            compact_ms = (time.perf_counter() - start) * 1e3
+            compacted_query_ms = query_ms(database, queries, metric, k)
+
+            print(f'    delta {delta_size:6d}: add_vector {add_ms:.3f}ms ({rebuild_ms / add_ms:.0f}x cheaper than a rebuild), '
+                  f'query {delta_query_ms:.3f}ms, compaction {compact_ms:.1f}ms, query after {compacted_query_ms:.3f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--delta-sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--dimensions', type=int, default=9)
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--n-trees', type=int, default=30)
+    parser.add_argument('--n-queries', type=int, default=200)
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes, args.delta_sizes, args.dimensions, args.metric, args.k, args.n_trees, args.n_queries)
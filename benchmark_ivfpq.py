@@ -0,0 +1,111 @@
+#%%
+"""
+Memory, recall and latency of the IVF-PQ engine (ivfpq_index.py) on large synthetic catalogs, e.g. one
+embedding per glyph and weight.
+
+For each catalog and metric this reports:
+    - the bytes of the float32 vectors, against the bytes of the IVF-PQ index (codes, ids and quantizers)
+    - the resident memory (RSS) of this process after the build, and how much the database added to it
+    - the offline build time (training of the coarse centroids and codebooks, and encoding)
+    - recall@k against exact search and mean query latency for several nprobe (inverted lists scanned)
+
+Exact distances are computed a few queries at a time, so that a million-vector catalog fits in memory.
+
+Usage:
+    python benchmark_ivfpq.py
+    python benchmark_ivfpq.py --catalogs 100000 --metrics euclidean angular --n-subquantizers 9 --nprobe 8 32 128
+"""
+import os
+import json
+import argparse
+import time
+
+import numpy as np
+
+from vector_database import MultiMetricDatabase, ExactSearchDatabase
+from benchmark_quantization import load_catalog
+from shared_store import process_memory
+
+
+def exact_recall(exact_db, queries, neighbours, metric, k, batch_size=16):
+    """Mean fraction of the k requested neighbours at least as close as the exact k-th neighbour (robust to ties)."""
+    recalls = []
+    for start in range(0, len(queries), batch_size):
+        distances = exact_db._distances(queries[start:start + batch_size], metric)
+        kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+        tolerance = 1e-5 * np.maximum(1.0, np.abs(kth))
+        for row, found in enumerate(neighbours[start:start + batch_size]):
+            # Item ids -> columns of the exact distance matrix
+            found_distances = distances[row, np.searchsorted(exact_db.item_ids, found)]
+            recalls.append(np.sum(found_distances <= kth[row] + tolerance[row]) / k)
+    return float(np.mean(recalls))
+
+
+def run_benchmark(catalog, dimensions, metrics, k, engine_options, nprobes, n_queries, seed=42):
+    vectors, map_labels_to_indices = load_catalog(catalog, dimensions)
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(seed)
+
+    exact_db = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = exact_db.vectors[rng.choice(len(exact_db.vectors), size=min(n_queries, len(exact_db.vectors)), replace=False)]
+
+    results = {'catalog': catalog, 'n_fonts': len(exact_db.item_ids), 'k': k, 'n_queries': len(queries),
+               'engine_options': engine_options, 'float32_bytes': int(exact_db.vectors.nbytes), 'metrics': []}
+    for metric in metrics:
+        # The catalog and the exact database are already resident, the growth is the IVF-PQ database's
+        rss_before = process_memory()['rss']
+        database = MultiMetricDatabase(dimensions=vectors.shape[1], metrics=[metric], engine='ivfpq', engine_options=engine_options)
+        database.add_vectors(vectors, map_labels_to_indices)
+        start = time.perf_counter()
+        database.warm_up()
+        row = {'metric': metric, 'build_seconds': time.perf_counter() - start, 'bytes': database.index_sizes[metric],
+               'rss_bytes': process_memory()['rss'], 'rss_growth_bytes': process_memory()['rss'] - rss_before, 'points': []}
+
+        for nprobe in nprobes:
+            start = time.perf_counter()
+            neighbours = database.nearest_neighbors_batch(queries, metric, k, search_k=nprobe)
+            query_ms = (time.perf_counter() - start) / len(queries) * 1e3
+            row['points'].append({'nprobe': nprobe, 'recall': exact_recall(exact_db, queries, neighbours, metric, k), 'query_ms': query_ms})
+        results['metrics'].append(row)
+        del database
+
+    return results
+
+
+def print_report(results):
+    print(f"\ncatalog {results['catalog']}: {results['n_fonts']} fonts, recall@{results['k']} over {results['n_queries']} queries, "
+          f"float32 vectors {results['float32_bytes'] / 1024**2:.2f} MB")
+    for row in results['metrics']:
+        print(f"  {row['metric']:>9}: built in {row['build_seconds']:6.2f}s, {row['bytes'] / 1024**2:8.2f} MB "
+              f"({row['bytes'] / results['float32_bytes']:.1%} of float32), process RSS {row['rss_bytes'] / 1024**2:.1f} MB "
+              f"(+{row['rss_growth_bytes'] / 1024**2:.1f} MB)")
+        for point in row['points']:
+            print(f"      nprobe {point['nprobe']:5d}  recall {point['recall']:.4f}  {point['query_ms']:.3f}ms per query")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalogs', nargs='+', default=['100000', '1000000'], help="'real' or numbers of synthetic fonts")
+    parser.add_argument('--metrics', nargs='+', default=['euclidean'])
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--n-lists', type=int, default=None, help='Inverted lists, 4 * sqrt(n) by default')
+    parser.add_argument('--n-subquantizers', type=int, default=None, help='Bytes per code, half the dimensions by default')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 32, 128])
+    parser.add_argument('--n-queries', type=int, default=100)
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--output', default=None, help='JSON report, data/benchmarks/ivfpq_<time>.json by default')
+    args = parser.parse_args()
+
+    engine_options = {'n_lists': args.n_lists, 'n_subquantizers': args.n_subquantizers}
+    all_results = []
+    for catalog in args.catalogs:
+        results = run_benchmark(catalog, args.dimensions, args.metrics, args.k, engine_options, args.nprobe, args.n_queries)
+        print_report(results)
+        all_results.append(results)
+
+    output = args.output or f"./data/benchmarks/ivfpq_{time.strftime('%Y%m%dT%H%M%S')}.json"
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(all_results, handle, indent=2)
+    print(f'\nReport written to {output}')
@@ -0,0 +1,94 @@
+#%%
+"""
+Crossover benchmark between the exact (brute-force NumPy) and the Annoy vector database backends.
+
+For a range of synthetic catalog sizes this measures, for both backends:
+    - build time (add_vectors)
+    - mean latency of a single nearest_neighbors query
+
+and reports the smallest catalog size at which Annoy answers queries faster than the exact search,
+plus the number of queries needed to amortise Annoy's extra build time at that size.
+
+Usage:
+    python benchmark_knn_crossover.py
+    python benchmark_knn_crossover.py --sizes 1000 10000 100000 --dimensions 9 --k 200
+"""
+import argparse
+import time
+
+import numpy as np
+
+from vector_database import MultiMetricDatabase, ExactSearchDatabase
+
+
+def time_backend(database_class, vectors, queries, metric, k, n_trees):
+    map_labels_to_indices = {i: i for i in range(len(vectors))}
+
+    database = database_class(dimensions=vectors.shape[1], metrics=[metric], n_trees=n_trees)
+
+    start = time.perf_counter()
+    database.add_vectors(vectors, map_labels_to_indices)
+    build_seconds = time.perf_counter() - start
+
+    # Warm up once, so lazy allocations are not counted against the first query
+    database.nearest_neighbors(queries[0], metric, k)
+
+    start = time.perf_counter()
+    for query in queries:
+        database.nearest_neighbors(query, metric, k)
+    query_seconds = (time.perf_counter() - start) / len(queries)
+
+    return build_seconds, query_seconds
+
+
+def run_benchmark(sizes, dimensions, k, metric, n_trees, n_queries, seed=42):
+    rng = np.random.default_rng(seed)
+    results = []
+
+    for size in sizes:
+        vectors = rng.normal(size=(size, dimensions)).astype(np.float32)
+        queries = vectors[rng.integers(0, size, n_queries)]
+
+        exact_build, exact_query = time_backend(ExactSearchDatabase, vectors, queries, metric, k, n_trees)
+        annoy_build, annoy_query = time_backend(MultiMetricDatabase, vectors, queries, metric, k, n_trees)
+
+        results.append({
+            'size': size,
+            'exact_build_ms': exact_build * 1e3,
+            'exact_query_ms': exact_query * 1e3,
+            'annoy_build_ms': annoy_build * 1e3,
+            'annoy_query_ms': annoy_query * 1e3,
+        })
+
+    return results
+
+
+def print_report(results):
+    print(f"{'size':>10} {'exact build':>12} {'exact query':>12} {'annoy build':>12} {'annoy query':>12}")
+    for row in results:
+        print(f"{row['size']:>10} {row['exact_build_ms']:>10.2f}ms {row['exact_query_ms']:>10.3f}ms "
+              f"{row['annoy_build_ms']:>10.2f}ms {row['annoy_query_ms']:>10.3f}ms")
+
+    crossover = next((row for row in results if row['annoy_query_ms'] < row['exact_query_ms']), None)
+    if crossover is None:
+        print('\nExact search was faster per query at every size tested.')
+        return
+
+    saved_per_query_ms = crossover['exact_query_ms'] - crossover['annoy_query_ms']
+    extra_build_ms = crossover['annoy_build_ms'] - crossover['exact_build_ms']
+    print(f"\nAnnoy starts to win per query at a catalog size of {crossover['size']} vectors.")
+    print(f"At that size it needs ~{max(extra_build_ms, 0) / saved_per_query_ms:.0f} queries to amortise its extra build time.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 5000, 10000, 20000, 50000, 100000])
+    parser.add_argument('--dimensions', type=int, default=9)
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--n-trees', type=int, default=30)
+    parser.add_argument('--n-queries', type=int, default=200)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.dimensions, args.k, args.metric, args.n_trees, args.n_queries)
+    print_report(results)
@@ -0,0 +1,279 @@
+"""
+HTTP load test of /fonts, /similar_fonts and /graph against a locally started server.
+
+For every catalog, the app from main.py is started under gunicorn (as in the Procfile) on a free port on
+127.0.0.1, then 'concurrency' clients keep requests in flight for 'duration' seconds, each picking the endpoint
+from the request mix. Reported per endpoint: throughput, p50/p95/p99 latency and errors, plus the resident memory
+of every worker (sampled during the run). Results are written as JSON, to compare runs.
+
+Catalogs are either 'real' (the app's own ./data) or a number of fonts: a synthetic catalog of that size is then
+generated (clustered random embeddings, labels 'Synthetic-000000', ...) in a temporary directory the server runs
+in. Synthetic catalogs have no precomputed neighbour table or layouts, so /similar_fonts and /graph go through
+live vector search and PCA: this is where to look for the catalog size at which they stop scaling.
+
+The response cache is disabled unless --cache is given, so every request does the full work.
+
+Usage:
+    python benchmark_load.py
+    python benchmark_load.py --catalogs real 1000 10000 100000 --concurrency 16 --duration 30
+    python benchmark_load.py --mix fonts=1 similar_fonts=4 graph=4 --workers 2
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from font_catalog import FontCatalog
+from shared_store import process_memory
+from vector_database import catalog_version
+
+
+repository_path = os.path.dirname(os.path.abspath(__file__))
+catalog_file = os.path.join('data', 'embeddings', 'all_fonts.fontcat')
+store_catalog_file = os.path.join('data', 'store', 'font_catalog.fontcat')
+
+
+def synthetic_catalog(n_fonts, dimensions, seed=42):
+    """Clustered random embeddings with unit overall standard deviation (like the real ones), and their label map."""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, n_fonts // 50)
+    centres = rng.normal(size=(n_clusters, dimensions))
+    font_embeddings_array = centres[rng.integers(n_clusters, size=n_fonts)] + 0.5 * rng.normal(size=(n_fonts, dimensions))
+    font_embeddings_array = (font_embeddings_array / font_embeddings_array.std()).astype(np.float32)
+    dict_font_labels_to_indices = {f'Synthetic-{index:06d}': index for index in range(n_fonts)}
+    return font_embeddings_array, dict_font_labels_to_indices
+
+
+def make_synthetic_catalog(directory, n_fonts, dimensions, seed=42):
+    """Write a synthetic catalog of 'n_fonts' fonts into 'directory'/data/embeddings."""
+    font_embeddings_array, dict_font_labels_to_indices = synthetic_catalog(n_fonts, dimensions, seed)
+
+    os.makedirs(os.path.join(directory, 'data', 'embeddings'), exist_ok=True)
+    FontCatalog.write(os.path.join(directory, catalog_file), font_embeddings_array, dict_font_labels_to_indices,
+                      catalog_version(font_embeddings_array, dict_font_labels_to_indices))
+
+    # The app serves its pages and images from the working directory
+    for name in ['static', 'templates']:
+        os.symlink(os.path.join(repository_path, name), os.path.join(directory, name))
+
+
+def free_port():
+    with socket.socket() as handle:
+        handle.bind(('127.0.0.1', 0))
+        return handle.getsockname()[1]
+
+
+def start_server(directory, port, workers, cache):
+    environment = dict(os.environ, PYTHONPATH=repository_path, METRICS_DIRECTORY=os.path.join(directory, 'data', 'metrics'))
+    if not cache:
+        environment['RESPONSE_CACHE_MAX_BYTES'] = '0'
+        environment.pop('RESPONSE_CACHE_DIRECTORY', None)
+
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(repository_path, 'gunicorn.conf.py'),
+                               '-w', str(workers), '-k', 'uvicorn.workers.UvicornWorker', '-b', f'127.0.0.1:{port}', 'main:app'],
+                              cwd=directory, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    deadline = time.time() + 300
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'Server exited while starting:\n{server.stderr.read().decode()[-2000:]}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/cache/stats')
+            if connection.getresponse().status == 200:
+                connection.close()
+                return server
+        except OSError:
+            pass
+        time.sleep(0.5)
+    server.kill()
+    raise RuntimeError('Server did not start within 300s')
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def worker_pids(server):
+    import psutil
+
+    return [child.pid for child in psutil.Process(server.pid).children()]
+
+
+def make_request(endpoint, font_index, font_label):
+    """Method, path and body of one request to 'endpoint' about the font 'font_index'."""
+    if endpoint == 'fonts':
+        return 'GET', '/fonts', None
+    if endpoint == 'similar_fonts':
+        return 'POST', '/similar_fonts', {'font_index': font_index}
+    return 'POST', '/graph', {'font_1_index': font_index, 'font_1_label': font_label}
+
+
+def run_load(port, font_labels, mix, concurrency, duration, seed=42):
+    """Keep 'concurrency' requests in flight for 'duration' seconds. Returns [(endpoint, seconds, status)]."""
+    endpoints = list(mix)
+    weights = [mix[endpoint] for endpoint in endpoints]
+    results = []
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(client_index):
+        rng = random.Random(seed + client_index)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        own_results = []
+        while time.perf_counter() < deadline:
+            endpoint = rng.choices(endpoints, weights)[0]
+            font_index = rng.randrange(len(font_labels))
+            method, path, payload = make_request(endpoint, font_index, font_labels[font_index])
+            body = json.dumps(payload).encode() if payload is not None else None
+            headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'} if body else {'Accept-Encoding': 'gzip'}
+
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                status = 0
+            own_results.append((endpoint, time.perf_counter() - start, status))
+        connection.close()
+        with results_lock:
+            results.extend(own_results)
+
+    threads = [threading.Thread(target=client, args=(client_index,)) for client_index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(results, duration):
+    summary = {}
+    for endpoint in sorted({endpoint for endpoint, _, _ in results}):
+        latencies = np.array([seconds for name, seconds, _ in results if name == endpoint]) * 1000
+        errors = sum(1 for name, _, status in results if name == endpoint and status != 200)
+        summary[endpoint] = {
+            'requests': len(latencies), 'errors': errors, 'throughput_rps': len(latencies) / duration,
+            'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)), 'mean_ms': float(latencies.mean()),
+        }
+    return summary
+
+
+def benchmark_catalog(catalog, args, mix):
+    directory = None
+    if catalog == 'real':
+        server_directory = os.getcwd()
+    else:
+        directory = tempfile.mkdtemp(prefix=f'font_load_{catalog}_')
+        make_synthetic_catalog(directory, int(catalog), args.dimensions)
+        server_directory = directory
+
+    port = free_port()
+    started = time.perf_counter()
+    server = start_server(server_directory, port, args.workers, args.cache)
+    startup_seconds = time.perf_counter() - started
+    try:
+        # Without a catalog file the server has just populated the shared store (see main.py)
+        catalog_path = os.path.join(server_directory, catalog_file)
+        if not os.path.exists(catalog_path):
+            catalog_path = os.path.join(server_directory, store_catalog_file)
+        font_catalog = FontCatalog.open(catalog_path)
+        font_labels = [font_catalog.label(index) for index in range(len(font_catalog.font_embeddings_array))]
+
+        # Sample the workers' memory while the load runs, to report its peak
+        peak_rss = {}
+        sampling = threading.Event()
+
+        def sample_memory():
+            while not sampling.wait(0.5):
+                for pid in worker_pids(server):
+                    try:
+                        peak_rss[pid] = max(peak_rss.get(pid, 0), process_memory(pid)['rss'])
+                    except Exception:     # worker restarting
+                        pass
+
+        run_load(port, font_labels, mix, args.concurrency, args.warmup)
+        sampler = threading.Thread(target=sample_memory)
+        sampler.start()
+        results = run_load(port, font_labels, mix, args.concurrency, args.duration)
+        sampling.set()
+        sampler.join()
+        final_memory = {pid: process_memory(pid) for pid in worker_pids(server)}
+    finally:
+        stop_server(server)
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    mb = 1024 ** 2
+    return {
+        'catalog': catalog, 'n_fonts': len(font_labels), 'startup_seconds': startup_seconds,
+        'throughput_rps': len(results) / args.duration,
+        'endpoints': summarize(results, args.duration),
+        'workers': [{'pid': pid, 'rss_mb': memory['rss'] / mb, 'unique_mb': memory['unique'] / mb,
+                     'peak_rss_mb': max(peak_rss.get(pid, 0), memory['rss']) / mb} for pid, memory in final_memory.items()],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository_path, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalogs', nargs='+', default=['1000', '10000', '100000'], help="'real' or a number of synthetic fonts")
+    parser.add_argument('--mix', nargs='+', default=['fonts=1', 'similar_fonts=4', 'graph=4'], help='endpoint=weight pairs')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of measured load per catalog')
+    parser.add_argument('--warmup', type=float, default=3, help='Seconds of unmeasured load before measuring')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--cache', action='store_true', help='Keep the response cache enabled')
+    parser.add_argument('--output', default=None, help='Results file, by default ./data/benchmarks/load_<time>.json')
+    args = parser.parse_args()
+
+    mix = {endpoint: float(weight) for endpoint, weight in (item.split('=') for item in args.mix)}
+    unknown_endpoints = set(mix) - {'fonts', 'similar_fonts', 'graph'}
+    assert not unknown_endpoints, f'Unknown endpoints in --mix: {unknown_endpoints}'
+
+    runs = []
+    for catalog in args.catalogs:
+        run = benchmark_catalog(catalog, args, mix)
+        runs.append(run)
+
+        print(f"catalog {catalog}: {run['n_fonts']} fonts, started in {run['startup_seconds']:.1f}s, "
+              f"{run['throughput_rps']:.0f} requests/s with {args.concurrency} clients")
+        for endpoint, summary in run['endpoints'].items():
+            print(f"    {endpoint:<14} {summary['throughput_rps']:8.1f}/s   p50 {summary['p50_ms']:8.2f}ms   "
+                  f"p95 {summary['p95_ms']:8.2f}ms   p99 {summary['p99_ms']:8.2f}ms   errors {summary['errors']}")
+        for worker in run['workers']:
+            print(f"    worker {worker['pid']}: rss {worker['rss_mb']:.1f}MB (peak {worker['peak_rss_mb']:.1f}MB, unique {worker['unique_mb']:.1f}MB)")
+
+    output_path = args.output or os.path.join('data', 'benchmarks', f"load_{time.strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w') as handle:
+        json.dump({'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                   'concurrency': args.concurrency, 'duration': args.duration, 'workers': args.workers, 'mix': mix,
+                   'cache': args.cache, 'runs': runs}, handle, indent=2)
+    print(f'Results written to {output_path}')
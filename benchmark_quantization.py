@@ -0,0 +1,117 @@
+#%%
+"""
+Memory saved and recall lost by storing the embeddings as float16 or int8 (QuantizedSearchDatabase), against
+the float32 ExactSearchDatabase.
+
+For each catalog and quantization this reports:
+    - the bytes held per process: the float32 copy plus per-metric arrays of the exact backend, the codes of the
+      quantized one (the full-precision vectors they re-rank with are the shared, memory-mapped catalog)
+    - recall@k against exact search, for several re-ranking factors (candidates searched per requested neighbour)
+    - mean query latency
+
+Usage:
+    python benchmark_quantization.py
+    python benchmark_quantization.py --catalogs real 100000 --metrics euclidean angular --k 200
+"""
+import os
+import json
+import argparse
+import time
+
+import numpy as np
+
+from vector_database import ExactSearchDatabase, QuantizedSearchDatabase
+
+
+def load_catalog(catalog, dimensions):
+    if catalog != 'real':
+        from benchmark_load import synthetic_catalog
+        return synthetic_catalog(int(catalog), dimensions)
+
+    from tune_annoy_index import load_catalog as load_real_catalog
+    return load_real_catalog('real', dimensions)
+
+
+def exact_bytes(database, metrics):
+    database.warm_up(metrics)
+    prepared = sum(array.nbytes for metric in metrics for name, array in database.databases[metric].items()
+                   if name != 'vectors' or array is not database.vectors)
+    return database.vectors.nbytes + database.item_ids.nbytes + prepared
+
+
+def recall_at_k(distances, neighbours, k):
+    """Fraction of 'neighbours' at least as close as the exact k-th neighbour (robust to ties)."""
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1:k]
+    found = np.take_along_axis(distances, neighbours, axis=1)
+    return float(np.mean(found <= kth + 1e-5 * np.maximum(1.0, np.abs(kth))))
+
+
+def run_benchmark(catalog, dimensions, metrics, k, quantizations, rerank_factors, n_queries, seed=42):
+    vectors, map_labels_to_indices = load_catalog(catalog, dimensions)
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(seed)
+
+    exact_db = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = exact_db.vectors[rng.choice(len(exact_db.vectors), size=min(n_queries, len(exact_db.vectors)), replace=False)]
+
+    results = {'catalog': catalog, 'n_fonts': len(exact_db.item_ids), 'k': k, 'n_queries': len(queries),
+               'exact_bytes': exact_bytes(exact_db, metrics), 'exact_query_ms': {}, 'quantized': []}
+
+    distances = {}
+    for metric in metrics:
+        distances[metric] = exact_db._distances(queries, metric)
+        start = time.perf_counter()
+        exact_db.nearest_neighbors_batch(queries, metric, k)
+        results['exact_query_ms'][metric] = (time.perf_counter() - start) / len(queries) * 1e3
+
+    for quantization in quantizations:
+        for rerank_factor in rerank_factors:
+            database = QuantizedSearchDatabase(dimensions=vectors.shape[1], metrics=metrics, quantization=quantization, rerank_factor=rerank_factor)
+            database.add_vectors(vectors, map_labels_to_indices)
+            row = {'quantization': quantization, 'rerank_factor': rerank_factor, 'bytes': database.memory_bytes(), 'recall': {}, 'query_ms': {}}
+
+            for metric in metrics:
+                start = time.perf_counter()
+                neighbours = database.nearest_neighbors_batch(queries, metric, k)
+                row['query_ms'][metric] = (time.perf_counter() - start) / len(queries) * 1e3
+                # Item ids -> columns of the exact distance matrix
+                row['recall'][metric] = recall_at_k(distances[metric], np.searchsorted(exact_db.item_ids, neighbours), k)
+            results['quantized'].append(row)
+
+    return results
+
+
+def print_report(results, metrics):
+    print(f"\ncatalog {results['catalog']}: {results['n_fonts']} fonts, recall@{results['k']} over {results['n_queries']} queries")
+    print(f"  float32 exact: {results['exact_bytes'] / 1024**2:9.2f} MB  "
+          + '  '.join(f"{metric} {results['exact_query_ms'][metric]:.3f}ms" for metric in metrics))
+    for row in results['quantized']:
+        saved = 1 - row['bytes'] / results['exact_bytes']
+        print(f"  {row['quantization']:>7} x{row['rerank_factor']:<4g} {row['bytes'] / 1024**2:9.2f} MB ({saved:6.1%} saved)  "
+              + '  '.join(f"{metric} recall {row['recall'][metric]:.4f} {row['query_ms'][metric]:.3f}ms" for metric in metrics))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalogs', nargs='+', default=['real', '10000', '100000'], help="'real' or numbers of synthetic fonts")
+    parser.add_argument('--metrics', nargs='+', default=['euclidean', 'angular'])
+    parser.add_argument('--quantizations', nargs='+', default=['float16', 'int8'])
+    parser.add_argument('--rerank-factors', type=float, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--n-queries', type=int, default=200)
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--output', default=None, help='JSON report, data/benchmarks/quantization_<time>.json by default')
+    args = parser.parse_args()
+
+    all_results = []
+    for catalog in args.catalogs:
+        results = run_benchmark(catalog, args.dimensions, args.metrics, args.k, args.quantizations, args.rerank_factors, args.n_queries)
+        print_report(results, args.metrics)
+        all_results.append(results)
+
+    output = args.output or f"./data/benchmarks/quantization_{time.strftime('%Y%m%dT%H%M%S')}.json"
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(all_results, handle, indent=2)
+    print(f'\nReport written to {output}')
@@ -0,0 +1,142 @@
+#%%
+"""
+Scatter-gather search over local shard processes (sharded_search.py) against one in-process database.
+
+For each catalog and number of shards this reports:
+    - the time to start the shards (each indexes its partition) and their memory (unique pages, PSS)
+    - recall@k of the merged results against exact search
+    - latency (mean, p95) of single queries, and throughput with 'concurrency' threads querying at once
+    - the same for one in-process database of the same backend, as the baseline
+
+Shards help when one machine's cores are otherwise idle during a query, or when an index no longer fits one
+process: with as many shards as cores, a query's work is split across them.
+
+Usage:
+    python benchmark_sharded_search.py
+    python benchmark_sharded_search.py --catalogs 1000000 --backend ivfpq --shards 2 4 8 --concurrency 8
+"""
+import os
+import json
+import argparse
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from vector_database import vector_database_backends, ExactSearchDatabase
+from sharded_search import start_shards, wait_for_shards, ShardedSearchDatabase
+from benchmark_quantization import load_catalog
+from benchmark_ann_engines import recall_at_k
+from shared_store import process_memory
+
+
+def measure(database, queries, metric, k, concurrency):
+    """Single-query latencies in ms, the neighbours found, and queries per second with 'concurrency' threads."""
+    latencies, neighbours = [], []
+    for query in queries:
+        start = time.perf_counter()
+        neighbours.append(database.nearest_neighbors(query, metric, k))
+        latencies.append((time.perf_counter() - start) * 1e3)
+
+    def run(rows):
+        for query in queries[rows]:
+            database.nearest_neighbors(query, metric, k)
+
+    threads = [threading.Thread(target=run, args=(slice(thread, None, concurrency),)) for thread in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    throughput = len(queries) / (time.perf_counter() - start)
+    return latencies, neighbours, throughput
+
+
+def summary(latencies, neighbours, throughput, distances, item_ids, k):
+    return {'mean_ms': float(np.mean(latencies)), 'p95_ms': float(np.percentile(latencies, 95)),
+            'queries_per_second': throughput, 'recall': recall_at_k(distances, item_ids, neighbours, k)}
+
+
+def run_benchmark(catalog, dimensions, metric, k, backend, shard_counts, timeout, concurrency, n_queries, seed=42):
+    vectors, map_labels_to_indices = load_catalog(catalog, dimensions)
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(seed)
+
+    exact_db = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=[metric])
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = exact_db.vectors[rng.choice(len(exact_db.vectors), size=min(n_queries, len(exact_db.vectors)), replace=False)]
+    distances = exact_db._distances(queries, metric)
+
+    results = {'catalog': catalog, 'n_fonts': len(exact_db.item_ids), 'metric': metric, 'k': k, 'backend': backend,
+               'n_queries': len(queries), 'concurrency': concurrency, 'runs': []}
+
+    # Baseline: one database in this process
+    start = time.perf_counter()
+    database = vector_database_backends[backend](dimensions=vectors.shape[1], metrics=[metric], n_trees=30)
+    database.add_vectors(vectors, map_labels_to_indices)
+    database.warm_up()
+    row = {'n_shards': 0, 'start_seconds': time.perf_counter() - start}
+    row.update(summary(*measure(database, queries, metric, k, concurrency), distances, exact_db.item_ids, k))
+    results['runs'].append(row)
+    del database
+
+    for n_shards in shard_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            processes = start_shards(vectors, map_labels_to_indices, n_shards, directory, backend, [metric], {'n_trees': 30})
+            try:
+                statuses = wait_for_shards(directory, n_shards, processes=processes)
+                row = {'n_shards': n_shards, 'start_seconds': time.perf_counter() - start,
+                       'shard_memory': [process_memory(status['pid']) for status in statuses]}
+                database = ShardedSearchDatabase(dimensions=vectors.shape[1], metrics=[metric], n_shards=n_shards, directory=directory, timeout=timeout)
+                row.update(summary(*measure(database, queries, metric, k, concurrency), distances, exact_db.item_ids, k))
+                row['partial_queries'] = database.partial_queries
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.join()
+        results['runs'].append(row)
+
+    return results
+
+
+def print_report(results):
+    print(f"\ncatalog {results['catalog']}: {results['n_fonts']} fonts, {results['backend']} {results['metric']}, "
+          f"recall@{results['k']} over {results['n_queries']} queries, {results['concurrency']} threads for throughput")
+    for row in results['runs']:
+        name = f"{row['n_shards']} shards" if row['n_shards'] else 'in-process'
+        memory = ''
+        if 'shard_memory' in row:
+            memory = (f", shards {sum(memory['unique'] for memory in row['shard_memory']) / 1024**2:.1f} MB unique "
+                      f"/ {sum(memory['pss'] for memory in row['shard_memory']) / 1024**2:.1f} MB PSS, {row['partial_queries']} partial queries")
+        print(f"  {name:>10}: started in {row['start_seconds']:6.2f}s, recall {row['recall']:.4f}, {row['mean_ms']:.3f}ms mean, "
+              f"{row['p95_ms']:.3f}ms p95, {row['queries_per_second']:.0f} queries/s{memory}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalogs', nargs='+', default=['100000'], help="'real' or numbers of synthetic fonts")
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--backend', default='annoy', choices=[backend for backend in vector_database_backends if backend != 'sharded'])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--timeout', type=float, default=1.0, help='Seconds a query waits for the shards')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--n-queries', type=int, default=200)
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--output', default=None, help='JSON report, data/benchmarks/sharded_search_<time>.json by default')
+    args = parser.parse_args()
+
+    all_results = []
+    for catalog in args.catalogs:
+        results = run_benchmark(catalog, args.dimensions, args.metric, args.k, args.backend, args.shards, args.timeout,
+                                args.concurrency, args.n_queries)
+        print_report(results)
+        all_results.append(results)
+
+    output = args.output or f"./data/benchmarks/sharded_search_{time.strftime('%Y%m%dT%H%M%S')}.json"
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump(all_results, handle, indent=2)
+    print(f'\nReport written to {output}')
@@ -0,0 +1,103 @@
+"""
+Latency benchmark for /similar_fonts and /graph, with and without the precomputed neighbour table.
+
+Drives the FastAPI app from main.py in-process (straight through its ASGI interface, no network),
+keeping 'concurrency' requests in flight, and reports p50/p99 latency for both serving modes plus
+how much the neighbour table reduces them. Build the table first with build_neighbour_table.py.
+
+Usage:
+    python benchmark_similar_fonts_latency.py
+    python benchmark_similar_fonts_latency.py --requests 2000 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+import main
+
+
+async def asgi_post(app, path, payload):
+    """Send one JSON POST through the ASGI app and return the response status code."""
+    body = json.dumps(payload).encode()
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'root_path': '', 'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 0), 'server': ('127.0.0.1', 8000),
+    }
+    request_sent = False
+    status = {}
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            return {'type': 'http.disconnect'}
+        request_sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+
+    await app(scope, receive, send)
+    return status['code']
+
+
+def make_payload(path, font_index):
+    if path == '/similar_fonts':
+        return {'font_index': font_index}
+    return {'font_1_index': font_index, 'font_1_label': main.catalog_snapshots.current.dict_font_indices_to_labels[font_index]}
+
+
+async def run_load(path, n_requests, concurrency, seed=42):
+    rng = random.Random(seed)
+    font_indices = [rng.choice(list(main.catalog_snapshots.current.dict_font_indices_to_labels)) for _ in range(n_requests)]
+    latencies = []
+    queue = asyncio.Queue()
+    for font_index in font_indices:
+        queue.put_nowait(font_index)
+
+    async def worker():
+        while not queue.empty():
+            font_index = queue.get_nowait()
+            start = time.perf_counter()
+            status = await asgi_post(main.app, path, make_payload(path, font_index))
+            latencies.append(time.perf_counter() - start)
+            assert status == 200, f'{path} returned {status}'
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return np.array(latencies) * 1e3
+
+
+def percentiles(latencies_ms):
+    return np.percentile(latencies_ms, 50), np.percentile(latencies_ms, 99)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    snapshot = main.catalog_snapshots.current
+    assert snapshot.font_neighbour_table is not None, 'No usable neighbour table, run build_neighbour_table.py first.'
+
+    # Measure the search itself, not the response cache
+    main.response_cache.max_bytes = 0
+    main.response_cache.disk_directory = None
+    neighbour_table = snapshot.font_neighbour_table
+
+    for path in ['/similar_fonts', '/graph']:
+        snapshot.font_neighbour_table = None
+        live_p50, live_p99 = percentiles(asyncio.run(run_load(path, args.requests, args.concurrency)))
+        snapshot.font_neighbour_table = neighbour_table
+        table_p50, table_p99 = percentiles(asyncio.run(run_load(path, args.requests, args.concurrency)))
+
+        print(f'{path} ({args.requests} requests, concurrency {args.concurrency}, backend {main.vector_database_backend})')
+        print(f'    live search:     p50 {live_p50:8.3f}ms   p99 {live_p99:8.3f}ms')
+        print(f'    neighbour table: p50 {table_p50:8.3f}ms   p99 {table_p99:8.3f}ms')
+        print(f'    reduction:       p50 {100 * (1 - table_p50 / live_p50):7.1f}%    p99 {100 * (1 - table_p99 / live_p99):7.1f}%')
@@ -0,0 +1,71 @@
+"""
+Startup regression benchmark for the web process: import time, resident memory and heavy modules of 'import main'.
+
+main.py is imported in fresh Python processes (so nothing is cached between runs), which is what every gunicorn
+worker does at boot. Exits with status 1 when the median import time or RSS goes over its threshold, or when
+any module that serving does not need (torch, matplotlib, scikit-learn, ...) gets imported at startup again,
+so it can run as a check before deploying to the 500MB dyno.
+
+Usage:
+    python benchmark_startup.py
+    python benchmark_startup.py --repeats 10 --max-seconds 3 --max-rss-mb 150
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+
+# Only needed for training, plotting or offline builds: importing any of them in the web process is a regression
+forbidden_modules = ['torch', 'torchvision', 'matplotlib', 'sklearn', 'kneed', 'pandas', 'networkx', 'memory_profiler', 'PIL']
+
+import_main = """
+import time, json, sys
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+import psutil
+print(json.dumps({{'seconds': seconds, 'rss_mb': psutil.Process().memory_info().rss / 1024**2,
+                  'modules': len(sys.modules), 'forbidden': [module for module in {forbidden!r} if module in sys.modules]}}))
+"""
+
+
+def run(repeats):
+    results = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', import_main.format(forbidden=forbidden_modules)],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=3.0, help='Threshold on the median import time')
+    parser.add_argument('--max-rss-mb', type=float, default=150.0, help='Threshold on the median RSS after import')
+    args = parser.parse_args()
+
+    results = run(args.repeats)
+    seconds = float(np.median([result['seconds'] for result in results]))
+    rss_mb = float(np.median([result['rss_mb'] for result in results]))
+    forbidden = sorted({module for result in results for module in result['forbidden']})
+
+    print(f'import main, median of {args.repeats} fresh processes')
+    print(f'    time:     {seconds:6.2f}s   (threshold {args.max_seconds:.2f}s)')
+    print(f'    rss:      {rss_mb:6.1f}MB  (threshold {args.max_rss_mb:.1f}MB)')
+    print(f"    modules:  {results[0]['modules']:6d}    forbidden: {', '.join(forbidden) or 'none'}")
+
+    failures = []
+    if seconds > args.max_seconds:
+        failures.append(f'import time {seconds:.2f}s is over {args.max_seconds:.2f}s')
+    if rss_mb > args.max_rss_mb:
+        failures.append(f'RSS {rss_mb:.1f}MB is over {args.max_rss_mb:.1f}MB')
+    if forbidden:
+        failures.append(f"startup imports {', '.join(forbidden)}, which serving does not need")
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
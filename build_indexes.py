@@ -0,0 +1,68 @@
+"""
+Offline build step for the Annoy (or HNSW / IVF-PQ, with --engine) index artifacts.
+
+IVF-PQ indexes train their coarse centroids and product-quantization codebooks here, so workers only map the codes.
+
+Writes one versioned, memory-mappable index file per metric into ./data/indexes, so that web workers
+only have to mmap them at startup (see MultiMetricDatabase.load_or_build). Artifacts that are already
+up to date are left untouched; stale ones are rebuilt and the old versions removed.
+
+Usage:
+    python build_indexes.py
+    python build_indexes.py --metrics euclidean angular --n-trees 30
+    python build_indexes.py --engine hnsw --hnsw-m 16
+    python build_indexes.py --engine ivfpq --ivfpq-subquantizers 9
+"""
+import argparse
+import os
+import time
+
+from vector_database import MultiMetricDatabase, index_engines
+from font_catalog import FontCatalog
+from utils import load_data_dict, load_npz
+
+
+# The catalog main.py serves, when it exists, so that the artifacts have the version main.py looks for. Its
+# embeddings are memory-mapped, which IVF-PQ builds read a chunk at a time
+font_catalog_path = './data/embeddings/all_fonts.fontcat'
+font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
+dictionary_path = './data/embeddings/font_name_to_index.pickle'
+index_directory = './data/indexes'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metrics', nargs='+', default=['euclidean'])
+    parser.add_argument('--n-trees', type=int, default=30)
+    parser.add_argument('--engine', default='annoy', choices=list(index_engines))
+    parser.add_argument('--hnsw-m', type=int, default=16)
+    parser.add_argument('--hnsw-ef-construction', type=int, default=64)
+    parser.add_argument('--ivfpq-lists', type=int, default=None)
+    parser.add_argument('--ivfpq-subquantizers', type=int, default=None)
+    parser.add_argument('--directory', default=index_directory)
+    args = parser.parse_args()
+
+    if os.path.exists(font_catalog_path):
+        font_catalog = FontCatalog.open(font_catalog_path)
+        font_embeddings_array = font_catalog.font_embeddings_array
+        dict_font_labels_to_indices = font_catalog.dict_font_labels_to_indices
+    else:
+        font_embeddings_array = load_npz(file_path= font_embeddings_path)
+        dict_font_labels_to_indices = load_data_dict(dictionary_path)
+
+    # Must match the options main.py passes (HNSW_M, HNSW_EF_CONSTRUCTION, IVFPQ_LISTS, IVFPQ_SUBQUANTIZERS),
+    # or the app sees the files as stale
+    engine_options = None
+    if args.engine == 'hnsw':
+        engine_options = {'M': args.hnsw_m, 'ef_construction': args.hnsw_ef_construction}
+    if args.engine == 'ivfpq':
+        engine_options = {'n_lists': args.ivfpq_lists, 'n_subquantizers': args.ivfpq_subquantizers}
+    font_vector_db = MultiMetricDatabase(dimensions=font_embeddings_array.shape[1], metrics=args.metrics, n_trees=args.n_trees,
+                                         engine=args.engine, engine_options=engine_options)
+
+    start = time.perf_counter()
+    version = font_vector_db.load_or_build(font_embeddings_array, dict_font_labels_to_indices, args.directory)
+    # Indexes are otherwise only built on their first query
+    font_vector_db.warm_up(args.metrics)
+    print(f'Index artifacts for {args.metrics} at version {version} ready in {args.directory} '
+          f'({time.perf_counter() - start:.2f}s)')
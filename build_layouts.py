@@ -0,0 +1,52 @@
+"""
+Batch job that precomputes the 2D layout of every font's /graph neighbourhood.
+
+Reads the neighbour table written by build_neighbour_table.py (the /graph candidates of every font), fits the
+same PCA (and, with --tsne, t-SNE) that /graph would run per request, and stores all coordinates as one compact
+float16 array per method in data/embeddings/all_font_layouts.npz. /graph then serves layouts with a single slice.
+
+Usage:
+    python build_neighbour_table.py
+    python build_layouts.py
+    python build_layouts.py --tsne
+"""
+import argparse
+import os
+import time
+
+from graph_layouts import LayoutTable
+from vector_database import NeighbourTable
+from font_catalog import FontCatalog
+from utils import load_npz
+
+
+# The catalog main.py serves, when it exists, so that the layouts are fitted on the embeddings it serves
+font_catalog_path = './data/embeddings/all_fonts.fontcat'
+font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
+neighbour_table_path = './data/embeddings/all_font_neighbours.npz'
+layouts_path = './data/embeddings/all_font_layouts.npz'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tsne', action='store_true', help='also precompute t-SNE layouts (slow)')
+    parser.add_argument('--output', default=layouts_path)
+    args = parser.parse_args()
+
+    if os.path.exists(font_catalog_path):
+        font_embeddings_array = FontCatalog.open(font_catalog_path).font_embeddings_array
+    else:
+        font_embeddings_array = load_npz(file_path= font_embeddings_path)
+    neighbour_table = NeighbourTable.load(neighbour_table_path)
+    methods = ['pca', 'tsne'] if args.tsne else ['pca']
+
+    def progress(method, font_index):
+        if (font_index + 1) % 100 == 0:
+            print(f'    {method}: {font_index + 1}/{len(font_embeddings_array)}')
+
+    start = time.perf_counter()
+    layout_table = LayoutTable.build(font_embeddings_array, neighbour_table, methods=methods, progress=progress)
+    layout_table.save(args.output)
+
+    print(f'{methods} layouts of {layout_table.candidates.shape[0]} neighbourhoods of {layout_table.k} fonts '
+          f'({os.path.getsize(args.output) / 1024:.0f}KB) written to {args.output} in {time.perf_counter() - start:.1f}s')
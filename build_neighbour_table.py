@@ -0,0 +1,50 @@
+"""
+Build-time job for the precomputed neighbour table.
+
+Computes the exact top-k (default 200) neighbours of every font in the catalog and stores them as a compact
+int16/int32 matrix next to all_font_embeddings.npz. main.py serves /similar_fonts and /graph from it with a
+single row slice, and only falls back to live vector search when the table is missing, stale, or does not
+cover the requested metric / number of neighbours.
+
+Usage:
+    python build_neighbour_table.py
+    python build_neighbour_table.py --metric euclidean --k 200
+"""
+import argparse
+import os
+import time
+
+from vector_database import NeighbourTable
+from font_catalog import FontCatalog
+from utils import load_data_dict, load_npz
+
+
+# The catalog main.py serves, when it exists, so that the table records the version main.py checks it against
+font_catalog_path = './data/embeddings/all_fonts.fontcat'
+font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
+dictionary_path = './data/embeddings/font_name_to_index.pickle'
+neighbour_table_path = './data/embeddings/all_font_neighbours.npz'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--output', default=neighbour_table_path)
+    args = parser.parse_args()
+
+    if os.path.exists(font_catalog_path):
+        font_catalog = FontCatalog.open(font_catalog_path)
+        font_embeddings_array = font_catalog.font_embeddings_array
+        dict_font_labels_to_indices = font_catalog.dict_font_labels_to_indices
+    else:
+        font_embeddings_array = load_npz(file_path= font_embeddings_path)
+        dict_font_labels_to_indices = load_data_dict(dictionary_path)
+
+    start = time.perf_counter()
+    neighbour_table = NeighbourTable.build(font_embeddings_array, dict_font_labels_to_indices, metric=args.metric, k=args.k)
+    neighbour_table.save(args.output)
+
+    print(f'Top-{neighbour_table.k} {args.metric} neighbours of {neighbour_table.table.shape[0]} fonts '
+          f'({neighbour_table.table.dtype}, {os.path.getsize(args.output) / 1024:.0f}KB) written to {args.output} '
+          f'in {time.perf_counter() - start:.2f}s')
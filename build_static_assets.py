@@ -0,0 +1,33 @@
+"""
+Fingerprint the static assets for immutable caching (see static_assets.py).
+
+Copies every file under static/ to static/dist/ with a content hash in its name, writes precompressed
+.gz/.br siblings of the compressible ones and static/dist/manifest.json. Run it after any change to static/,
+including after build_thumbnails.py, then restart the app: it resolves asset URLs through the manifest at startup.
+
+Usage:
+    python build_static_assets.py
+"""
+import os
+import time
+
+from static_assets import build_asset_manifest
+
+
+static_directory = './static'
+output_directory = './static/dist'
+
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    manifest = build_asset_manifest(static_directory, output_directory)
+
+    n_bytes = 0
+    n_compressed = 0
+    for directory, _, file_names in os.walk(output_directory):
+        for file_name in file_names:
+            n_bytes += os.path.getsize(os.path.join(directory, file_name))
+            n_compressed += file_name.endswith(('.gz', '.br'))
+
+    print(f'{len(manifest["assets"])} assets fingerprinted into {output_directory} '
+          f'({n_compressed} precompressed variants, {n_bytes / 1024**2:.1f}MB) in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,147 @@
+"""
+Offline thumbnail and sprite-atlas pipeline for the font preview images.
+
+static/all_font_images holds one 400x400 *_Aa.png per font (~18MB), while a /graph view draws up to 200 of them
+as small circular nodes. For every requested size this writes:
+    - a thumbnail per font:        static/thumbnails/{size}/{label}_Aa.{webp,png}
+    - sprite atlases of all fonts: static/thumbnails/{size}/atlas_{n}.{webp,png}, a grid of size x size cells
+    - static/thumbnails/manifest.json, with the cell of every font in its atlas and the path of every thumbnail
+
+GraphManager.load_image_manifest then makes /graph emit atlas references ('atlas.webp#xywh=x,y,w,h') or
+thumbnail paths instead of full-size image paths, and reports how many bytes and requests a graph render saves.
+
+Requires Pillow (with WebP support for the .webp outputs).
+
+Usage:
+    python build_thumbnails.py
+    python build_thumbnails.py --sizes 32 64 128 --formats webp png --atlas-columns 16
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+image_folder_path = './static/all_font_images'
+output_folder_path = './static/thumbnails'
+neighbour_table_path = './data/embeddings/all_font_neighbours.npz'
+image_suffix = '_Aa.png'
+
+
+def save_image(image, file_path, image_format):
+    if image_format == 'webp':
+        image.save(file_path, 'WEBP', quality=80, method=6)
+    else:
+        image.save(file_path, 'PNG', optimize=True)
+
+
+def fit_to_cell(image, size):
+    """Scale 'image' to fit a size x size cell, centred on a white background like the originals."""
+    thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((size, size), Image.LANCZOS)
+    cell = Image.new('RGB', (size, size), (255, 255, 255))
+    cell.paste(thumbnail, ((size - thumbnail.width) // 2, (size - thumbnail.height) // 2))
+    return cell
+
+
+def build(font_labels, sizes, image_formats, atlas_columns):
+    manifest = {'version': 1, 'sizes': {}}
+    fonts_per_atlas = atlas_columns * atlas_columns
+
+    for size in sizes:
+        size_folder_path = os.path.join(output_folder_path, str(size))
+        os.makedirs(size_folder_path, exist_ok=True)
+
+        size_manifest = {'cell': size, 'fonts': {}, 'formats': {image_format: {'atlases': [], 'thumbnails': {}} for image_format in image_formats}}
+        atlases = []
+
+        for position, font_label in enumerate(font_labels):
+            with Image.open(os.path.join(image_folder_path, f'{font_label}{image_suffix}')) as image:
+                cell = fit_to_cell(image, size)
+
+            for image_format in image_formats:
+                thumbnail_name = f'{size}/{font_label}_Aa.{image_format}'
+                save_image(cell, os.path.join(output_folder_path, thumbnail_name), image_format)
+                size_manifest['formats'][image_format]['thumbnails'][font_label] = thumbnail_name
+
+            atlas_number, slot = divmod(position, fonts_per_atlas)
+            if atlas_number == len(atlases):
+                n_fonts_in_atlas = min(fonts_per_atlas, len(font_labels) - position)
+                n_rows = -(-n_fonts_in_atlas // atlas_columns)
+                atlases.append(Image.new('RGB', (atlas_columns * size, n_rows * size), (255, 255, 255)))
+            x, y = (slot % atlas_columns) * size, (slot // atlas_columns) * size
+            atlases[atlas_number].paste(cell, (x, y))
+            size_manifest['fonts'][font_label] = [atlas_number, x, y]
+
+        for atlas_number, atlas in enumerate(atlases):
+            for image_format in image_formats:
+                atlas_name = f'{size}/atlas_{atlas_number}.{image_format}'
+                save_image(atlas, os.path.join(output_folder_path, atlas_name), image_format)
+                size_manifest['formats'][image_format]['atlases'].append(atlas_name)
+
+        manifest['sizes'][str(size)] = size_manifest
+
+    with open(os.path.join(output_folder_path, 'manifest.json'), 'w') as handle:
+        json.dump(manifest, handle)
+    return manifest
+
+
+def report(manifest, font_labels, graphs):
+    """Mean bytes and requests per graph render: full-size images vs per-font thumbnails vs atlases."""
+    def file_size(file_path):
+        return os.path.getsize(file_path)
+
+    full_sizes = {font_label: file_size(os.path.join(image_folder_path, f'{font_label}{image_suffix}')) for font_label in font_labels}
+    full_bytes = np.mean([sum(full_sizes[font_labels[i]] for i in graph) for graph in graphs])
+    print(f'{len(graphs)} graphs of {len(graphs[0])} nodes, mean per render')
+    print(f'    full-size png:           {len(graphs[0]):4d} requests  {full_bytes / 1024:8.1f}KB')
+
+    for size, size_manifest in manifest['sizes'].items():
+        for image_format, format_manifest in size_manifest['formats'].items():
+            thumbnails = format_manifest['thumbnails']
+            thumbnail_bytes = np.mean([sum(file_size(os.path.join(output_folder_path, thumbnails[font_labels[i]])) for i in graph) for graph in graphs])
+
+            atlas_paths = format_manifest['atlases']
+            atlas_numbers = [{size_manifest['fonts'][font_labels[i]][0] for i in graph} for graph in graphs]
+            atlas_requests = np.mean([len(numbers) for numbers in atlas_numbers])
+            atlas_bytes = np.mean([sum(file_size(os.path.join(output_folder_path, atlas_paths[n])) for n in numbers) for numbers in atlas_numbers])
+
+            print(f'    {size:>3}px {image_format:<4} thumbnails:  {len(graphs[0]):4d} requests  {thumbnail_bytes / 1024:8.1f}KB')
+            print(f'    {size:>3}px {image_format:<4} atlases:     {atlas_requests:4.1f} requests  {atlas_bytes / 1024:8.1f}KB')
+
+    print('Atlases cover the whole catalog: the browser fetches each one once, and every later render reuses them.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--formats', nargs='+', default=['webp', 'png'], choices=['webp', 'png'])
+    parser.add_argument('--atlas-columns', type=int, default=16)
+    args = parser.parse_args()
+
+    assert Image is not None, 'build_thumbnails.py needs Pillow: pip install Pillow'
+
+    font_labels = sorted(file_name[:-len(image_suffix)] for file_name in os.listdir(image_folder_path) if file_name.endswith(image_suffix))
+
+    start = time.perf_counter()
+    manifest = build(font_labels, args.sizes, args.formats, args.atlas_columns)
+    print(f'Thumbnails and atlases of {len(font_labels)} fonts written to {output_folder_path} in {time.perf_counter() - start:.1f}s')
+
+    # Measure on the real /graph neighbourhoods when the neighbour table exists, random ones otherwise
+    if os.path.exists(neighbour_table_path):
+        from utils import load_data_dict
+        from vector_database import NeighbourTable
+        dict_font_labels_to_indices = load_data_dict('./data/embeddings/font_name_to_index.pickle')
+        position_of_index = {dict_font_labels_to_indices[label]: position for position, label in enumerate(font_labels) if label in dict_font_labels_to_indices}
+        graphs = [[position_of_index[i] for i in row if i in position_of_index] for row in NeighbourTable.load(neighbour_table_path).table]
+    else:
+        rng = np.random.default_rng(42)
+        graphs = [rng.choice(len(font_labels), size=min(200, len(font_labels)), replace=False) for _ in range(100)]
+    report(manifest, font_labels, graphs)
@@ -0,0 +1,201 @@
+import os
+import gc
+import json
+import time
+import weakref
+import threading
+import contextlib
+import contextvars
+
+
+"""
+Versioned snapshots of the font catalog, swapped atomically for zero-downtime reloads.
+
+Everything derived from one version of the catalog (embeddings, label maps, vector database, neighbour and
+layout tables, graph manager, /fonts payload) is built into one CatalogSnapshot. Requests read
+SnapshotManager.current once, when they start, and use that snapshot to the end, so a reload never mixes two
+catalogs within a request. Code that derives something else from the snapshot before the endpoint runs (e.g. the
+response cache key) pins it with SnapshotManager.pinned(), so that 'current' returns that same snapshot for the
+rest of the request. A reload builds the next snapshot in a background thread while the current one keeps
+serving, then swaps it in with a single attribute assignment. In-flight requests finish on the previous
+snapshot, which is freed once the last of them drops its reference.
+
+The catalog files are replaced by rename (see font_catalog.py and build_indexes.py), so the memory maps of the
+previous snapshot stay valid while it drains.
+
+With several gunicorn workers, a reload requested from one worker is also announced in a small request file,
+which every worker polls and follows (see SnapshotManager.watch).
+"""
+
+
+class CatalogSnapshot:
+    """
+    One immutable version of everything the endpoints read from the catalog.
+
+    Parameters:
+    version (str): Catalog version, as recorded in the catalog file.
+    font_catalog: The FontCatalog (or SharedFontStore catalog) the snapshot was built from.
+    font_vector_db: Vector database over the catalog embeddings.
+    font_neighbour_table (NeighbourTable): Precomputed neighbours, or None if missing or stale.
+    font_layout_table (LayoutTable): Precomputed graph layouts, or None if missing or stale.
+    graph_manager (GraphManager): Converts graphs of this catalog into vis.js nodes.
+    fonts_payload (PrecompressedPayload): The /fonts response of this catalog.
+    """
+    def __init__(self, version, font_catalog, font_vector_db, font_neighbour_table, font_layout_table, graph_manager, fonts_payload):
+        self.version = version
+        self.font_catalog = font_catalog
+        self.font_embeddings_array = font_catalog.font_embeddings_array
+        self.dict_font_labels_to_indices = font_catalog.dict_font_labels_to_indices
+        self.dict_font_indices_to_labels = font_catalog.dict_font_indices_to_labels
+        self.font_vector_db = font_vector_db
+        self.font_neighbour_table = font_neighbour_table
+        self.font_layout_table = font_layout_table
+        self.graph_manager = graph_manager
+        self.fonts_payload = fonts_payload
+
+
+def resident_memory():
+    import psutil
+
+    return psutil.Process().memory_info().rss
+
+
+class SnapshotManager:
+    """
+    Holds the current CatalogSnapshot and reloads it in the background.
+
+    Parameters:
+    build (callable): Builds and returns a new CatalogSnapshot from the catalog files on disk.
+    on_swap (callable): Called with the new snapshot right after it becomes current (e.g. to move cache
+        namespaces to the new catalog version).
+    request_file (str): JSON file through which workers announce reloads to each other. None keeps reloads local.
+    poll_interval (float): Seconds between two checks of 'request_file' by watch().
+    """
+    def __init__(self, build, on_swap=None, request_file=None, poll_interval=5.0):
+        self.build = build
+        self.on_swap = on_swap
+        self.request_file = request_file
+        self.poll_interval = poll_interval
+
+        self.latest = None
+        # Snapshot pinned by the running request; every asyncio task (so every request) has its own value
+        self._pinned = contextvars.ContextVar(f'pinned_snapshot_{id(self)}', default=None)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.watcher = None
+        self.generation = self.requested_generation()
+        self.previous = None     # weak reference to the snapshot replaced by the last reload
+        self.last_reload = None
+
+    @property
+    def current(self):
+        """The snapshot pinned by the running request (see pinned), otherwise the latest one."""
+        return self._pinned.get() or self.latest
+
+    @contextlib.contextmanager
+    def pinned(self):
+        """Make 'current' return the same snapshot until the block exits, even if a reload swaps in a new one."""
+        snapshot = self.current
+        token = self._pinned.set(snapshot)
+        try:
+            yield snapshot
+        finally:
+            self._pinned.reset(token)
+
+    def load(self):
+        """Build the first snapshot, in the calling thread."""
+        self.latest = self.build()
+        if self.on_swap is not None:
+            self.on_swap(self.latest)
+        return self.latest
+
+    #====================================
+    # Reloading
+    #====================================
+    def reload(self, generation=None):
+        """Start building the next snapshot in a background thread. Returns False if a reload is already running."""
+        with self.lock:
+            if self.thread is not None:
+                return False
+            if generation is not None:
+                self.generation = max(self.generation, generation)
+            self.last_reload = {'status': 'building', 'pid': os.getpid(), 'started': time.time(),
+                                'previous_version': self.latest.version if self.latest is not None else None}
+            self.thread = threading.Thread(target=self.run, name='catalog-reload', daemon=True)
+            self.thread.start()
+            return True
+
+    def run(self):
+        status = self.last_reload
+        try:
+            rss_before = resident_memory()
+            start = time.perf_counter()
+            snapshot = self.build()
+            status['build_seconds'] = time.perf_counter() - start
+            # Both snapshots are resident from here until the previous one has drained
+            status['rss_before_bytes'] = rss_before
+            status['rss_overlap_bytes'] = resident_memory()
+
+            previous = self.latest
+            self.latest = snapshot
+            if self.on_swap is not None:
+                self.on_swap(snapshot)
+            status.update({'status': 'swapped', 'version': snapshot.version, 'swapped': time.time()})
+
+            self.previous = weakref.ref(previous) if previous is not None else None
+            del previous, snapshot
+            gc.collect()
+            status['rss_after_swap_bytes'] = resident_memory()
+        except Exception as error:
+            status.update({'status': 'failed', 'error': f'{type(error).__name__}: {error}'})
+        finally:
+            status['finished'] = time.time()
+            with self.lock:
+                self.thread = None
+
+    def status(self):
+        """The current version and the outcome of the last reload of this worker."""
+        previous = self.previous() if self.previous is not None else None
+        last_reload = dict(self.last_reload) if self.last_reload is not None else None
+        if last_reload is not None and 'rss_before_bytes' in last_reload:
+            last_reload['rss_overlap_delta_bytes'] = last_reload['rss_overlap_bytes'] - last_reload['rss_before_bytes']
+        return {'pid': os.getpid(), 'version': self.latest.version if self.latest is not None else None,
+                'generation': self.generation, 'reloading': self.thread is not None,
+                'previous_snapshot_released': previous is None, 'last_reload': last_reload}
+
+    #====================================
+    # Reloads across workers
+    #====================================
+    def requested_generation(self):
+        if self.request_file is None:
+            return 0
+        try:
+            with open(self.request_file) as handle:
+                return json.load(handle)['generation']
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def request_reload(self):
+        """Reload this worker now, and announce the reload to the other workers through the request file."""
+        generation = max(self.generation, self.requested_generation()) + 1
+        if self.request_file is not None:
+            os.makedirs(os.path.dirname(self.request_file) or '.', exist_ok=True)
+            with open(f'{self.request_file}.{os.getpid()}.tmp', 'w') as handle:
+                json.dump({'generation': generation, 'requested': time.time(), 'pid': os.getpid()}, handle)
+            os.replace(f'{self.request_file}.{os.getpid()}.tmp', self.request_file)
+        return self.reload(generation)
+
+    def watch(self):
+        """Start the thread following reloads requested by other workers. Call it in each worker, after forking."""
+        if self.request_file is None or self.watcher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.poll_interval)
+                generation = self.requested_generation()
+                if generation > self.generation:
+                    self.reload(generation)
+
+        self.watcher = threading.Thread(target=run, name='catalog-reload-watcher', daemon=True)
+        self.watcher.start()
@@ -1,15 +1,10 @@
 
 # import necessary libraries
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
-
-import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from kneed import KneeLocator
-
 import numpy as np
 
+# scikit-learn, matplotlib and kneed are imported by the functions that use them, so importing this module
+# stays cheap for the web app: with precomputed layouts (see graph_layouts.py) it may never reduce anything
+
 
 
 # Function for dimensionality reduction using Principal Component Analysis (PCA)
@@ -30,6 +25,8 @@ def reduce_with_pca(data, n_components):
     The reduced data can be used for further analysis or visualization, 
     and the PCA object can be used to transform additional data or to perform an inverse transform.
     """
+    from sklearn.decomposition import PCA
+
     pca = PCA(n_components=n_components)
     reduced_data = pca.fit_transform(data)
     return reduced_data, pca
@@ -79,6 +76,8 @@ def reduce_with_tsne(data, n_components, perplexity= 20, random_state=42):
     The t-SNE object can't be used to transform additional data or perform an inverse transform as 
     t-SNE doesn't support these operations.
     """
+    from sklearn.manifold import TSNE
+
     tsne = TSNE(n_components=n_components, perplexity=perplexity, random_state=random_state)
     reduced_data = tsne.fit_transform(data)
     return reduced_data, tsne
@@ -93,6 +92,8 @@ def plot_2d(data, labels, title):
     labels (numpy.ndarray): The label for each sample in the data. Used to color the points.
     title (str): The title for the plot.
     """
+    import matplotlib.pyplot as plt
+
     plt.scatter(data[:, 0], data[:, 1], c=labels, cmap='viridis')
     plt.title(title)
     plt.show()
@@ -110,6 +111,8 @@ def plot_data_with_kmeans(data, n_components, method='pca', random_state=42):
     method (str, optional): The dimensionality reduction method to use. Can be 'pca' or 'tsne'. Defaults to 'pca'.
     random_state (int, optional): The seed for the random number generator. Defaults to 42.
     """
+    from sklearn.cluster import KMeans
+    from kneed import KneeLocator
 
     # Reduce data
     if method == 'pca':
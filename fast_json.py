@@ -0,0 +1,38 @@
+import json
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:     # optional dependency: fall back to the stdlib encoder
+    orjson = None
+
+
+"""
+Fast JSON encoding for responses that are already plain JSON data (or NumPy arrays).
+
+Returning a FastJSONResponse from an endpoint skips FastAPI's response_model re-validation and
+jsonable_encoder pass. The bytes are produced by orjson when it is installed, which also serializes
+NumPy arrays natively, and by the stdlib json module (with NumPy arrays converted to lists) otherwise.
+"""
+
+
+def _default(value):
+    # Only reached with the stdlib encoder, for NumPy arrays and scalars
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(content):
+    """Serialize 'content' to compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, separators=(',', ':'), default=_default).encode('utf-8')
+
+
+class FastJSONResponse(Response):
+    media_type = 'application/json'
+
+    def render(self, content):
+        return dumps(content)
@@ -0,0 +1,213 @@
+import os
+import mmap
+import struct
+import hashlib
+from collections.abc import Mapping
+
+import numpy as np
+
+
+"""
+Single-file, memory-mapped binary font catalog.
+
+Replaces the npz embeddings archive plus the pickled font_name_to_index dictionary (and the three places that
+inverted it by hand). The file is opened with mmap and never unpickled, so it loads in microseconds, and its
+pages stay shared between gunicorn workers because reading it does not touch any Python refcounts.
+
+Layout (little-endian, every section aligned to 64 bytes):
+    header          magic, format, n_fonts, dimensions, hash table size, section offsets, catalog version
+    embeddings      float32 [n_fonts, dimensions]
+    label offsets   uint32 [n_fonts + 1], label i is label_blob[offsets[i]:offsets[i + 1]]
+    label blob      UTF-8 bytes of every label, concatenated in index order
+    hash table      int32 [hash table size], open addressing with linear probing, -1 marks an empty slot
+
+index -> label is two offset reads and a slice; label -> index hashes the label and probes the table.
+
+Usage (converter):
+    python font_catalog.py
+    python font_catalog.py --embeddings ./data/embeddings/all_font_embeddings.npz \\
+        --dictionary ./data/embeddings/font_name_to_index.pickle --output ./data/embeddings/all_fonts.fontcat
+"""
+
+catalog_magic = b'FONTCAT\x00'
+catalog_format = 1
+header_struct = struct.Struct('<8sIIIIQQQQQ16s')
+section_alignment = 64
+
+
+def label_hash(encoded_label):
+    """Stable 64-bit hash of a UTF-8 label (Python's own str hash is randomised per process)."""
+    return int.from_bytes(hashlib.blake2b(encoded_label, digest_size=8).digest(), 'little')
+
+
+def align(offset):
+    return -(-offset // section_alignment) * section_alignment
+
+
+class IndexToLabelView(Mapping):
+    """Read-only {font index: label} mapping over the catalog's label offsets and blob."""
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __getitem__(self, index):
+        label = self.catalog.label(index) if isinstance(index, (int, np.integer)) else None
+        if not label:
+            raise KeyError(index)
+        return label
+
+    def __iter__(self):
+        label_offsets = self.catalog._label_offsets
+        for index in range(self.catalog.n_fonts):
+            if label_offsets[index + 1] > label_offsets[index]:
+                yield index
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.catalog.label_offsets)))
+
+
+class LabelToIndexView(Mapping):
+    """Read-only {label: font index} mapping answered from the catalog's hash table."""
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __getitem__(self, label):
+        index = self.catalog.index(label) if isinstance(label, str) else None
+        if index is None:
+            raise KeyError(label)
+        return index
+
+    def __iter__(self):
+        # Catalog (index) order, the same order the original pickled dictionary was built in
+        for index in self.catalog.dict_font_indices_to_labels:
+            yield self.catalog.label(index)
+
+    def __len__(self):
+        return len(self.catalog.dict_font_indices_to_labels)
+
+
+class FontCatalog:
+    """
+    A font catalog file opened with mmap. Exposes the same three objects main.py used to load separately:
+    font_embeddings_array (read-only), dict_font_labels_to_indices and dict_font_indices_to_labels
+    (read-only Mapping views), plus the catalog 'version' fingerprint recorded when the file was written.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as handle:
+            self.buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, file_format, self.n_fonts, self.dimensions, self.hash_table_size, embeddings_offset,
+         label_offsets_offset, label_blob_offset, label_blob_size, hash_table_offset, version) = header_struct.unpack_from(self.buffer, 0)
+        assert magic == catalog_magic, f"{file_path} is not a font catalog."
+        assert file_format == catalog_format, f"{file_path} has catalog format {file_format}, expected {catalog_format}."
+        self.version = version.decode('ascii')
+
+        self.font_embeddings_array = np.frombuffer(self.buffer, dtype='<f4', count=self.n_fonts * self.dimensions,
+                                                   offset=embeddings_offset).reshape(self.n_fonts, self.dimensions)
+        self.label_offsets = np.frombuffer(self.buffer, dtype='<u4', count=self.n_fonts + 1, offset=label_offsets_offset)
+        self.label_blob_offset = label_blob_offset
+        self.hash_table = np.frombuffer(self.buffer, dtype='<i4', count=self.hash_table_size, offset=hash_table_offset)
+
+        # memoryview casts give the lookups plain Python ints, which is several times faster than numpy scalar indexing
+        self._label_offsets = memoryview(self.buffer)[label_offsets_offset:label_offsets_offset + 4 * (self.n_fonts + 1)].cast('I')
+        self._hash_table = memoryview(self.buffer)[hash_table_offset:hash_table_offset + 4 * self.hash_table_size].cast('i')
+
+        self.dict_font_indices_to_labels = IndexToLabelView(self)
+        self.dict_font_labels_to_indices = LabelToIndexView(self)
+
+    @classmethod
+    def open(cls, file_path):
+        return cls(file_path)
+
+    def _encoded_label(self, index):
+        return self.buffer[self.label_blob_offset + self._label_offsets[index]:self.label_blob_offset + self._label_offsets[index + 1]]
+
+    def label(self, index):
+        """Label of font 'index', or None if there is no such font. O(1)."""
+        if not 0 <= index < self.n_fonts:
+            return None
+        return self._encoded_label(index).decode('utf-8') or None
+
+    def index(self, label):
+        """Index of the font called 'label', or None if there is none. O(1) expected, via the hash table."""
+        encoded_label = label.encode('utf-8')
+        mask = self.hash_table_size - 1
+        slot = label_hash(encoded_label) & mask
+        while True:
+            index = self._hash_table[slot]
+            if index == -1:
+                return None
+            if self._encoded_label(index) == encoded_label:
+                return index
+            slot = (slot + 1) & mask
+
+    @staticmethod
+    def write(file_path, font_embeddings_array, dict_font_labels_to_indices, version):
+        """Write a catalog file. Written under a temporary name and renamed, so readers never see a partial file."""
+        font_embeddings_array = np.ascontiguousarray(font_embeddings_array, dtype='<f4')
+        n_fonts, dimensions = font_embeddings_array.shape
+
+        encoded_labels = [b''] * n_fonts
+        for label, index in dict_font_labels_to_indices.items():
+            if index < n_fonts:
+                encoded_labels[index] = label.encode('utf-8')
+        label_offsets = np.zeros(n_fonts + 1, dtype='<u4')
+        label_offsets[1:] = np.cumsum([len(encoded_label) for encoded_label in encoded_labels])
+        label_blob = b''.join(encoded_labels)
+
+        # Keep the table at most half full, so probe sequences stay short
+        hash_table_size = 8
+        while hash_table_size < 2 * n_fonts:
+            hash_table_size *= 2
+        hash_table = np.full(hash_table_size, -1, dtype='<i4')
+        for index, encoded_label in enumerate(encoded_labels):
+            if not encoded_label:
+                continue
+            slot = label_hash(encoded_label) & (hash_table_size - 1)
+            while hash_table[slot] != -1:
+                slot = (slot + 1) & (hash_table_size - 1)
+            hash_table[slot] = index
+
+        embeddings_offset = align(header_struct.size)
+        label_offsets_offset = align(embeddings_offset + font_embeddings_array.nbytes)
+        label_blob_offset = align(label_offsets_offset + label_offsets.nbytes)
+        hash_table_offset = align(label_blob_offset + len(label_blob))
+
+        header = header_struct.pack(catalog_magic, catalog_format, n_fonts, dimensions, hash_table_size, embeddings_offset,
+                                    label_offsets_offset, label_blob_offset, len(label_blob), hash_table_offset,
+                                    version.encode('ascii').ljust(16, b'\x00'))
+
+        temporary_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as handle:
+            for offset, section in [(0, header), (embeddings_offset, font_embeddings_array.tobytes()),
+                                    (label_offsets_offset, label_offsets.tobytes()), (label_blob_offset, label_blob),
+                                    (hash_table_offset, hash_table.tobytes())]:
+                handle.write(b'\x00' * (offset - handle.tell()))
+                handle.write(section)
+        os.replace(temporary_path, file_path)
+
+
+def convert_font_catalog(font_embeddings_path, dictionary_path, output_path):
+    """Convert the npz embeddings archive and pickled font_name_to_index dictionary into a single catalog file."""
+    from utils import load_data_dict, load_npz
+    from vector_database import catalog_version
+
+    font_embeddings_array = load_npz(file_path= font_embeddings_path)
+    dict_font_labels_to_indices = load_data_dict(dictionary_path)
+
+    version = catalog_version(font_embeddings_array, dict_font_labels_to_indices)
+    FontCatalog.write(output_path, font_embeddings_array, dict_font_labels_to_indices, version)
+    return version
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert the npz + pickle font catalog into a single catalog file.')
+    parser.add_argument('--embeddings', default='./data/embeddings/all_font_embeddings.npz')
+    parser.add_argument('--dictionary', default='./data/embeddings/font_name_to_index.pickle')
+    parser.add_argument('--output', default='./data/embeddings/all_fonts.fontcat')
+    args = parser.parse_args()
+
+    version = convert_font_catalog(args.embeddings, args.dictionary, args.output)
+    print(f'Wrote {args.output} (catalog version {version}, {os.path.getsize(args.output) / 1024:.0f}KB)')
@@ -0,0 +1,64 @@
+import numpy as np
+
+
+"""
+Precomputed 2D layouts of every font's /graph neighbourhood.
+
+The candidate set of a /graph request only depends on the chosen font, so the layout of every
+neighbourhood can be computed ahead of time (see build_layouts.py) and /graph only has to slice it,
+which keeps sklearn (and the seconds-long t-SNE fits) out of the request path.
+"""
+
+
+class LayoutTable:
+    """
+    For every font i: 'candidates[i]' are the item ids of its k neighbours (the nodes of its graph), and
+    'layouts[method][i]' the (k, 2) coordinates of those nodes, stored as float16 to keep the file compact.
+    Only valid for the metric and catalog version it was built with.
+    """
+    def __init__(self, candidates, layouts, metric, version):
+        self.candidates = candidates
+        self.layouts = layouts
+        self.metric = metric
+        self.version = version
+        self.k = candidates.shape[1]
+
+    @classmethod
+    def build(cls, vectors, neighbour_table, methods=['pca'], progress=None):
+        """
+        Lay out the neighbourhood of every font in 'neighbour_table' (a vector_database.NeighbourTable) with the
+        same reduce_with_* functions /graph uses live, so precomputed and live layouts are identical.
+        """
+        from dimensionality_reduction import reduce_with_pca, reduce_with_tsne
+        reducers = {'pca': reduce_with_pca, 'tsne': reduce_with_tsne}
+
+        candidates = neighbour_table.table
+        layouts = {}
+        for method in methods:
+            coordinates = np.empty((*candidates.shape, 2), dtype=np.float16)
+            for font_index, font_candidates in enumerate(candidates):
+                reduced_data, _ = reducers[method](data= vectors[font_candidates, :], n_components= 2)
+                coordinates[font_index] = reduced_data
+                if progress is not None:
+                    progress(method, font_index)
+            layouts[method] = coordinates
+
+        return cls(candidates, layouts, neighbour_table.metric, neighbour_table.version)
+
+    def save(self, file_path):
+        arrays = {f'layout_{method}': coordinates for method, coordinates in self.layouts.items()}
+        np.savez(file_path, candidates=self.candidates, metric=self.metric, version=self.version, **arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            layouts = {name[len('layout_'):]: data[name] for name in data.files if name.startswith('layout_')}
+            return cls(data['candidates'], layouts, str(data['metric']), str(data['version']))
+
+    def covers(self, method, metric, k, version):
+        """Whether this table holds the 'method' layout of 'k'-node graphs for 'metric' on the catalog 'version'."""
+        return method in self.layouts and metric == self.metric and k == self.k and version == self.version
+
+    def layout(self, font_index, method):
+        """Return the candidate item ids and their (k, 2) float32 coordinates for the graph of 'font_index'."""
+        return self.candidates[font_index].tolist(), self.layouts[method][font_index].astype(np.float32)
@@ -0,0 +1,26 @@
+# Gunicorn picks this file up automatically from the working directory (see Procfile)
+import os
+
+from shared_store import SharedFontStore, memory_report
+
+
+font_catalog_path = './data/embeddings/all_fonts.fontcat'
+font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
+dictionary_path = './data/embeddings/font_name_to_index.pickle'
+font_store_directory = './data/store'
+
+
+def on_starting(server):
+    """
+    Populate the shared font store once, in the master, before any worker is forked.
+    Not needed when a ready-made catalog file is deployed, as workers then map that file directly.
+    """
+    if os.path.exists(font_catalog_path):
+        return
+    if not SharedFontStore.is_current(font_store_directory, font_embeddings_path, dictionary_path):
+        SharedFontStore.populate(font_store_directory, font_embeddings_path, dictionary_path)
+
+
+def post_worker_init(worker):
+    """Log how much of the worker's resident memory is unique to it and how much is shared."""
+    worker.log.info(memory_report(worker.pid, worker.ppid))
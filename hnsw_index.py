@@ -0,0 +1,332 @@
+import heapq
+
+import numpy as np
+
+from index_file import write_index_file, map_index_file
+
+
+"""
+Hierarchical Navigable Small World graph index (Malkov & Yashunin, 2016) in NumPy, as an alternative index
+engine for MultiMetricDatabase.
+
+It has the subset of AnnoyIndex's interface that MultiMetricDatabase uses (add_item, build, save, load, unload,
+get_n_items, get_nns_by_vector with search_k and include_distances), and returns distances on Annoy's scale for
+every metric, so the two engines are interchangeable behind the database.
+
+Every item lives on layer 0, linked to at most 2 * M neighbours; a geometrically decreasing fraction of them
+also lives on the upper layers, linked to at most M. A query descends greedily through the upper layers and
+then runs a best-first search on layer 0, keeping the 'ef' closest items seen: a larger ef means better recall
+and slower queries. Neighbours are chosen with the paper's diversity heuristic, which keeps the graph navigable
+on clustered data.
+
+Saved indexes are a single file whose arrays (vectors and links) are memory-mapped on load, like Annoy's, so
+gunicorn workers loading the same file share its pages (see index_file.py).
+"""
+
+hnsw_magic = b'HNSW'
+hnsw_format = 1
+
+
+class HNSWIndex:
+    """
+    Parameters:
+    f (int): Dimensions of the vectors (named like AnnoyIndex's argument).
+    metric (str): 'euclidean', 'angular', 'manhattan', 'hamming' or 'dot', with Annoy's semantics.
+    M (int): Links per item on the upper layers, twice that on layer 0. More links mean better recall, more memory.
+    ef_construction (int): Candidates considered when linking a new item. Higher builds slower and better graphs.
+    ef (int): Default number of candidates kept by a query. get_nns_by_vector's search_k overrides it.
+    seed (int): Seed of the random layer assignment.
+    """
+    file_extension = 'hnsw'
+    query_options = ['ef']     # constructor options that do not change the graph
+    supported_metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+
+    def __init__(self, f, metric, M=16, ef_construction=64, ef=64, seed=42):
+        assert metric in self.supported_metrics, f"Metric '{metric}' is not supported."
+        self.dimensions = f
+        self.metric = metric
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.seed = seed
+
+        self.items = {}     # item id -> vector, until build()
+        self.built = False
+        self.unload()
+
+    #====================================
+    # Distances
+    #====================================
+    def _encode(self, vectors):
+        """Vectors as stored: unit length for angular, bits for hamming, as given otherwise."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.metric == 'angular':
+            norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+            return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        if self.metric == 'hamming':
+            return (vectors > 0.5).astype(np.float32)
+        return vectors
+
+    def _distances(self, query, vectors):
+        """Internal distances, smaller is closer: squared L2, 1 - cosine, L1, differing bits, or -inner product."""
+        if self.metric == 'euclidean':
+            difference = vectors - query
+            return np.einsum('...d,...d->...', difference, difference)
+        if self.metric == 'angular':
+            return 1.0 - vectors @ query
+        if self.metric == 'dot':
+            return -(vectors @ query)
+        return np.abs(vectors - query).sum(axis=-1)     # manhattan, and hamming on 0/1 vectors
+
+    def _pairwise_distances(self, vectors):
+        """Internal distances between every pair of 'vectors', as a (n, n) matrix."""
+        if self.metric == 'euclidean':
+            squared_norms = np.einsum('ij,ij->i', vectors, vectors)
+            return squared_norms[:, None] + squared_norms[None, :] - 2.0 * (vectors @ vectors.T)
+        if self.metric == 'angular':
+            return 1.0 - vectors @ vectors.T
+        if self.metric == 'dot':
+            return -(vectors @ vectors.T)
+        return np.abs(vectors[:, None, :] - vectors[None, :, :]).sum(axis=2)
+
+    def _annoy_distances(self, distances):
+        """Internal distances converted to the values AnnoyIndex.get_nns_by_vector(include_distances=True) returns."""
+        if self.metric == 'euclidean':
+            return np.sqrt(np.maximum(distances, 0.0))
+        if self.metric == 'angular':
+            return np.sqrt(np.maximum(2.0 * distances, 0.0))
+        if self.metric == 'dot':
+            return -distances
+        return distances
+
+    #====================================
+    # Construction
+    #====================================
+    def add_item(self, i, vector):
+        assert not self.built, "Items cannot be added after build()."
+        self.items[int(i)] = np.asarray(vector, dtype=np.float32).reshape(self.dimensions)
+
+    def build(self, n_trees=None, n_jobs=-1):
+        """Link every added item into the graph. n_trees and n_jobs are accepted for AnnoyIndex compatibility."""
+        self.ids = np.array(sorted(self.items), dtype=np.int64)
+        n = len(self.ids)
+        self.vectors = self._encode(np.stack([self.items[i] for i in self.ids])) if n else np.empty((0, self.dimensions), dtype=np.float32)
+        self.items = {}
+
+        rng = np.random.default_rng(self.seed)
+        level_multiplier = 1.0 / np.log(max(self.M, 2))
+        self.levels = np.floor(-np.log(1.0 - rng.random(n)) * level_multiplier).astype(np.int8)
+
+        self.links0 = np.full((n, 2 * self.M), -1, dtype=np.int32)
+        self.counts0 = np.zeros(n, dtype=np.int32)
+        self.upper = [dict() for _ in range(int(self.levels.max()) if n else 0)]     # layer l >= 1 -> {node: links}
+        self.entry_point = -1
+        self.max_level = -1
+
+        visited = np.zeros(n, dtype=bool)
+        for node in range(n):
+            self._insert(node, visited)
+        self.built = True
+
+    def _neighbours(self, node, level):
+        if level == 0:
+            return self.links0[node, :self.counts0[node]]
+        return self.upper[level - 1].get(node, np.empty(0, dtype=np.int32))
+
+    def _set_neighbours(self, node, level, links):
+        if level == 0:
+            self.links0[node, :len(links)] = links
+            self.links0[node, len(links):] = -1
+            self.counts0[node] = len(links)
+        else:
+            self.upper[level - 1][node] = np.asarray(links, dtype=np.int32)
+
+    def _search_layer(self, query, entry_points, ef, level, visited):
+        """
+        Best-first search of one layer: the 'ef' closest nodes found, as a list of (distance, node), closest first.
+        'visited' is an all-False boolean array over the nodes, used as scratch space and left all-False again.
+        """
+        entry_points = np.asarray(entry_points, dtype=np.int64)
+        visited[entry_points] = True
+        touched = [entry_points]
+
+        distances = self._distances(query, self.vectors[entry_points]).tolist()
+        candidates = list(zip(distances, entry_points.tolist()))
+        heapq.heapify(candidates)
+        results = [(-distance, node) for distance, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbours = self._neighbours(node, level)
+            neighbours = neighbours[~visited[neighbours]]
+            if not len(neighbours):
+                continue
+            visited[neighbours] = True
+            touched.append(neighbours)
+
+            bound = -results[0][0]
+            neighbour_distances = self._distances(query, self.vectors[neighbours])
+            if len(results) >= ef:
+                closer = neighbour_distances < bound
+                neighbours, neighbour_distances = neighbours[closer], neighbour_distances[closer]
+            for neighbour_distance, neighbour in zip(neighbour_distances.tolist(), neighbours.tolist()):
+                if len(results) < ef or neighbour_distance < bound:
+                    heapq.heappush(candidates, (neighbour_distance, neighbour))
+                    heapq.heappush(results, (-neighbour_distance, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+                    bound = -results[0][0]
+
+        for nodes in touched:
+            visited[nodes] = False
+        return sorted((-distance, node) for distance, node in results)
+
+    def _select_neighbours(self, candidates, M):
+        """
+        The paper's heuristic: walk the candidates closest first, and keep one only if it is closer to the base
+        than to every candidate kept so far. Slots left over are filled with the closest candidates skipped.
+        """
+        if len(candidates) <= M:
+            return [node for _, node in candidates]
+        nodes = np.array([node for _, node in candidates], dtype=np.int64)
+        pairwise = self._pairwise_distances(self.vectors[nodes]).tolist()
+
+        kept, skipped = [], []
+        for position, (distance, _) in enumerate(candidates):
+            row = pairwise[position]
+            if all(row[other] >= distance for other in kept):
+                kept.append(position)
+                if len(kept) == M:
+                    break
+            else:
+                skipped.append(position)
+        kept += skipped[:M - len(kept)]
+        return nodes[kept].tolist()
+
+    def _insert(self, node, visited):
+        query = self.vectors[node]
+        level = int(self.levels[node])
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+
+        entry_points = [self.entry_point]
+        for layer in range(self.max_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer, visited)[0][1]]
+
+        for layer in range(min(level, self.max_level), -1, -1):
+            candidates = self._search_layer(query, entry_points, self.ef_construction, layer, visited)
+            max_links = 2 * self.M if layer == 0 else self.M
+            neighbours = self._select_neighbours(candidates, self.M)
+            self._set_neighbours(node, layer, neighbours)
+
+            for neighbour in neighbours:
+                links = self._neighbours(neighbour, layer)
+                if len(links) < max_links:
+                    self._set_neighbours(neighbour, layer, np.append(links, node))
+                    continue
+                # Full: keep the neighbour's closest links among its current ones and the new node. The heuristic
+                # is only applied to a new node's own links, which is most of its benefit for a fraction of the cost
+                links = np.append(links, node)
+                distances = self._distances(self.vectors[neighbour], self.vectors[links])
+                self._set_neighbours(neighbour, layer, links[np.argpartition(distances, max_links - 1)[:max_links]])
+            entry_points = [candidate for _, candidate in candidates]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    #====================================
+    # Queries
+    #====================================
+    def get_n_items(self):
+        """Like AnnoyIndex: one more than the largest item id, counting the items added before build()."""
+        if not self.built:
+            return max(self.items) + 1 if self.items else 0
+        return int(self.ids[-1]) + 1 if len(self.ids) else 0
+
+    def get_item_vector(self, i):
+        """The stored vector of item 'i' (unit length for angular, 0/1 for hamming)."""
+        return self.vectors[np.searchsorted(self.ids, i)].tolist()
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        """
+        The 'n' nearest items of 'vector', closest first. 'search_k', when positive, is the ef of this query
+        (at least n); otherwise the index's default ef is used.
+        """
+        if self.entry_point < 0 or n <= 0:
+            return ([], []) if include_distances else []
+        query = self._encode(vector)
+        ef = max(n, search_k if search_k is not None and search_k > 0 else self.ef)
+        # Allocated per query, so concurrent queries from several threads do not share it
+        visited = np.zeros(len(self.ids), dtype=bool)
+
+        entry_points = [self.entry_point]
+        for layer in range(self.max_level, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer, visited)[0][1]]
+        results = self._search_layer(query, entry_points, ef, 0, visited)[:n]
+
+        ids = self.ids[[node for _, node in results]].tolist()
+        if not include_distances:
+            return ids
+        return ids, self._annoy_distances(np.array([distance for distance, _ in results], dtype=np.float64)).tolist()
+
+    def memory_bytes(self):
+        """Bytes of the vectors and links, whether in memory or memory-mapped."""
+        upper = sum(len(links) * 4 + 8 for layer in self.upper for links in layer.values())
+        return self.vectors.nbytes + self.ids.nbytes + self.levels.nbytes + self.links0.nbytes + self.counts0.nbytes + upper
+
+    #====================================
+    # Persistence
+    #====================================
+    def save(self, path):
+        """Write the index to a single memory-mappable file (see index_file.py)."""
+        rows = [(node, layer + 1, links) for layer, nodes in enumerate(self.upper) for node, links in sorted(nodes.items())]
+        upper_links = np.full((len(rows), self.M), -1, dtype=np.int32)
+        for row, (_, _, links) in enumerate(rows):
+            upper_links[row, :len(links)] = links
+        arrays = {
+            'ids': self.ids, 'levels': self.levels, 'vectors': self.vectors, 'links0': self.links0, 'counts0': self.counts0,
+            'upper_nodes': np.array([node for node, _, _ in rows], dtype=np.int32),
+            'upper_layers': np.array([layer for _, layer, _ in rows], dtype=np.int32),
+            'upper_counts': np.array([len(links) for _, _, links in rows], dtype=np.int32),
+            'upper_links': upper_links,
+        }
+        header = {'format': hnsw_format, 'metric': self.metric, 'dimensions': self.dimensions, 'M': self.M,
+                  'ef_construction': self.ef_construction, 'ef': self.ef, 'entry_point': self.entry_point,
+                  'max_level': self.max_level}
+        write_index_file(path, hnsw_magic, header, arrays)
+        return True
+
+    def load(self, path):
+        """Memory-map a saved index. Its build parameters replace the ones given to the constructor, ef is kept."""
+        self.buffer, header, arrays = map_index_file(path, hnsw_magic)
+        assert header['format'] == hnsw_format, f"{path} has HNSW format {header['format']}, expected {hnsw_format}."
+        assert header['metric'] == self.metric and header['dimensions'] == self.dimensions, f"{path} is an index of other vectors."
+
+        self.M, self.ef_construction = header['M'], header['ef_construction']
+        self.entry_point, self.max_level = header['entry_point'], header['max_level']
+        self.ids, self.levels, self.vectors = arrays['ids'], arrays['levels'], arrays['vectors']
+        self.links0, self.counts0 = arrays['links0'], arrays['counts0']
+        self.upper = [dict() for _ in range(max(self.max_level, 0))]
+        for node, layer, count, links in zip(arrays['upper_nodes'].tolist(), arrays['upper_layers'].tolist(),
+                                             arrays['upper_counts'].tolist(), arrays['upper_links']):
+            self.upper[layer - 1][node] = links[:count]
+        self.items = {}
+        self.built = True
+        return True
+
+    def unload(self):
+        """Drop the graph (and the memory map of a loaded index), leaving an empty index."""
+        self.ids = np.empty(0, dtype=np.int64)
+        self.levels = np.empty(0, dtype=np.int8)
+        self.vectors = np.empty((0, self.dimensions), dtype=np.float32)
+        self.links0 = np.empty((0, 2 * self.M), dtype=np.int32)
+        self.counts0 = np.empty(0, dtype=np.int32)
+        self.upper, self.entry_point, self.max_level = [], -1, -1
+        self.buffer = None
+        return True
@@ -0,0 +1,49 @@
+import json
+import mmap
+
+import numpy as np
+
+
+"""
+Single-file, memory-mappable storage of the NumPy index engines (hnsw_index.py, ivfpq_index.py).
+
+A file is a 4-byte magic, the length of a JSON header and the header itself, then every array at a 64-byte
+aligned offset recorded in the header. Reading it memory-maps the file and wraps the arrays with np.frombuffer,
+without copying, so gunicorn workers mapping the same file share its pages through the OS page cache, as they
+do with Annoy's files.
+"""
+
+header_size = 4096     # room reserved for the magic, the header length and the header
+
+
+def write_index_file(path, magic, header, arrays):
+    """
+    Write 'arrays' (name -> ndarray) and the JSON-serializable 'header' to 'path'.
+    The header read back has an extra 'arrays' entry: name -> [offset, dtype, shape].
+    """
+    header = dict(header, arrays={})
+    offset = header_size
+    for name, array in arrays.items():
+        header['arrays'][name] = [offset, array.dtype.str, list(array.shape)]
+        offset += -(-array.nbytes // 64) * 64
+    encoded_header = json.dumps(header).encode()
+    assert len(encoded_header) + 8 <= header_size, f"Header of {path} too large."
+
+    with open(path, 'wb') as handle:
+        handle.write(magic + len(encoded_header).to_bytes(4, 'little') + encoded_header)
+        for name, array in arrays.items():
+            handle.write(b'\x00' * (header['arrays'][name][0] - handle.tell()))
+            handle.write(np.ascontiguousarray(array).tobytes())
+
+
+def map_index_file(path, magic):
+    """Memory-map a file written by write_index_file. Returns (mmap buffer, header, name -> read-only array)."""
+    with open(path, 'rb') as handle:
+        buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    assert buffer[:4] == magic, f"{path} is not a {magic.decode()} index."
+    header = json.loads(buffer[8:8 + int.from_bytes(buffer[4:8], 'little')])
+
+    arrays = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return buffer, header, arrays
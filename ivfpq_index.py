@@ -0,0 +1,346 @@
+import numpy as np
+
+from index_file import write_index_file, map_index_file
+
+
+"""
+Inverted-file index with product quantization (IVF-PQ, Jégou et al., 2011) in NumPy, as a compressed index
+engine of MultiMetricDatabase for catalogs too large to hold as float32 vectors or Annoy forests (e.g. one
+embedding per glyph and weight rather than per font).
+
+Building it (offline, see build_indexes.py) trains two quantizers on a sample of the vectors:
+    - coarse centroids, by k-means: every vector is filed in the inverted list of its closest centroid
+    - product quantization codebooks of the residuals (vector - its centroid): the dimensions are split into
+      'n_subquantizers' subspaces, each with its own k-means codebook of 256 centroids
+and encodes every vector as one uint8 code per subspace. A vector then takes n_subquantizers bytes plus a
+4-byte id, against 4 bytes per dimension for float32.
+
+A query ranks the coarse centroids, scans the 'nprobe' closest inverted lists, and scores their codes with
+asymmetric distance computation: one table per probed list of the distances from the (unquantized) query
+residual to every codebook centroid, so scoring a code is n_subquantizers table lookups. The distances of
+every metric are sums over the dimensions, hence over the subspaces: squared L2 (also on unit vectors for
+angular), L1 (also on 0/1 vectors for hamming), and minus the inner product. More probed lists means better
+recall and slower queries; get_nns_by_vector's search_k sets nprobe.
+
+Saved indexes are a single file whose codes are memory-mapped on load (see index_file.py).
+"""
+
+ivfpq_magic = b'IVPQ'
+ivfpq_format = 1
+
+
+#====================================
+# k-means
+#====================================
+def nearest_centroids(vectors, centroids, chunk_size=None):
+    """Row of the closest centroid (squared L2) of every vector, computed in chunks of about 64 MB of distances."""
+    chunk_size = chunk_size or max(1, 2**24 // len(centroids))
+    # ||x - c||^2 ranks like ||c||^2 - 2 x.c, computed as one product and one in-place addition
+    squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+    scaled_centroids = np.ascontiguousarray(-2.0 * centroids.T, dtype=np.float32)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        distances = np.asarray(vectors[start:start + chunk_size], dtype=np.float32) @ scaled_centroids
+        distances += squared_norms
+        assignment[start:start + chunk_size] = np.argmin(distances, axis=1)
+    return assignment
+
+
+def kmeans(vectors, k, n_iterations=20, seed=42):
+    """
+    Lloyd's k-means under squared L2: (min(k, len(vectors)), d) float32 centroids.
+    Clusters left empty by an iteration are re-seeded with random vectors.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for _ in range(n_iterations):
+        assignment = nearest_centroids(vectors, centroids)
+        # Sum the members of each cluster with one reduceat over the vectors sorted by cluster
+        order = np.argsort(assignment, kind='stable')
+        clusters, starts, counts = np.unique(assignment[order], return_index=True, return_counts=True)
+        centroids[clusters] = np.add.reduceat(vectors[order], starts, axis=0) / counts[:, None]
+
+        empty = np.setdiff1d(np.arange(k), clusters)
+        if not len(empty):
+            continue
+        centroids[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    Parameters:
+    f (int): Dimensions of the vectors (named like AnnoyIndex's argument).
+    metric (str): 'euclidean', 'angular', 'manhattan', 'hamming' or 'dot', with Annoy's semantics.
+    n_lists (int): Coarse centroids, i.e. inverted lists. None picks 4 * sqrt(number of items).
+    n_subquantizers (int): Subspaces, i.e. bytes per code. None picks half the dimensions, rounded up.
+    nprobe (int): Default number of inverted lists scanned by a query. get_nns_by_vector's search_k overrides it.
+    training_size (int): Vectors sampled to train the coarse centroids and the codebooks.
+    n_iterations (int): k-means iterations.
+    seed (int): Seed of the training sample and the k-means initialisation.
+    """
+    file_extension = 'ivfpq'
+    query_options = ['nprobe']     # constructor options that do not change the index
+    supported_metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    codebook_size = 256     # centroids per subspace, so codes fit in uint8
+    compressed = True     # holds codes rather than the vectors, see MultiMetricDatabase
+    chunk_size = 65536     # vectors read, assigned and encoded at a time
+
+    def __init__(self, f, metric, n_lists=None, n_subquantizers=None, nprobe=16, training_size=65536, n_iterations=20, seed=42):
+        assert metric in self.supported_metrics, f"Metric '{metric}' is not supported."
+        self.dimensions = f
+        self.metric = metric
+        self.n_lists = n_lists
+        self.n_subquantizers = n_subquantizers or -(-f // 2)
+        self.nprobe = nprobe
+        self.training_size = training_size
+        self.n_iterations = n_iterations
+        self.seed = seed
+
+        # Subspaces of equal width: the vectors are padded with zeros, which add nothing to any distance
+        self.subspace_dimensions = -(-f // self.n_subquantizers)
+        self.pending = []     # (item ids, vectors) added since the index was created, until build()
+        self.built = False
+        self.unload()
+
+    #====================================
+    # Distances
+    #====================================
+    def _encode(self, vectors):
+        """Vectors as indexed, padded to n_subquantizers * subspace_dimensions: unit length for angular, bits for hamming."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.metric == 'angular':
+            norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+            vectors = vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+        elif self.metric == 'hamming':
+            vectors = (vectors > 0.5).astype(np.float32)
+        padding = self.n_subquantizers * self.subspace_dimensions - self.dimensions
+        return np.pad(vectors, [(0, 0)] * (vectors.ndim - 1) + [(0, padding)])
+
+    def _distances(self, query, vectors):
+        """Internal distances, smaller is closer: squared L2 (on unit vectors for angular), L1, or -inner product."""
+        if self.metric in ('euclidean', 'angular'):
+            difference = vectors - query
+            return np.einsum('...d,...d->...', difference, difference)
+        if self.metric == 'dot':
+            return -(vectors @ query)
+        return np.abs(vectors - query).sum(axis=-1)     # manhattan, and hamming on 0/1 vectors
+
+    def _annoy_distances(self, distances):
+        """Internal distances converted to the values AnnoyIndex.get_nns_by_vector(include_distances=True) returns."""
+        if self.metric in ('euclidean', 'angular'):
+            return np.sqrt(np.maximum(distances, 0.0))
+        if self.metric == 'dot':
+            return -distances
+        return distances
+
+    #====================================
+    # Construction
+    #====================================
+    def add_item(self, i, vector):
+        assert not self.built, "Items cannot be added after build()."
+        self.pending.append((np.array([i], dtype=np.int64), np.asarray(vector, dtype=np.float32).reshape(1, self.dimensions)))
+
+    def add_items(self, ids, vectors):
+        """Add many items at once, without a Python object per item."""
+        assert not self.built, "Items cannot be added after build()."
+        self.pending.append((np.asarray(ids, dtype=np.int64), np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)))
+
+    def build(self, n_trees=None, n_jobs=-1):
+        """Train the quantizers and encode every added item. n_trees and n_jobs are accepted for AnnoyIndex compatibility."""
+        ids = np.concatenate([ids for ids, _ in self.pending]) if self.pending else np.empty(0, dtype=np.int64)
+        vectors = np.concatenate([vectors for _, vectors in self.pending]) if self.pending else np.empty((0, self.dimensions), dtype=np.float32)
+        self.pending = []
+        # Like AnnoyIndex, the last vector added under an id wins
+        ids, last = np.unique(ids[::-1], return_index=True)
+        vectors = vectors[::-1][last]
+        self._build(ids, lambda rows: vectors[rows])
+        return True
+
+    def build_from(self, vectors, ids):
+        """
+        Train the quantizers and encode the items 'ids', whose vectors are the rows 'ids' of 'vectors' (e.g. a
+        memory-mapped catalog). Unlike add_items and build, the vectors are only read a chunk at a time, so the
+        build never holds a float32 copy of them. Items added with add_item(s) are discarded.
+        """
+        assert not self.built, "An index can only be built once."
+        self.pending = []
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        self._build(ids, lambda rows: vectors[ids[rows]])
+        return True
+
+    def _build(self, ids, read):
+        """Build over the sorted item 'ids', where read(rows) returns the vectors of ids[rows] (a slice or sorted rows)."""
+        assert not len(ids) or ids[-1] < 2**31, "Item ids must fit in int32."
+        n = len(ids)
+        rng = np.random.default_rng(self.seed)
+        training = self._encode(read(np.sort(rng.choice(n, size=min(n, self.training_size), replace=False))))
+        n_lists = max(1, min(self.n_lists or int(round(4 * np.sqrt(n))), n))
+        if n:
+            self.centroids = kmeans(training, n_lists, self.n_iterations, self.seed)
+            residuals = training - self.centroids[nearest_centroids(training, self.centroids)]
+            self.codebooks = np.stack([kmeans(subspace, self.codebook_size, self.n_iterations, self.seed)
+                                       for subspace in self._split(residuals)])
+        del training
+
+        # File every vector in its list and encode its residual, by chunks to bound the temporary arrays
+        assignment = np.empty(n, dtype=np.int64)
+        codes = np.empty((n, self.n_subquantizers), dtype=np.uint8)
+        for start in range(0, n, self.chunk_size):
+            rows = slice(start, start + self.chunk_size)
+            assignment[rows], codes[rows] = self._assign_and_encode(self._encode(read(rows)))
+        self._file(ids, assignment, codes)
+
+    def _assign_and_encode(self, vectors):
+        """Inverted list and code of every (encoded) vector."""
+        assignment = nearest_centroids(vectors, self.centroids)
+        residuals = vectors - self.centroids[assignment]
+        codes = np.empty((len(vectors), self.n_subquantizers), dtype=np.uint8)
+        for subspace, (residual, codebook) in enumerate(zip(self._split(residuals), self.codebooks)):
+            codes[:, subspace] = nearest_centroids(residual, codebook)
+        return assignment, codes
+
+    def _file(self, ids, assignment, codes):
+        """Store the items sorted by list, so that each inverted list is one contiguous slice of ids and codes."""
+        order = np.argsort(assignment, kind='stable')
+        self.ids = ids[order].astype(np.int32)
+        self.codes = codes[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))]).astype(np.int64)
+        self.n_items = int(ids.max()) + 1 if len(ids) else 0
+        self.built = True
+
+    def updated(self, ids, vectors, removed=()):
+        """
+        A new index with the quantizers of this one, without retraining: the items of this one except 'removed',
+        plus the items 'ids' with the rows of 'vectors' (replacing the items of the same ids). This is how
+        MultiMetricDatabase compacts its changes without the float32 vectors of the catalog.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        assert not len(ids) or ids.max() < 2**31, "Item ids must fit in int32."
+        index = IVFPQIndex(self.dimensions, self.metric, n_lists=self.n_lists, n_subquantizers=self.n_subquantizers, nprobe=self.nprobe,
+                           training_size=self.training_size, n_iterations=self.n_iterations, seed=self.seed)
+        index.centroids, index.codebooks = np.array(self.centroids), np.array(self.codebooks)
+
+        lists = np.repeat(np.arange(len(self.centroids)), np.diff(self.list_offsets))
+        keep = ~np.isin(self.ids, np.concatenate([ids, np.fromiter(removed, dtype=np.int64, count=len(removed))]))
+        assignment, codes = index._assign_and_encode(index._encode(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimensions)))
+        index._file(np.concatenate([self.ids[keep].astype(np.int64), ids]), np.concatenate([lists[keep], assignment]),
+                    np.concatenate([self.codes[keep], codes]))
+        return index
+
+    def _split(self, vectors):
+        """(n, n_subquantizers * subspace_dimensions) vectors as (n_subquantizers, n, subspace_dimensions)."""
+        return vectors.reshape(len(vectors), self.n_subquantizers, self.subspace_dimensions).transpose(1, 0, 2)
+
+    #====================================
+    # Queries
+    #====================================
+    def get_n_items(self):
+        """Like AnnoyIndex: one more than the largest item id, counting the items added before build()."""
+        if not self.built and self.pending:
+            return int(max(ids.max(initial=-1) for ids, _ in self.pending)) + 1
+        return self.n_items
+
+    def get_item_vector(self, i):
+        """The reconstruction of item 'i' from its list centroid and code (unit length for angular, ~0/1 for hamming)."""
+        row = int(np.flatnonzero(np.asarray(self.ids) == i)[0])
+        centroid = self.centroids[np.searchsorted(self.list_offsets, row, side='right') - 1]
+        residual = self.codebooks[np.arange(self.n_subquantizers), self.codes[row]].reshape(-1)
+        return (centroid + residual)[:self.dimensions].tolist()
+
+    def _distance_tables(self, query, lists):
+        """
+        Distances from 'query' to every codebook centroid, per probed list: (len(lists), n_subquantizers, 256),
+        plus a constant per list. For 'dot' the residual tables do not depend on the list, only the constant does.
+        """
+        codebooks = self.codebooks
+        if self.metric == 'dot':
+            tables = -np.einsum('skd,sd->sk', codebooks, query.reshape(self.n_subquantizers, -1))[None]
+            return tables, -(self.centroids[lists] @ query)
+
+        residuals = (query - self.centroids[lists]).reshape(len(lists), self.n_subquantizers, 1, -1)
+        if self.metric in ('euclidean', 'angular'):
+            tables = (np.einsum('lsqd,lsqd->lsq', residuals, residuals) - 2.0 * np.einsum('lsqd,skd->lsk', residuals, codebooks)
+                      + np.einsum('skd,skd->sk', codebooks, codebooks)[None])
+        else:
+            tables = np.abs(residuals - codebooks[None]).sum(axis=-1)
+        return tables, np.zeros(len(lists), dtype=np.float32)
+
+    def get_nns_by_vector(self, vector, n, search_k=-1, include_distances=False):
+        """
+        The 'n' nearest items of 'vector' by their quantized distances, closest first. 'search_k', when positive,
+        is the number of inverted lists scanned (nprobe); otherwise the index's default nprobe is used.
+        """
+        if not len(self.ids) or n <= 0:
+            return ([], []) if include_distances else []
+        query = self._encode(vector)
+        n_lists = len(self.centroids)
+        nprobe = min(search_k if search_k is not None and search_k > 0 else self.nprobe, n_lists)
+
+        coarse_distances = self._distances(query, self.centroids)
+        lists = np.argpartition(coarse_distances, nprobe - 1)[:nprobe] if nprobe < n_lists else np.arange(n_lists)
+        tables, constants = self._distance_tables(query, lists)
+
+        # The probed lists are contiguous slices of the (memory-mapped) ids and codes
+        starts, ends = self.list_offsets[lists], self.list_offsets[lists + 1]
+        ids = np.concatenate([self.ids[start:end] for start, end in zip(starts, ends)])
+        codes = np.concatenate([self.codes[start:end] for start, end in zip(starts, ends)])
+        if not len(ids):
+            return ([], []) if include_distances else []
+
+        # Asymmetric distances: one lookup per subspace in the table of the item's list, summed
+        list_positions = np.repeat(np.arange(len(lists)), ends - starts)
+        table_positions = list_positions if len(tables) > 1 else np.zeros_like(list_positions)
+        table_rows = (table_positions[:, None] * self.n_subquantizers + np.arange(self.n_subquantizers)) * tables.shape[2]
+        distances = tables.reshape(-1)[table_rows + codes].sum(axis=1) + constants[list_positions]
+
+        n = min(n, len(ids))
+        nearest = np.argpartition(distances, n - 1)[:n] if n < len(ids) else np.arange(len(ids))
+        nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+        if not include_distances:
+            return ids[nearest].tolist()
+        return ids[nearest].tolist(), self._annoy_distances(distances[nearest].astype(np.float64)).tolist()
+
+    def memory_bytes(self):
+        """Bytes of the codes, ids and quantizers, whether in memory or memory-mapped."""
+        return self.codes.nbytes + self.ids.nbytes + self.list_offsets.nbytes + self.centroids.nbytes + self.codebooks.nbytes
+
+    #====================================
+    # Persistence
+    #====================================
+    def save(self, path):
+        """Write the index to a single memory-mappable file (see index_file.py)."""
+        header = {'format': ivfpq_format, 'metric': self.metric, 'dimensions': self.dimensions,
+                  'n_subquantizers': self.n_subquantizers, 'n_items': self.n_items}
+        arrays = {'centroids': self.centroids, 'codebooks': self.codebooks, 'list_offsets': self.list_offsets,
+                  'ids': self.ids, 'codes': self.codes}
+        write_index_file(path, ivfpq_magic, header, arrays)
+        return True
+
+    def load(self, path):
+        """Memory-map a saved index. Its build parameters replace the ones given to the constructor, nprobe is kept."""
+        self.buffer, header, arrays = map_index_file(path, ivfpq_magic)
+        assert header['format'] == ivfpq_format, f"{path} has IVF-PQ format {header['format']}, expected {ivfpq_format}."
+        assert header['metric'] == self.metric and header['dimensions'] == self.dimensions, f"{path} is an index of other vectors."
+
+        self.n_subquantizers, self.n_items = header['n_subquantizers'], header['n_items']
+        self.subspace_dimensions = -(-self.dimensions // self.n_subquantizers)
+        self.centroids, self.codebooks, self.list_offsets = arrays['centroids'], arrays['codebooks'], arrays['list_offsets']
+        self.ids, self.codes = arrays['ids'], arrays['codes']
+        self.pending = []
+        self.built = True
+        return True
+
+    def unload(self):
+        """Drop the lists and quantizers (and the memory map of a loaded index), leaving an empty index."""
+        padded_dimensions = self.n_subquantizers * self.subspace_dimensions
+        self.centroids = np.zeros((1, padded_dimensions), dtype=np.float32)
+        self.codebooks = np.zeros((self.n_subquantizers, 1, self.subspace_dimensions), dtype=np.float32)
+        self.list_offsets = np.zeros(2, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int32)
+        self.codes = np.empty((0, self.n_subquantizers), dtype=np.uint8)
+        self.n_items = 0
+        self.buffer = None
+        return True
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fast_json
+from metrics import process_exists
+
+
+"""
+Background jobs for expensive /graph layouts (t-SNE).
+
+Fitting t-SNE takes seconds, so running it inside an async handler would block the uvicorn event loop and
+every other request with it. Instead a POST returns a job id straight away, the layout is computed in a
+bounded ProcessPoolExecutor, and clients poll the job (or wait for it over server-sent events).
+
+- Identical jobs are deduplicated: the job id is a hash of the catalog version, method and font, so
+  submitting the same layout twice (from any gunicorn worker) returns the existing job.
+- The number of queued + running jobs is capped; beyond it, submit() raises LayoutQueueFullError.
+- Completed results are kept on disk in 'results_directory', so they survive restarts and any worker can
+  serve them. Small marker files, holding the worker's pid, let a worker report jobs another worker is still
+  computing; the marker of a worker that died no longer counts, so the job can be submitted again.
+- Results older than 'max_age' seconds are deleted, then the oldest ones until the directory fits in 'max_bytes'
+  (results of old catalog versions are never requested again, as the job ids hash the catalog version).
+"""
+
+
+class LayoutQueueFullError(Exception):
+    pass
+
+
+def compute_layout(method, data):
+    """Runs in a pool process: lay out the rows of 'data' in 2D with 'method' ('tsne' or 'pca')."""
+    from dimensionality_reduction import reduce_with_pca, reduce_with_tsne
+
+    if method == 'tsne':
+        reduced_data, _ = reduce_with_tsne(data= data, n_components= 2)
+    else:
+        reduced_data, _ = reduce_with_pca(data= data, n_components= 2)
+    return reduced_data
+
+
+class LayoutJobManager:
+    def __init__(self, results_directory, namespace='', max_workers=1, max_queue_depth=8, pending_timeout=600,
+                 max_bytes=64 * 1024**2, max_age=7 * 24 * 3600):
+        self.results_directory = results_directory
+        self.namespace = namespace
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.pending_timeout = pending_timeout
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.futures = {}     # job id -> Future, for the jobs this process is computing
+        self.executor = None
+        self._lock = threading.Lock()
+        os.makedirs(results_directory, exist_ok=True)
+
+    def job_id(self, method, font_index, response_format='nodes', namespace=None):
+        namespace = self.namespace if namespace is None else namespace
+        return hashlib.sha1(f'{namespace}\x00{method}\x00{font_index}\x00{response_format}'.encode()).hexdigest()[:20]
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.results_directory, f'{job_id}.{suffix}')
+
+    def _get_executor(self):
+        # Created on first use, and with 'spawn', so no pool processes exist until a layout is actually requested
+        # and they never inherit the server's threads or event loop through fork
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def submit(self, method, font_index, data, render_result, response_format='nodes', namespace=None):
+        """
+        Queue the 'method' layout of 'data' (the embeddings of the graph's nodes) for 'font_index' and return its job id.
+        When it completes, render_result(coordinates) turns the coordinates into the result to store, which must be
+        serializable by fast_json.dumps. 'namespace' (e.g. the catalog version 'data' was read from) defaults to
+        the manager's own.
+        """
+        job_id = self.job_id(method, font_index, response_format, namespace)
+        with self._lock:
+            status = self.status(job_id)['status']
+            if status not in ['unknown', 'failed']:
+                return job_id
+            # Failed jobs are retried when they are submitted again
+            if status == 'failed':
+                os.remove(self._path(job_id, 'failed'))
+
+            if len(self.futures) >= self.max_queue_depth:
+                raise LayoutQueueFullError(f'{len(self.futures)} layout jobs are already queued or running')
+
+            with open(self._path(job_id, 'pending'), 'w') as handle:
+                handle.write(str(os.getpid()))
+            executor = self._get_executor()
+            try:
+                future = executor.submit(compute_layout, method, data)
+            except BrokenProcessPool:
+                # The pool broke before the callbacks of its jobs replaced it
+                self._discard_executor(executor)
+                executor = self._get_executor()
+                future = executor.submit(compute_layout, method, data)
+            self.futures[job_id] = future
+
+        future.add_done_callback(lambda future: self._finish(job_id, future, render_result, executor))
+        return job_id
+
+    def _discard_executor(self, executor):
+        # Called with or without the lock held: only replace the pool if it still is the current one, as the
+        # callbacks of all the jobs of a broken pool (each failing with BrokenProcessPool) land here
+        if self.executor is executor:
+            self.executor = None
+            executor.shutdown(wait=False)
+
+    def _finish(self, job_id, future, render_result, executor):
+        """Store a finished job's result (or error) on disk, then forget about its future."""
+        try:
+            body = fast_json.dumps(render_result(future.result()))
+            suffix = 'json'
+        except Exception as error:
+            body = fast_json.dumps({'error': f'{type(error).__name__}: {error}'})
+            suffix = 'failed'
+            if isinstance(error, BrokenProcessPool):
+                # A pool process died, failing every job queued on the pool; start a fresh pool for the next job
+                with self._lock:
+                    self._discard_executor(executor)
+
+        temporary_path = self._path(job_id, f'{suffix}.{os.getpid()}.tmp')
+        with open(temporary_path, 'wb') as handle:
+            handle.write(body)
+        os.replace(temporary_path, self._path(job_id, suffix))
+
+        with self._lock:
+            try:
+                os.remove(self._path(job_id, 'pending'))
+            except OSError:
+                pass
+            self.futures.pop(job_id, None)
+        self.prune()
+
+    def prune(self):
+        """
+        Delete results and failures older than max_age, then the oldest ones once the directory grows past max_bytes.
+        Pending markers and temporary files left behind by a worker that died mid-job go after pending_timeout.
+        """
+        now = time.time()
+        entries = []
+        for directory_entry in os.scandir(self.results_directory):
+            try:
+                stat = directory_entry.stat()
+            except OSError:     # pruned by another worker meanwhile
+                continue
+            if directory_entry.name.endswith(('.json', '.failed')):
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(directory_entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, directory_entry.path))
+            elif directory_entry.name.endswith(('.pending', '.tmp')) and now - stat.st_mtime > self.pending_timeout:
+                self._remove(directory_entry.path)
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def status(self, job_id):
+        """Return {'status': 'done' | 'failed' | 'running' | 'pending' | 'unknown', ...} for a job, from any worker."""
+        for suffix, status in [('json', 'done'), ('failed', 'failed')]:
+            try:
+                with open(self._path(job_id, suffix)) as handle:
+                    return {'job_id': job_id, 'status': status, 'result': json.load(handle)}
+            except (OSError, ValueError):
+                pass
+
+        future = self.futures.get(job_id)
+        if future is not None:
+            return {'job_id': job_id, 'status': 'running' if future.running() else 'pending'}
+
+        # Computed by another worker? A marker is stale, and the job 'unknown' so it gets computed again, once the
+        # worker that wrote it is gone, when it is this process (which would have the job's future), or after
+        # pending_timeout (e.g. a worker hung mid-job, or its pid reused)
+        pending_path = self._path(job_id, 'pending')
+        try:
+            with open(pending_path) as handle:
+                pid = int(handle.read())
+            age = time.time() - os.path.getmtime(pending_path)
+        except (OSError, ValueError):
+            return {'job_id': job_id, 'status': 'unknown'}
+        if age < self.pending_timeout and pid > 0 and pid != os.getpid() and process_exists(pid):
+            return {'job_id': job_id, 'status': 'pending'}
+        return {'job_id': job_id, 'status': 'unknown'}
+
+    async def wait(self, job_id, poll_interval=0.5):
+        """Wait for a job to finish (without blocking the event loop) and return its final status."""
+        while True:
+            future = self.futures.get(job_id)
+            if future is not None:
+                try:
+                    await asyncio.wrap_future(future)
+                except Exception:
+                    pass
+                # Give the done callback a moment to write the result
+                for _ in range(100):
+                    if self.status(job_id)['status'] in ['done', 'failed']:
+                        break
+                    await asyncio.sleep(0.01)
+
+            status = self.status(job_id)
+            if status['status'] in ['done', 'failed', 'unknown']:
+                return status
+            # Running in another worker: all we can do is poll the shared results directory
+            await asyncio.sleep(poll_interval)
@@ -2,23 +2,36 @@
 
 
 # Import necessary libraries
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import List, Dict, Any
+import os
+import json
+import asyncio
+import logging
+import numpy as np
 
 # Import personalised modules
 #from database import *
-from vector_database import *
-from utils import *
-from optimised_manager import *
-from dimensionality_reduction import *
-
-# Memory optimisation
-from memory_profiler import profile
+from vector_database import NeighbourTable, vector_database_backends
+from optimised_manager import GraphManager
+from dimensionality_reduction import reduce_with_pca
+from shared_store import SharedFontStore
+from font_catalog import FontCatalog
+from response_cache import ResponseCache, cached_response
+from graph_layouts import LayoutTable
+from layout_jobs import LayoutJobManager, LayoutQueueFullError
+from fast_json import FastJSONResponse
+import fast_json
+from precompressed import PrecompressedPayload
+from static_assets import AssetManifest, ImmutableStaticFiles
+from metrics import MetricsRegistry, MetricsMiddleware
+from sampling_profiler import SamplingProfiler, ProfilingMiddleware
+from catalog_snapshot import CatalogSnapshot, SnapshotManager
 
 #===================================================================
 #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
@@ -33,6 +46,13 @@ TO DO:
 # Initialize the FastAPI application
 app = FastAPI()
 
+# Messages go to uvicorn's error log, next to the server's own (gunicorn forwards it to --error-logfile)
+logger = logging.getLogger('uvicorn.error')
+
+# Fingerprinted copies of the static files, written by build_static_assets.py, are cached by browsers for good.
+# Mounted first, as the "/static" mount would otherwise match their URLs too
+app.mount("/static/dist", ImmutableStaticFiles(directory="static/dist", check_dir=False), name="static_dist")
+
 # Serve static files from the "static" directory
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -54,63 +74,255 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-route and per-stage latency histograms and worker RSS, served at /metrics. Each worker writes snapshots
+# into METRICS_DIRECTORY, and /metrics adds up the snapshots of all workers (see metrics.py)
+request_metrics = MetricsRegistry(directory= os.environ.get('METRICS_DIRECTORY', './data/metrics'))
+app.add_middleware(MetricsMiddleware, registry= request_metrics, routes= app.routes)
+
+@app.on_event("startup")
+async def start_metrics():
+    request_metrics.start()
+
+# Opt-in sampling profiler: PROFILE_SLOW_REQUESTS_MS keeps a stack profile of every request slower than that, and
+# PROFILE_HEADER_TOKEN profiles requests sent with 'X-Debug-Profile: <token>'. Profiles are collapsed stack files
+# in PROFILE_DIRECTORY, for flamegraph.pl or speedscope (see sampling_profiler.py)
+profile_slow_requests_ms = os.environ.get('PROFILE_SLOW_REQUESTS_MS')
+profile_header_token = os.environ.get('PROFILE_HEADER_TOKEN')
+if profile_slow_requests_ms is not None or profile_header_token is not None:
+    app.add_middleware(ProfilingMiddleware,
+                       profiler= SamplingProfiler(interval= float(os.environ.get('PROFILE_INTERVAL_MS', 5)) / 1000),
+                       directory= os.environ.get('PROFILE_DIRECTORY', './data/profiles'),
+                       threshold_seconds= float(profile_slow_requests_ms) / 1000 if profile_slow_requests_ms is not None else None,
+                       header_token= profile_header_token,
+                       max_files= int(os.environ.get('PROFILE_MAX_FILES', 100)))
+
 # Initialize Jinja2 templates with the "templates" directory
 templates = Jinja2Templates(directory="templates")
 
+# Templates link assets through asset_url('main.js'), which resolves to the fingerprinted copy when there is one
+asset_manifest = AssetManifest('./static/dist/manifest.json')
+templates.env.globals['asset_url'] = asset_manifest.url
+
 # ...
 image_folder_path = './static/all_font_images'
 
-font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
-font_embeddings_array = load_npz(file_path= font_embeddings_path)
+# The embeddings and label maps come from a single memory-mapped catalog file (see font_catalog.py), so every
+# worker shares the same physical pages instead of holding its own copy. Without a catalog file, the npz + pickle
+# files are converted once into a shared store, by the gunicorn master (see gunicorn.conf.py).
+font_catalog_path = './data/embeddings/all_fonts.fontcat'
 
+font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
 dictionary_path = './data/embeddings/font_name_to_index.pickle'
-dict_font_labels_to_indices= load_data_dict(dictionary_path)
-dict_font_indices_to_labels = {v: k for k, v in dict_font_labels_to_indices.items()}
+font_store_directory = './data/store'
+
+
+# Metrics the vector database supports. Each metric's index is only built (or loaded) on its first query,
+# and the least recently used ones are dropped once they exceed vector_index_memory_budget bytes.
+metrics = ['euclidean', 'angular', 'manhattan', 'hamming', 'dot']
+vector_index_memory_budget = int(os.environ.get('VECTOR_INDEX_MEMORY_BUDGET', 64 * 1024**2))
+
+# 'exact' answers each query with one vectorized NumPy pass (exact results, no index to build),
+# 'annoy' builds an approximate Annoy forest. See benchmark_knn_crossover.py for when Annoy starts to pay off.
+# 'quantized' searches a float16 / int8 copy (EMBEDDING_QUANTIZATION) and re-ranks the candidates with the
+# memory-mapped full-precision embeddings, see benchmark_quantization.py for the memory saved and recall lost.
+# 'hnsw' replaces the Annoy forests with HNSW graphs (links per item HNSW_M, query candidates HNSW_EF),
+# see benchmark_ann_engines.py for how the two compare.
+# 'ivfpq' stores uint8 product-quantization codes in inverted lists (IVFPQ_LISTS lists, IVFPQ_SUBQUANTIZERS bytes
+# per vector, IVFPQ_NPROBE lists scanned per query), for catalogs too large for the others, see benchmark_ivfpq.py.
+# 'sharded' sends every query to SHARD_COUNT shard processes started separately (python sharded_search.py) and
+# merges their results, leaving out the shards that have not replied after SHARD_TIMEOUT seconds.
+vector_database_backend = os.environ.get('VECTOR_DATABASE_BACKEND', 'exact')     #['exact', 'annoy', 'quantized', 'hnsw', 'ivfpq', 'sharded']
+vector_database_options = {}
+if vector_database_backend == 'quantized':
+    vector_database_options = {'quantization': os.environ.get('EMBEDDING_QUANTIZATION', 'int8'),     #['float16', 'int8']
+                               'rerank_factor': float(os.environ.get('QUANTIZED_RERANK_FACTOR', 4))}
+if vector_database_backend == 'hnsw':
+    vector_database_options = {'engine_options': {'M': int(os.environ.get('HNSW_M', 16)),
+                                                  'ef_construction': int(os.environ.get('HNSW_EF_CONSTRUCTION', 64)),
+                                                  'ef': int(os.environ.get('HNSW_EF', 64))}}
+if vector_database_backend == 'ivfpq':
+    # Unset IVFPQ_LISTS / IVFPQ_SUBQUANTIZERS keep the defaults of ivfpq_index.py
+    vector_database_options = {'engine_options': {'n_lists': int(os.environ['IVFPQ_LISTS']) if 'IVFPQ_LISTS' in os.environ else None,
+                                                  'n_subquantizers': int(os.environ['IVFPQ_SUBQUANTIZERS']) if 'IVFPQ_SUBQUANTIZERS' in os.environ else None,
+                                                  'nprobe': int(os.environ.get('IVFPQ_NPROBE', 16))}}
+if vector_database_backend == 'sharded':
+    vector_database_options = {'n_shards': int(os.environ.get('SHARD_COUNT', 4)),
+                               'directory': os.environ.get('SHARD_DIRECTORY', './data/shards'),
+                               'timeout': float(os.environ.get('SHARD_TIMEOUT', 0.5))}
+
+# The Annoy backend memory-maps the per-metric index files written by build_indexes.py
+# (rebuilding any that are missing or stale), so gunicorn workers share them.
+index_directory = './data/indexes'
+
+# Precomputed exact neighbours of every catalog font (see build_neighbour_table.py).
+# Only used if it was built from the current catalog, otherwise every query falls back to live search.
+neighbour_table_path = './data/embeddings/all_font_neighbours.npz'
+
+# Precomputed 2D layouts of every font's /graph neighbourhood (see build_layouts.py), so /graph only slices them
+layouts_path = './data/embeddings/all_font_layouts.npz'
+
+
+# Draw graph nodes from the small thumbnails / sprite atlases written by build_thumbnails.py, when they exist,
+# instead of fetching up to 200 full-size images one by one. GRAPH_IMAGE_SIZE and GRAPH_IMAGE_FORMAT pick one of
+# the variants built (build_thumbnails.py --sizes / --formats); without it, nodes fall back to full-size images.
+image_manifest_path = './static/thumbnails/manifest.json'
+graph_image_mode = os.environ.get('GRAPH_IMAGE_MODE', 'atlas')     #['atlas', 'thumbnail', 'full']
+graph_image_size = int(os.environ.get('GRAPH_IMAGE_SIZE', 64))
+graph_image_format = os.environ.get('GRAPH_IMAGE_FORMAT', 'webp')     #['webp', 'png']
+if not os.path.exists(image_manifest_path):
+    graph_image_mode = 'full'
 
+data_path = './data'
 
-all_font_labels = [label for label, index in dict_font_labels_to_indices.items()]
 
+def build_catalog_snapshot():
+    """
+    Open the catalog files on disk and build everything derived from them into a CatalogSnapshot.
+    Runs once at import, and again in a background thread for every reload (see catalog_snapshot.py).
+    """
+    # A stale shared store (source files changed since it was populated) is repopulated by the first worker to reload
+    if os.path.exists(font_catalog_path):
+        font_catalog = FontCatalog.open(font_catalog_path)
+    else:
+        font_catalog = SharedFontStore.open_or_populate(font_store_directory, font_embeddings_path, dictionary_path)
 
-metrics = ['euclidean']     #['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    font_embeddings_array = font_catalog.font_embeddings_array
+    dict_font_labels_to_indices = font_catalog.dict_font_labels_to_indices
+    dict_font_indices_to_labels = font_catalog.dict_font_indices_to_labels
 
-font_vector_db = MultiMetricDatabase(dimensions=font_embeddings_array.shape[1], metrics= metrics, n_trees=30)
+    # The /fonts response, serialized and compressed once per catalog. Its ETag is derived from the catalog version,
+    # so browsers revalidate with If-None-Match and get a 304 until the catalog changes.
+    list_of_fonts = [
+        {"value": index, "name": label}
+        for label, index in dict_font_labels_to_indices.items()
+    ]
+    fonts_payload = PrecompressedPayload(fast_json.dumps(list_of_fonts), media_type= 'application/json',
+                                         etag= f'"fonts-{font_catalog.version}"')
 
-# Add all fonts to vector database
-font_vector_db.add_vectors(font_embeddings_array, dict_font_labels_to_indices)
+    font_vector_db = vector_database_backends[vector_database_backend](dimensions=font_embeddings_array.shape[1], metrics= metrics, n_trees=30, memory_budget= vector_index_memory_budget, **vector_database_options)
 
+    # Add all fonts to vector database
+    font_vector_db.load_or_build(font_embeddings_array, dict_font_labels_to_indices, index_directory)
 
+    font_neighbour_table = None
+    if os.path.exists(neighbour_table_path):
+        font_neighbour_table = NeighbourTable.load(neighbour_table_path)
+        if font_neighbour_table.version != font_catalog.version:
+            logger.warning(f'Ignoring stale neighbour table {neighbour_table_path}, rerun build_neighbour_table.py')
+            font_neighbour_table = None
 
-# Instantiate and initialize necessary components for the application
-data_path = './data'
-graph_manager = GraphManager(data_path)
+    font_layout_table = None
+    if os.path.exists(layouts_path):
+        font_layout_table = LayoutTable.load(layouts_path)
+        if font_layout_table.version != font_catalog.version:
+            logger.warning(f'Ignoring stale layouts {layouts_path}, rerun build_layouts.py')
+            font_layout_table = None
+
+    graph_manager = GraphManager(data_path, font_embeddings_array= font_embeddings_array, dict_font_labels_to_indices= dict_font_labels_to_indices, dict_font_indices_to_labels= dict_font_indices_to_labels)
+    if graph_image_mode != 'full':
+        if not graph_manager.load_image_manifest(image_manifest_path, size= graph_image_size, image_format= graph_image_format, image_mode= graph_image_mode):
+            logger.warning(f'No {graph_image_size}px {graph_image_format} thumbnails in {image_manifest_path}, using full-size images; '
+                           f'rerun build_thumbnails.py or set GRAPH_IMAGE_SIZE / GRAPH_IMAGE_FORMAT')
+    graph_manager.asset_manifest = asset_manifest
+
+    return CatalogSnapshot(font_catalog.version, font_catalog, font_vector_db, font_neighbour_table, font_layout_table, graph_manager, fonts_payload)
+
+
+# Cache of serialized /similar_fonts and /graph responses, which are pure functions of the request body.
+# Namespaced by the catalog version, node image mode and asset build, so a new catalog never serves old
+# responses. Setting RESPONSE_CACHE_DIRECTORY adds an on-disk tier shared by all gunicorn workers.
+response_cache = ResponseCache(max_bytes= int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024**2)),
+                               disk_directory= os.environ.get('RESPONSE_CACHE_DIRECTORY'))
+
+# Expensive layouts (t-SNE) are computed by background jobs in a small process pool (see layout_jobs.py).
+# Their results are kept on disk up to LAYOUT_JOB_MAX_BYTES in total and LAYOUT_JOB_MAX_AGE seconds each.
+layout_job_manager = LayoutJobManager(results_directory= './data/layout_jobs',
+                                      max_workers= int(os.environ.get('LAYOUT_JOB_WORKERS', 1)),
+                                      max_queue_depth= int(os.environ.get('LAYOUT_JOB_QUEUE_DEPTH', 8)),
+                                      max_bytes= int(os.environ.get('LAYOUT_JOB_MAX_BYTES', 64 * 1024**2)),
+                                      max_age= float(os.environ.get('LAYOUT_JOB_MAX_AGE', 7 * 24 * 3600)))
+
+
+def response_namespace(snapshot):
+    """Cached responses are keyed on the catalog version of the snapshot serving the request, its node images and the asset build."""
+    image_mode = snapshot.graph_manager.image_mode
+    graph_images = f'{image_mode}-{graph_image_size}-{graph_image_format}' if image_mode else 'full'
+    return f'{snapshot.version}-{graph_images}-{asset_manifest.version}'
+
+
+# Everything derived from the catalog lives in one snapshot, which POST /admin/reload rebuilds in the background
+# and swaps in without dropping requests. Endpoints read catalog_snapshots.current once per request; cached
+# endpoints pin it first, as their cache key is derived from it (see cached_response).
+# Reloads are announced to the other workers through CATALOG_RELOAD_FILE.
+catalog_snapshots = SnapshotManager(build_catalog_snapshot,
+                                    request_file= os.environ.get('CATALOG_RELOAD_FILE', './data/reload/request.json'),
+                                    poll_interval= float(os.environ.get('CATALOG_RELOAD_POLL_SECONDS', 5)))
+catalog_snapshots.load()
+
+@app.on_event("startup")
+async def watch_catalog_reloads():
+    catalog_snapshots.watch()
+
+# Required to call POST /admin/reload, in an 'X-Admin-Token' header. The admin endpoints are disabled without it.
+admin_token = os.environ.get('ADMIN_TOKEN')
 
 
 #===================================================================
 #&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&
 #===================================================================
-def find_similar_fonts(chosen_font_label, distance_metric='euclidean'):
+def find_similar_fonts(snapshot, chosen_font_label, distance_metric='euclidean'):
     
     # Translate indication name to index in indication diffusion profiles, to retrieve diffusion profile
     #chosen_font_label = graph_manager.mapping_indication_name_to_label[chosen_indication_name]
-    chosen_font_index = dict_font_labels_to_indices[chosen_font_label]
-    chosen_font_embedding = font_embeddings_array[chosen_font_index]
+    with request_metrics.stage('label_lookup'):
+        chosen_font_index = snapshot.dict_font_labels_to_indices[chosen_font_label]
 
     #====================================
     # Querying Vector Database to return drug candidates
     #====================================
-    num_recommendations = 200
-
-    query = chosen_font_embedding
 
-    font_candidates_indices = font_vector_db.nearest_neighbors(query, distance_metric, num_recommendations)
-
-    font_candidates_labels = [dict_font_indices_to_labels[index] for index in font_candidates_indices]
+    with request_metrics.stage('ann_search'):
+        # Catalog fonts are served from the precomputed neighbour table with a single row slice
+        font_neighbour_table = snapshot.font_neighbour_table
+        if font_neighbour_table is not None and font_neighbour_table.covers(distance_metric, num_recommendations, snapshot.version):
+            font_candidates_indices = font_neighbour_table.nearest_neighbors(chosen_font_index, num_recommendations)
+        else:
+            query = snapshot.font_embeddings_array[chosen_font_index]
+            font_candidates_indices = find_fonts_near_vector(snapshot, query, distance_metric, num_recommendations)
+
+    with request_metrics.stage('label_lookup'):
+        font_candidates_labels = [snapshot.dict_font_indices_to_labels[index] for index in font_candidates_indices]
     #drug_candidates_names = [graph_manager.mapping_drug_label_to_name[i] for i in font_candidates_labels]
 
     return font_candidates_labels # List
 
 
 
+def find_similar_fonts_batch(snapshot, chosen_font_indices, distance_metric='euclidean', num_recommendations=200):
+    """
+    Neighbours of several catalog fonts at once, as a dict from each (distinct) input index to its neighbour indices.
+    Everything is answered with one fancy-indexed slice of the neighbour table when it covers the query,
+    otherwise with a single batched call into the vector database.
+    """
+    unique_font_indices = list(dict.fromkeys(chosen_font_indices))
+
+    with request_metrics.stage('ann_search'):
+        font_neighbour_table = snapshot.font_neighbour_table
+        if font_neighbour_table is not None and font_neighbour_table.covers(distance_metric, num_recommendations, snapshot.version):
+            font_candidates_indices = font_neighbour_table.nearest_neighbors_batch(unique_font_indices, num_recommendations).tolist()
+        else:
+            queries = snapshot.font_embeddings_array[unique_font_indices]
+            font_candidates_indices = snapshot.font_vector_db.nearest_neighbors_batch(queries, distance_metric, num_recommendations)
+            font_candidates_indices = [list(map(int, candidates)) for candidates in font_candidates_indices]
+
+    return dict(zip(unique_font_indices, font_candidates_indices))
+
+
+def find_fonts_near_vector(snapshot, query, distance_metric='euclidean', num_recommendations=200):
+    """Live vector search, for ad-hoc query vectors that the neighbour table cannot answer."""
+    return snapshot.font_vector_db.nearest_neighbors(query, distance_metric, num_recommendations)
+
+
 def print_types(data, level=0):
     if isinstance(data, dict):
         for key, value in data.items():
@@ -122,6 +334,12 @@ def print_types(data, level=0):
             print_types(data[0], level + 1)
 
 
+# Number of similar fonts returned by /similar_fonts, i.e. the number of nodes in a /graph
+num_recommendations = 200
+
+# Largest number of fonts a single /similar_fonts/batch request may ask for
+max_batch_size = 100
+
 # Define a Pydantic model for diseases, drugs, and GraphRequest
 class Font(BaseModel):
     value: int
@@ -130,6 +348,11 @@ class Font(BaseModel):
 class SimilarFontsRequest(BaseModel):
     font_index: int
 
+class BatchSimilarFontsRequest(BaseModel):
+    font_indices: List[int] = Field(..., min_length=1, max_length=max_batch_size)
+    k: int = Field(200, ge=1)
+    metric: str = 'euclidean'
+
 class InterpolationRequest(BaseModel):
     font_1_index: int
     font_2_index: int
@@ -140,6 +363,8 @@ class InterpolationRequest(BaseModel):
 class GraphRequest(BaseModel):
     font_1_label: str
     font_1_index: int
+    dimensionality_reduction_type: str = 'pca'     #['pca', 'tsne']
+    response_format: str = 'nodes'     #['nodes', 'columnar']
 
 
 class FixedCoordinates(BaseModel):
@@ -175,30 +400,96 @@ async def read_items(request: Request):
 
 
 @app.get("/fonts", response_model= List[Font])
-async def get_fonts():
+async def get_fonts(request: Request):
     """Return a list of fonts"""
-    list_of_fonts = [
-        {"value": dict_font_labels_to_indices[label], "name": label}
-        for label in all_font_labels
-    ]
-    return list_of_fonts
+    # Built once per catalog snapshot (see build_catalog_snapshot)
+    return catalog_snapshots.current.fonts_payload.response(request)
 
 @app.post("/similar_fonts", response_model= List[Font])
+@cached_response(response_cache, "/similar_fonts", catalog_snapshots, response_namespace)
 async def get_similar_fonts(similar_fonts_request: SimilarFontsRequest):
     """Return a list of drugs based on the selected disease"""
 
     assert type(similar_fonts_request.font_index) == int
+    snapshot = catalog_snapshots.current
 
-    chosen_font_label = dict_font_indices_to_labels[similar_fonts_request.font_index]
+    with request_metrics.stage('label_lookup'):
+        chosen_font_label = snapshot.dict_font_indices_to_labels[similar_fonts_request.font_index]
 
-    font_candidates = find_similar_fonts(chosen_font_label=chosen_font_label, distance_metric='euclidean')
-    list_of_font_candidates = [
-        {"value": dict_font_labels_to_indices[label], "name": label}
-        for label in font_candidates
-    ]
-    return list_of_font_candidates
+    font_candidates = find_similar_fonts(snapshot, chosen_font_label=chosen_font_label, distance_metric='euclidean')
+
+    with request_metrics.stage('label_lookup'):
+        list_of_font_candidates = [
+            {"value": snapshot.dict_font_labels_to_indices[label], "name": label}
+            for label in font_candidates
+        ]
+
+    # Plain JSON data already, so encode it directly instead of re-validating it against the response model
+    with request_metrics.stage('serialization'):
+        return FastJSONResponse(list_of_font_candidates)
+
+
+
+@app.post("/similar_fonts/batch", response_model= Dict[int, List[int]])
+@cached_response(response_cache, "/similar_fonts/batch", catalog_snapshots, response_namespace)
+async def get_similar_fonts_batch(batch_request: BatchSimilarFontsRequest):
+    """
+    Return the indices of the k most similar fonts for every font index in the request, keyed by input index.
+    Clients resolve indices to names with the /fonts list, which keeps the response compact.
+    """
+    snapshot = catalog_snapshots.current
+    if batch_request.metric not in snapshot.font_vector_db.metrics:
+        raise HTTPException(status_code=400, detail=f"Metric '{batch_request.metric}' is not supported, use one of {snapshot.font_vector_db.metrics}")
+
+    unknown_font_indices = [index for index in batch_request.font_indices if index not in snapshot.dict_font_indices_to_labels]
+    if unknown_font_indices:
+        raise HTTPException(status_code=404, detail=f"Unknown font indices: {unknown_font_indices}")
+
+    k = min(batch_request.k, len(snapshot.dict_font_indices_to_labels))
+    similar_fonts = find_similar_fonts_batch(snapshot, batch_request.font_indices, distance_metric=batch_request.metric, num_recommendations=k)
+
+    # The result is already plain ints, so skip re-validating it against the response model
+    with request_metrics.stage('serialization'):
+        return JSONResponse(content=similar_fonts)
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Hit/miss counters and memory use of the response cache"""
+    return response_cache.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Latency histograms and memory of all workers, in the Prometheus text format"""
+    return Response(content=request_metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def check_admin_token(request):
+    if admin_token is None:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    if request.headers.get('x-admin-token') != admin_token:
+        raise HTTPException(status_code=403, detail="Missing or wrong X-Admin-Token header")
 
 
+@app.post("/admin/reload", status_code=202)
+async def reload_catalog(request: Request):
+    """
+    Rebuild the catalog snapshot from the files on disk in the background and swap it in, in this worker and
+    (within CATALOG_RELOAD_POLL_SECONDS) in all the others. Poll GET /admin/reload for the outcome.
+    """
+    check_admin_token(request)
+    if not catalog_snapshots.request_reload():
+        raise HTTPException(status_code=409, detail="A reload is already in progress")
+    return catalog_snapshots.status()
+
+
+@app.get("/admin/reload")
+async def get_reload_status(request: Request):
+    """Catalog version of this worker and its last reload: build time, and resident memory before, during and after the swap"""
+    check_admin_token(request)
+    return catalog_snapshots.status()
+
 
 # @app.post("/interpolation", response_class=JSONResponse)
 # async def get_interpolation_data(request: InterpolationRequest):
@@ -233,13 +524,14 @@ async def get_similar_fonts(similar_fonts_request: SimilarFontsRequest):
 
 #@app.post("/graph", response_model=GraphResponse)
 @app.post("/graph", response_model=Any)
+@cached_response(response_cache, "/graph", catalog_snapshots, response_namespace)
 async def get_graph_data(request: GraphRequest):
     # Extract parameters from request
 
     font_1_label = request.font_1_label
     font_1_index = request.font_1_index
 
-    dimensionality_reduction_type = 'pca' #['pca', 'tSNE']
+    dimensionality_reduction_type = request.dimensionality_reduction_type
 
     #print(f'disease_label: {disease_label}')
     #print(f'drug_label: {drug_label}')
@@ -248,23 +540,51 @@ async def get_graph_data(request: GraphRequest):
 
     #chosen_font_label = dict_font_indices_to_labels[font_1_index]
 
-    font_candidates = find_similar_fonts(chosen_font_label=font_1_label, distance_metric='euclidean')
-    list_of_font_candidate_indices = [
-        dict_font_labels_to_indices[label]
-        for label in font_candidates
-    ]
-
+    if dimensionality_reduction_type not in ['pca', 'tsne']:
+        raise HTTPException(status_code=400, detail=f"Unknown dimensionality reduction type '{dimensionality_reduction_type}', use 'pca' or 'tsne'")
+    if request.response_format not in ['nodes', 'columnar']:
+        raise HTTPException(status_code=400, detail=f"Unknown response format '{request.response_format}', use 'nodes' or 'columnar'")
 
+    snapshot = catalog_snapshots.current
+    font_layout_table = snapshot.font_layout_table
+    if font_layout_table is not None and font_layout_table.covers(dimensionality_reduction_type, 'euclidean', num_recommendations, snapshot.version):
+        # Both the candidates and their coordinates are precomputed, so this is just a slice
+        with request_metrics.stage('label_lookup'):
+            chosen_font_index = snapshot.dict_font_labels_to_indices[font_1_label]
+        with request_metrics.stage('dimensionality_reduction'):
+            list_of_font_candidate_indices, reduced_data = font_layout_table.layout(chosen_font_index, dimensionality_reduction_type)
 
-    recommended_font_embeddings_array = font_embeddings_array[list_of_font_candidate_indices, :]
+    elif dimensionality_reduction_type == 'tsne':
+        # Fitting t-SNE takes seconds, far too long to run inline in a request
+        raise HTTPException(status_code=404, detail="No precomputed t-SNE layouts: POST the request to /graph/jobs and poll the job, or run build_layouts.py --tsne")
 
-    if dimensionality_reduction_type == 'pca':
-        reduced_data, pca = reduce_with_pca(data= recommended_font_embeddings_array, n_components= 2)
     else:
-        reduced_data, pca = reduce_with_tsne(data= recommended_font_embeddings_array, n_components= 2)
+        list_of_font_candidate_indices = find_graph_candidates(snapshot, font_1_label)
+
+        with request_metrics.stage('dimensionality_reduction'):
+            recommended_font_embeddings_array = snapshot.font_embeddings_array[list_of_font_candidate_indices, :]
+
+            reduced_data, pca = reduce_with_pca(data= recommended_font_embeddings_array, n_components= 2)
+
+    # The response is plain JSON data already, so encode it directly instead of re-validating it
+    with request_metrics.stage('serialization'):
+        return FastJSONResponse(make_graph_response(snapshot, list_of_font_candidate_indices, reduced_data, request.response_format))
+
 
+def find_graph_candidates(snapshot, font_1_label):
+    """Indices of the fonts shown in the graph of 'font_1_label'"""
+    font_candidates = find_similar_fonts(snapshot, chosen_font_label=font_1_label, distance_metric='euclidean')
+    with request_metrics.stage('label_lookup'):
+        return [snapshot.dict_font_labels_to_indices[label] for label in font_candidates]
+
+
+def make_graph_response(snapshot, list_of_font_candidate_indices, reduced_data, response_format='nodes'):
     # Convert graph data into a format that vis.js can handle
-    visjs_nodes = graph_manager.convert_numpy_to_visjs_format(list_of_font_candidate_indices, reduced_data, image_folder_path)
+    if response_format == 'columnar':
+        # Parallel arrays built straight from the NumPy data; the client expands them into vis.js nodes
+        visjs_nodes = snapshot.graph_manager.convert_numpy_to_visjs_columnar(list_of_font_candidate_indices, reduced_data, image_folder_path)
+    else:
+        visjs_nodes = snapshot.graph_manager.convert_numpy_to_visjs_format(list_of_font_candidate_indices, reduced_data, image_folder_path)
 
     #print_types(visjs_nodes)
 
@@ -280,3 +600,64 @@ async def get_graph_data(request: GraphRequest):
     return response
 
 
+#============================================================================
+# Background layout jobs, for layouts too slow to compute inside a request
+#============================================================================
+
+@app.post("/graph/jobs", status_code=202)
+async def submit_graph_job(request: GraphRequest):
+    """
+    Queue the layout of a graph (typically 'tsne') and return its job id. Poll GET /graph/jobs/{job_id},
+    or listen on GET /graph/jobs/{job_id}/events, for the result, which has the same shape as a /graph response.
+    """
+    if request.dimensionality_reduction_type not in ['pca', 'tsne']:
+        raise HTTPException(status_code=400, detail=f"Unknown dimensionality reduction type '{request.dimensionality_reduction_type}', use 'pca' or 'tsne'")
+    if request.response_format not in ['nodes', 'columnar']:
+        raise HTTPException(status_code=400, detail=f"Unknown response format '{request.response_format}', use 'nodes' or 'columnar'")
+    snapshot = catalog_snapshots.current
+    if request.font_1_label not in snapshot.dict_font_labels_to_indices:
+        raise HTTPException(status_code=404, detail=f"Unknown font '{request.font_1_label}'")
+
+    list_of_font_candidate_indices = find_graph_candidates(snapshot, request.font_1_label)
+    recommended_font_embeddings_array = np.asarray(snapshot.font_embeddings_array[list_of_font_candidate_indices, :])
+
+    def render_result(reduced_data):
+        return make_graph_response(snapshot, list_of_font_candidate_indices, reduced_data, request.response_format)
+
+    try:
+        job_id = layout_job_manager.submit(request.dimensionality_reduction_type, snapshot.dict_font_labels_to_indices[request.font_1_label],
+                                           recommended_font_embeddings_array, render_result, request.response_format,
+                                           namespace= snapshot.version)
+    except LayoutQueueFullError as error:
+        raise HTTPException(status_code=429, detail=f'Too many layout jobs in progress ({error}), retry later')
+
+    return layout_job_manager.status(job_id)
+
+
+@app.get("/graph/jobs/{job_id}")
+async def get_graph_job(job_id: str):
+    """Status of a layout job, including its result once it is 'done'"""
+    status = layout_job_manager.status(job_id)
+    if status['status'] == 'unknown':
+        raise HTTPException(status_code=404, detail=f"Unknown layout job '{job_id}'")
+    return status
+
+
+@app.get("/graph/jobs/{job_id}/events")
+async def get_graph_job_events(job_id: str):
+    """Server-sent events stream that sends the job's final status (with its result) once it completes"""
+    if layout_job_manager.status(job_id)['status'] == 'unknown':
+        raise HTTPException(status_code=404, detail=f"Unknown layout job '{job_id}'")
+
+    async def events():
+        waiting = asyncio.ensure_future(layout_job_manager.wait(job_id))
+        while not waiting.done():
+            # Comment lines keep proxies from closing an idle connection
+            yield ': waiting\n\n'
+            await asyncio.wait([waiting], timeout=15)
+        status = waiting.result()
+        yield f"event: {status['status']}\ndata: {json.dumps(status, separators=(',', ':'))}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import shutil
+import threading
+import contextlib
+
+from starlette.routing import Match
+
+
+"""
+Request and stage latency histograms plus resident memory, exposed in the Prometheus text format.
+
+Every gunicorn worker records into its own MetricsRegistry, which a background thread periodically writes as a
+snapshot file into a directory shared by the workers of the same master process. Whichever worker answers
+/metrics merges every snapshot in that directory, so a scrape sees the totals of all workers, each at most
+'snapshot_interval' seconds old. Counts of workers that have exited are still included, so counters never go
+backwards when a worker is replaced: whenever a worker starts, and at every /metrics scrape, the snapshots of
+exited workers are folded into one cumulative file ('exited.json'), so the directory holds one file per live
+worker plus that one. Directories of masters that are no longer running are removed when a worker starts.
+"""
+
+# Upper bounds, in seconds, of the latency histogram buckets; the implicit last bucket is +Inf
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+histogram_help = {
+    'http_request_duration_seconds': 'Time from receiving a request to sending the last byte of its response',
+    'stage_duration_seconds': 'Time spent in each stage of request handling',
+}
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+def merge_histograms(snapshots):
+    """(metric name, label pairs) -> [bucket counts, sum, count], summed over the histograms of 'snapshots'."""
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, (buckets, total, count) in snapshot['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            histogram = merged.setdefault(key, [[0] * (len(latency_buckets) + 1), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+    return merged
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:     # alive, owned by someone else
+        pass
+    return True
+
+
+class MetricsRegistry:
+    """
+    Parameters:
+    directory (str): Directory shared by all workers for their snapshots. None keeps metrics process-local.
+    snapshot_interval (float): Seconds between snapshot writes (and RSS samples) of the background thread.
+    prefix (str): Prefix of all metric names.
+    """
+    exited_name = 'exited.json'     # cumulative histograms of the workers that have exited
+
+    def __init__(self, directory=None, snapshot_interval=5.0, prefix='font_app_'):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.prefix = prefix
+
+        # (metric name, sorted label pairs) -> [bucket counts (not cumulative, +Inf last), sum, count]
+        self.histograms = {}
+        self.rss_bytes = 0
+        self.peak_rss_bytes = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # Set by start(), in the worker process itself
+        self.pid = os.getpid()
+        self.snapshot_directory = None
+        self.snapshot_name = None
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(latency_buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(latency_buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Time the enclosed block as one of the request stages ('label_lookup', 'ann_search', ...)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_duration_seconds', time.perf_counter() - start, stage=stage)
+
+    def sample_memory(self):
+        import psutil
+
+        self.rss_bytes = psutil.Process().memory_info().rss
+        self.peak_rss_bytes = max(self.peak_rss_bytes, self.rss_bytes)
+
+    def snapshot(self):
+        with self.lock:
+            histograms = [[name, labels, [list(buckets), total, count]] for (name, labels), (buckets, total, count) in self.histograms.items()]
+        return {'pid': self.pid, 'updated': time.time(), 'rss_bytes': self.rss_bytes, 'peak_rss_bytes': self.peak_rss_bytes,
+                'buckets': list(latency_buckets), 'histograms': histograms}
+
+    def write_snapshot(self):
+        if self.snapshot_directory is None:
+            return
+        path = os.path.join(self.snapshot_directory, self.snapshot_name)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(self.snapshot(), handle)
+        os.replace(path + '.tmp', path)
+
+    def prune(self):
+        """Remove the snapshot directories of masters that are no longer running."""
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) != os.getppid() and not process_exists(int(name)):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def fold_exited(self):
+        """
+        Add the counts of the snapshots of exited workers to the cumulative file, and delete those snapshots.
+        The cumulative file lists the snapshots it includes until they are deleted, so a concurrent collect()
+        skips them instead of counting them twice.
+        """
+        exited = []
+        for file_name in os.listdir(self.snapshot_directory):
+            pid = file_name.split('-', 1)[0]
+            if file_name.endswith('.json') and pid.isdigit() and file_name != self.snapshot_name and not process_exists(int(pid)):
+                exited.append(file_name)
+        if not exited:
+            return
+
+        with open(os.path.join(self.snapshot_directory, '.fold.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                cumulative = self._read(self.exited_name) or {'histograms': [], 'folded': []}
+                snapshots = [cumulative]
+                for file_name in exited:
+                    snapshot = self._read(file_name)
+                    if snapshot is not None and file_name not in cumulative['folded'] and snapshot.get('buckets') == list(latency_buckets):
+                        snapshots.append(snapshot)
+
+                folded = [file_name for file_name in cumulative['folded'] + exited
+                          if os.path.exists(os.path.join(self.snapshot_directory, file_name))]
+                histograms = [[name, labels, histogram] for (name, labels), histogram in merge_histograms(snapshots).items()]
+                path = os.path.join(self.snapshot_directory, self.exited_name)
+                with open(path + '.tmp', 'w') as handle:
+                    json.dump({'pid': None, 'updated': 0, 'rss_bytes': 0, 'peak_rss_bytes': 0, 'buckets': list(latency_buckets),
+                               'histograms': histograms, 'folded': sorted(set(folded))}, handle)
+                os.replace(path + '.tmp', path)
+
+                for file_name in exited:
+                    try:
+                        os.remove(os.path.join(self.snapshot_directory, file_name))
+                    except OSError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self, file_name):
+        """A snapshot file of the directory, or None if it was removed or replaced meanwhile."""
+        try:
+            with open(os.path.join(self.snapshot_directory, file_name)) as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def start(self):
+        """Start the background thread sampling RSS and writing snapshots. Call it in each worker, after forking."""
+        if self.thread is not None:
+            return
+
+        self.pid = os.getpid()
+        if self.directory is not None:
+            # Workers of one gunicorn master share its pid as parent, and so the same snapshot directory
+            self.snapshot_directory = os.path.join(self.directory, str(os.getppid()))
+            self.snapshot_name = f'{self.pid}-{int(time.time() * 1000)}.json'
+            os.makedirs(self.snapshot_directory, exist_ok=True)
+            self.prune()
+            self.fold_exited()
+
+        def run():
+            while True:
+                try:
+                    self.sample_memory()
+                    self.write_snapshot()
+                except OSError:
+                    pass
+                time.sleep(self.snapshot_interval)
+
+        self.thread = threading.Thread(target=run, name='metrics-snapshot', daemon=True)
+        self.thread.start()
+
+    def collect(self):
+        """Snapshots of all workers, with this worker's refreshed first."""
+        self.sample_memory()
+        own = self.snapshot()
+        if self.snapshot_directory is None or not os.path.isdir(self.snapshot_directory):
+            return [own]
+
+        try:
+            self.fold_exited()
+        except OSError:
+            pass
+
+        snapshots = {}
+        folded = set()
+        for file_name in sorted(os.listdir(self.snapshot_directory)):
+            if not file_name.endswith('.json') or file_name == self.snapshot_name:
+                continue
+            snapshot = self._read(file_name)
+            if snapshot is not None and snapshot.get('buckets') == list(latency_buckets):
+                snapshots[file_name] = snapshot
+                folded.update(snapshot.get('folded', []))
+        # Snapshots listed before fold_exited() (of another worker) deleted them are already in the cumulative file
+        return [own] + [snapshot for file_name, snapshot in snapshots.items() if file_name not in folded]
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format (version 0.0.4)."""
+        snapshots = self.collect()
+        merged = merge_histograms(snapshots)
+
+        lines = []
+        for name in sorted({name for name, _ in merged}):
+            metric = self.prefix + name
+            lines.append(f'# HELP {metric} {histogram_help.get(name, name)}')
+            lines.append(f'# TYPE {metric} histogram')
+            for (histogram_name, labels), (buckets, total, count) in sorted(merged.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip([*latency_buckets, '+Inf'], buckets):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{{format_labels([*labels, ("le", bound)])}}} {cumulative}')
+                lines.append(f'{metric}_sum{{{format_labels(labels)}}} {total}')
+                lines.append(f'{metric}_count{{{format_labels(labels)}}} {count}')
+
+        # Memory gauges only for workers that are still alive, i.e. still refreshing their snapshot
+        live = [snapshot for snapshot in snapshots if time.time() - snapshot['updated'] < 3 * self.snapshot_interval]
+        for name, field, description in [('process_resident_memory_bytes', 'rss_bytes', 'Resident memory of each worker'),
+                                         ('process_resident_memory_peak_bytes', 'peak_rss_bytes', 'Largest sampled resident memory of each worker')]:
+            metric = self.prefix + name
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} gauge')
+            for snapshot in live:
+                lines.append(f'{metric}{{pid="{snapshot["pid"]}"}} {snapshot[field]}')
+        lines.append(f'# HELP {self.prefix}workers Workers currently reporting metrics')
+        lines.append(f'# TYPE {self.prefix}workers gauge')
+        lines.append(f'{self.prefix}workers {len(live)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of every HTTP request, labelled with the route template (not the raw
+    path, which would give one series per job id), the method and the response status.
+
+    Parameters:
+    app: The wrapped ASGI application.
+    registry (MetricsRegistry): Where the latencies are recorded.
+    routes (list): The application's routes (app.routes), used to find the template of a path.
+    """
+    def __init__(self, app, registry, routes):
+        self.app = app
+        self.registry = registry
+        self.routes = routes
+
+    def route_template(self, method, path):
+        scope = {'type': 'http', 'method': method, 'path': path}
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.registry.observe('http_request_duration_seconds', time.perf_counter() - start,
+                                  route=self.route_template(scope['method'], scope['path']), method=scope['method'], status=status)
@@ -1,35 +1,121 @@
-import pandas as pd
 import numpy as np
-import networkx as nx
-
-from memory_profiler import profile
 
 import pickle
 import gzip
+import json
+import os
 
 
 
 
 class GraphManager:
     #@profile
-    def __init__(self, data_path):
+    def __init__(self, data_path, font_embeddings_array=None, dict_font_labels_to_indices=None, dict_font_indices_to_labels=None):
+        """
+        The embeddings and label maps are loaded from 'data_path', unless the caller already holds them
+        (e.g. main.py's shared font store), in which case they are reused instead of loaded a second time.
+        """
 
         self.data_path = data_path
 
-        font_embeddings_path = f'{data_path}/embeddings/all_font_embeddings.npz'
-        self.font_embeddings_array = self.load_npz(font_embeddings_path)
+        if font_embeddings_array is None:
+            font_embeddings_path = f'{data_path}/embeddings/all_font_embeddings.npz'
+            font_embeddings_array = self.load_npz(font_embeddings_path)
+        self.font_embeddings_array = font_embeddings_array
 
-        dict_font_labels_to_indices_path= f'{data_path}/embeddings/font_name_to_index.pickle'
-        self.dict_font_labels_to_indices= self.load_data_dict(dict_font_labels_to_indices_path)
-        self.dict_font_indices_to_labels = self.invert_dict(self.dict_font_labels_to_indices)
+        if dict_font_labels_to_indices is None:
+            dict_font_labels_to_indices_path= f'{data_path}/embeddings/font_name_to_index.pickle'
+            dict_font_labels_to_indices= self.load_data_dict(dict_font_labels_to_indices_path)
+        self.dict_font_labels_to_indices= dict_font_labels_to_indices
 
-    def font_index_to_image_path(self, font_index, image_folder_path):
+        if dict_font_indices_to_labels is None:
+            dict_font_indices_to_labels = self.invert_dict(self.dict_font_labels_to_indices)
+        self.dict_font_indices_to_labels = dict_font_indices_to_labels
+
+        # Set by load_image_manifest, to emit thumbnails or sprite atlas references instead of full-size images
+        self.image_mode = None
+
+        # static_assets.AssetManifest, set to emit fingerprinted image URLs
+        self.asset_manifest = None
+
+    def load_image_manifest(self, manifest_path, size=64, image_format='webp', image_mode='atlas'):
+        """
+        Use the thumbnails and sprite atlases written by build_thumbnails.py for node images.
+
+        Parameters:
+        manifest_path (str): Path of the manifest.json written by build_thumbnails.py.
+        size (int): The thumbnail size, in pixels, to use. Must be one of the sizes that were built.
+        image_format (str): 'webp' or 'png', must be one of the formats that were built.
+        image_mode (str): 'atlas' to emit sprite atlas references, 'thumbnail' to emit per-font thumbnail paths.
+
+        Returns:
+        bool: False, leaving full-size images in use, if the manifest has no thumbnails of that size and format.
+        """
+        with open(manifest_path) as handle:
+            manifest = json.load(handle)
+
+        size_manifest = manifest['sizes'].get(str(size))
+        if size_manifest is None or image_format not in size_manifest['formats']:
+            return False
+        format_manifest = size_manifest['formats'][image_format]
+
+        self.image_mode = image_mode
+        self.image_manifest_folder = os.path.dirname(manifest_path)
+        self.image_cell_size = size_manifest['cell']
+        self.image_format = image_format
+        self.image_atlas_cells = size_manifest['fonts']
+        self.image_atlases = format_manifest['atlases']
+        self.image_thumbnails = format_manifest['thumbnails']
+        return True
+
+    def font_index_to_image_template(self, font_index, image_folder_path):
+        """
+        Image path of a font as a template shared by all fonts with the same kind of image (e.g. every cell of one
+        sprite atlas), and the fields filling it in. '{label}' stands for the font's label, '{x}' and '{y}' for
+        the position of its atlas cell.
+
+        Returns:
+        template (str): The image path template.
+        fields (dict): The values of the template's fields, other than the label.
+        """
 
         font_label = self.dict_font_indices_to_labels[font_index]
 
-        image_file_name = f'{font_label}_Aa.png'
+        if self.image_mode == 'atlas' and font_label in self.image_atlas_cells:
+            atlas_number, x, y = self.image_atlas_cells[font_label]
+            size = self.image_cell_size
+            return f'{self.image_manifest_folder}/{self.image_atlases[atlas_number]}#xywh={{x}},{{y}},{size},{size}', {'x': x, 'y': y}
+
+        elif self.image_mode == 'thumbnail' and font_label in self.image_thumbnails:
+            # build_thumbnails.py names every thumbnail after its font; any other name is used as is
+            template = f'{self.image_manifest_folder}/{self.image_cell_size}/{{label}}_Aa.{self.image_format}'
+            font_image_path = f'{self.image_manifest_folder}/{self.image_thumbnails[font_label]}'
+            if self.fill_image_template(template, font_label, {}) != font_image_path:
+                return font_image_path, {}
+            return template, {}
+
+        else:
+            return f'{image_folder_path}/{{label}}_Aa.png', {}
+
+    def fill_image_template(self, template, font_label, fields):
+        """The image path given by a template of font_index_to_image_template, filled in the way the client does."""
+        template = template.replace('{label}', font_label)
+        for name, value in fields.items():
+            template = template.replace(f'{{{name}}}', str(value))
+        return template
+
+    def font_index_to_image_path(self, font_index, image_folder_path):
+        """
+        Image path of a font. With an image manifest loaded this is either the path of its thumbnail, or a
+        reference to its cell in a sprite atlas, using the media fragment syntax: 'atlas_0.webp#xywh=x,y,w,h'.
+        """
+
+        template, fields = self.font_index_to_image_template(font_index, image_folder_path)
+        font_image_path = self.fill_image_template(template, self.dict_font_indices_to_labels[font_index], fields)
 
-        font_image_path = f'{image_folder_path}/{image_file_name}'
+        # Content-hashed URL, cached by browsers for good (see static_assets.py)
+        if self.asset_manifest:
+            font_image_path = self.asset_manifest.resolve(font_image_path)
 
         return font_image_path
 
@@ -99,5 +185,71 @@ class GraphManager:
 
         
         return nodes
+
+    def convert_numpy_to_visjs_columnar(self, list_of_font_indices, reduced_data, image_folder_path):
+        """
+        Columnar alternative to convert_numpy_to_visjs_format: instead of one dict per node, the nodes are
+        described by parallel arrays, computed straight from the NumPy data, plus the properties they all share.
+
+        Parameters:
+        list_of_font_indices (list): The font index of every node.
+        reduced_data (numpy.ndarray): The 2D coordinates of every node, one row per node.
+        image_folder_path (str): The folder containing the font images.
+
+        Returns:
+        columns (dict): A dictionary with the following key-value pairs:
+        - 'ids', 'labels': the index and label of every node
+        - 'x', 'y': float32 arrays with the scaled coordinates of every node
+        - 'image_templates': the distinct image URL templates of the nodes (see font_index_to_image_template), with
+          '{fingerprint}' standing for the content digest of a fingerprinted image
+        - 'image_template_index': only with several templates, the template of every node
+        - 'image_fingerprints': only with fingerprinted per-font images, the image digest of every node ('' if none)
+        - 'image_x', 'image_y': only with sprite atlases, the atlas cell position of every node
+        - 'shape' and 'fixed': the shape and fixed coordinates shared by all nodes
+        The client rebuilds node i as {id: ids[i], label: labels[i], image: its template filled with labels[i],
+        image_fingerprints[i], image_x[i] and image_y[i], x: x[i], y: y[i], ...}.
+        """
+        coordinate_distance_multiplier = 300
+
+        scaled_coordinates = np.asarray(reduced_data, dtype=np.float32) * coordinate_distance_multiplier
+
+        columns = {
+            "ids": list(list_of_font_indices),
+            "labels": [self.dict_font_indices_to_labels[font_index] for font_index in list_of_font_indices],
+            "x": np.ascontiguousarray(scaled_coordinates[:, 0]),
+            "y": np.ascontiguousarray(scaled_coordinates[:, 1]),
+            "shape": "circularImage",
+            "fixed": {"x": True, "y": True},
+        }
+
+        # Only what differs between nodes is sent per node: a handful of templates (one per sprite atlas) are
+        # shared by all of them, and filled in from the labels plus the short columns below
+        templates = {}
+        template_indices, fingerprints, image_x, image_y = [], [], [], []
+        for font_index, font_label in zip(columns["ids"], columns["labels"]):
+            template, fields = self.font_index_to_image_template(font_index, image_folder_path)
+            fingerprint = None
+            if self.asset_manifest and '{label}' not in template:
+                # One image for the whole template (a sprite atlas), fingerprinted once
+                template = self.asset_manifest.resolve(template)
+            elif self.asset_manifest:
+                fingerprint = self.asset_manifest.fingerprint(self.fill_image_template(template, font_label, fields))
+                if fingerprint is not None:
+                    template = self.asset_manifest.resolve_template(template)
+            template_indices.append(templates.setdefault(template, len(templates)))
+            fingerprints.append(fingerprint or '')
+            image_x.append(fields.get('x', 0))
+            image_y.append(fields.get('y', 0))
+
+        columns["image_templates"] = list(templates)
+        if len(templates) > 1:
+            columns["image_template_index"] = template_indices
+        if any(fingerprints):
+            columns["image_fingerprints"] = fingerprints
+        if self.image_mode == 'atlas':
+            columns["image_x"] = image_x
+            columns["image_y"] = image_y
+
+        return columns
     
 
@@ -0,0 +1,67 @@
+import gzip
+
+from fastapi import Response
+
+try:
+    import brotli
+except ImportError:     # in requirements.txt; without it (e.g. a bare checkout) only gzip and identity are offered
+    brotli = None
+
+
+"""
+Responses whose bytes are built once and served many times.
+
+A PrecompressedPayload keeps a body in plain, gzip and (when the brotli package is installed) brotli form,
+picks the best encoding the client accepts, and answers conditional requests carrying a matching
+If-None-Match with 304 Not Modified, without touching the body at all.
+"""
+
+
+def accepted_encodings(accept_encoding):
+    """Content codings listed in an Accept-Encoding header, ignoring any explicitly refused with q=0."""
+    encodings = set()
+    for item in accept_encoding.split(','):
+        coding, _, parameters = item.strip().partition(';')
+        parameters = parameters.replace(' ', '')
+        if coding and parameters not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']:
+            encodings.add(coding.lower())
+    return encodings
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header matches 'etag' (weak comparison, as RFC 9110 requires for If-None-Match)."""
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return any(candidate.removeprefix('W/') == etag for candidate in candidates)
+
+
+class PrecompressedPayload:
+    def __init__(self, body, media_type, etag, cache_control='no-cache'):
+        self.media_type = media_type
+        self.etag = etag
+        self.cache_control = cache_control
+
+        self.variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body, quality=11)
+
+    def variant_etag(self, encoding):
+        """Strong ETags must differ between encodings of the same resource, so compressed variants get a suffix."""
+        if encoding == 'identity':
+            return self.etag
+        return f'{self.etag[:-1]}-{encoding}"'
+
+    def response(self, request):
+        encodings = accepted_encodings(request.headers.get('accept-encoding', ''))
+        encoding = next((encoding for encoding in ['br', 'gzip'] if encoding in self.variants and encoding in encodings), 'identity')
+        headers = {'ETag': self.variant_etag(encoding), 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+
+        # Every variant has the same content, so a client holding any of them is up to date
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None and any(etag_matches(if_none_match, self.variant_etag(variant)) for variant in self.variants):
+            return Response(status_code=304, headers=headers)
+
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(content=self.variants[encoding], media_type=self.media_type, headers=headers)
@@ -0,0 +1,205 @@
+import os
+import json
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+
+"""
+Response cache for POST endpoints whose response is a pure function of the request body.
+
+Entries are keyed on a canonical hash of the validated request model (plus the route and a namespace,
+e.g. the catalog version, so a new catalog never serves old responses) and hold the already-serialized
+response bytes, so a hit skips the search, the dimensionality reduction, node construction and encoding.
+
+The in-memory tier is bounded by a byte budget with LRU eviction. An optional on-disk tier in a directory
+shared by all gunicorn workers lets each worker reuse the entries the others have already computed. Each worker
+keeps a running total of the directory's size (measured at startup, then updated with its own writes) and only
+scans the directory once that total exceeds the budget, or every 'disk_rescan_interval' writes to account for
+the other workers' entries. A prune removes the oldest entries down to 90% of the budget, so a full cache is
+not scanned on every write.
+"""
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=32 * 1024**2, namespace='', disk_directory=None, max_disk_bytes=256 * 1024**2, disk_rescan_interval=100):
+        self.max_bytes = max_bytes
+        self.namespace = namespace
+        self.disk_directory = disk_directory
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_rescan_interval = disk_rescan_interval
+
+        self.entries = OrderedDict()     # key -> response bytes, least recently used first
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        self.disk_bytes = 0
+        self.disk_writes = 0
+        if disk_directory is not None:
+            os.makedirs(disk_directory, exist_ok=True)
+            self._prune_disk()
+
+    def key(self, route, request_model, namespace=None):
+        """
+        Canonical hash of a validated request model: field order and formatting do not change the key.
+        'namespace' (e.g. derived from the catalog snapshot serving the request) defaults to the cache's own.
+        """
+        canonical_request = json.dumps(request_model.model_dump(mode='json'), sort_keys=True, separators=(',', ':'))
+        namespace = self.namespace if namespace is None else namespace
+        return hashlib.sha1(f'{namespace}\x00{route}\x00{canonical_request}'.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        body = self._read_disk(key)
+        with self._lock:
+            if body is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._store_memory(key, body)
+        return body
+
+    def put(self, key, body):
+        self._store_memory(key, body)
+        self._write_disk(key, body)
+
+    def _store_memory(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self.entries:
+                self.current_bytes -= len(self.entries.pop(key))
+            self.entries[key] = body
+            self.current_bytes += len(body)
+            while self.current_bytes > self.max_bytes:
+                _, evicted_body = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted_body)
+                self.evictions += 1
+
+    #====================================
+    # Shared on-disk tier
+    #====================================
+    def _disk_path(self, key):
+        return os.path.join(self.disk_directory, f'{key}.json')
+
+    def _read_disk(self, key):
+        if self.disk_directory is None:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as handle:
+                return handle.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, body):
+        if self.disk_directory is None:
+            return
+        try:
+            replaced_bytes = os.stat(self._disk_path(key)).st_size
+        except OSError:
+            replaced_bytes = 0
+        # Write under a temporary name and rename, so other workers never read a partial entry
+        temporary_path = f'{self._disk_path(key)}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as handle:
+            handle.write(body)
+        os.replace(temporary_path, self._disk_path(key))
+
+        with self._lock:
+            self.disk_bytes += len(body) - replaced_bytes
+            self.disk_writes += 1
+            scan = self.disk_bytes > self.max_disk_bytes or self.disk_writes % self.disk_rescan_interval == 0
+        if scan:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """
+        Measure the directory and reset the running total. If it grew past max_disk_bytes, remove the oldest
+        entries down to 90% of it.
+        """
+        entries = []
+        for directory_entry in os.scandir(self.disk_directory):
+            if directory_entry.name.endswith('.json'):
+                try:
+                    stat = directory_entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, directory_entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = total_bytes if total_bytes <= self.max_disk_bytes else 0.9 * self.max_disk_bytes
+        for _, size, path in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+        with self._lock:
+            self.disk_bytes = total_bytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'disk_tier': self.disk_directory is not None,
+                'disk_bytes': self.disk_bytes,
+            }
+
+
+def cached_response(cache, route, snapshots=None, namespace=None):
+    """
+    Decorator for an async endpoint taking a single validated request model. Responses are served from 'cache'
+    as pre-serialized JSON bytes; on a miss the endpoint runs and its (JSON-encoded) result is stored.
+
+    With a SnapshotManager 'snapshots', the snapshot is pinned for the whole request and the key's namespace is
+    namespace(snapshot), so the key and the body always come from the same catalog, even across a reload.
+    """
+    def decorator(endpoint):
+        # functools.wraps keeps the endpoint's signature visible to FastAPI, which then calls us with its own
+        # parameter name as keyword argument
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            if snapshots is None:
+                return await respond(None, *args, **kwargs)
+            with snapshots.pinned() as snapshot:
+                return await respond(namespace(snapshot), *args, **kwargs)
+
+        async def respond(key_namespace, *args, **kwargs):
+            request_model = args[0] if args else next(iter(kwargs.values()))
+            key = cache.key(route, request_model, key_namespace)
+            body = cache.get(key)
+            if body is not None:
+                return Response(content=body, media_type='application/json', headers={'X-Cache': 'HIT'})
+
+            result = await endpoint(*args, **kwargs)
+            if isinstance(result, Response):
+                if result.status_code != 200:
+                    return result
+                body = result.body
+            else:
+                body = json.dumps(jsonable_encoder(result), separators=(',', ':')).encode('utf-8')
+            cache.put(key, body)
+            return Response(content=body, media_type='application/json', headers={'X-Cache': 'MISS'})
+
+        return wrapper
+    return decorator
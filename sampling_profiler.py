@@ -0,0 +1,173 @@
+import os
+import re
+import sys
+import time
+import itertools
+import threading
+from collections import Counter
+
+from starlette.datastructures import Headers
+
+
+"""
+Opt-in sampling profiler for slow requests.
+
+While a profiled request is in flight, a background thread samples the stack of the thread serving it (the event
+loop thread, which runs the async endpoints and everything they call) every few milliseconds, through
+sys._current_frames(). Nothing is instrumented, so the cost is one stack walk per sample and nothing at all
+while no profiled request is running.
+
+A request's samples are kept when it took longer than the threshold, or when it carried the debug header, and
+written in the collapsed stack format ('outer;inner;innermost count' per line) that flamegraph.pl, speedscope
+and inferno read directly. Only the newest files are kept, within a file count and a byte budget.
+
+Requests served concurrently on the same event loop interleave, so a slow request's profile can also contain
+samples of requests that ran while it was waiting; profile with little concurrency for clean attributions.
+"""
+
+
+def collapse_stack(frame):
+    """'outermost;...;innermost' for a frame, each function written as 'name (file.py:first line)'."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Parameters:
+    interval (float): Seconds between two samples.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.tokens = itertools.count()
+
+    def begin(self, thread_id):
+        """Start collecting samples of the thread 'thread_id'. Returns the token to pass to end()."""
+        with self.lock:
+            token = next(self.tokens)
+            self.active[token] = (thread_id, Counter())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+                self.thread.start()
+            self.wakeup.set()
+        return token
+
+    def end(self, token):
+        """Stop collecting, and return the samples as a Counter of collapsed stacks."""
+        with self.lock:
+            _, samples = self.active.pop(token)
+        return samples
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                active = list(self.active.values())
+                if not active:
+                    self.wakeup.clear()
+                    continue
+
+            frames = sys._current_frames()
+            stacks = {}
+            for thread_id, samples in active:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                if thread_id not in stacks:
+                    stacks[thread_id] = collapse_stack(frame)
+                samples[stacks[thread_id]] += 1
+            del frames
+
+            time.sleep(self.interval)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling requests slower than 'threshold_seconds', and requests whose 'X-Debug-Profile'
+    header equals 'header_token'. Profiled requests get an 'X-Profile' response header with the file name their
+    profile is written to, when they asked for it with the header.
+
+    Parameters:
+    app: The wrapped ASGI application.
+    profiler (SamplingProfiler): Samples the stacks.
+    directory (str): Where the .collapsed files are written.
+    threshold_seconds (float): Keep the profile of every request that took at least this long. None disables it.
+    header_token (str): Value of the debug header that forces a profile. None disables the header.
+    max_files (int): Number of profiles kept, older ones are deleted first.
+    max_bytes (int): Total size of the profiles kept.
+    """
+    header = 'x-debug-profile'
+
+    def __init__(self, app, profiler, directory, threshold_seconds=None, header_token=None, max_files=100, max_bytes=20 * 1024**2):
+        self.app = app
+        self.profiler = profiler
+        self.directory = directory
+        self.threshold_seconds = threshold_seconds
+        self.header_token = header_token
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.sequence = itertools.count()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        requested = self.header_token is not None and Headers(scope=scope).get(self.header) == self.header_token
+        if not requested and self.threshold_seconds is None:
+            return await self.app(scope, receive, send)
+
+        path = re.sub(r'[^A-Za-z0-9]+', '_', scope['path']).strip('_') or 'root'
+        file_name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self.sequence)}-{scope['method']}-{path}.collapsed"
+
+        async def send_wrapper(message):
+            if requested and message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), (b'x-profile', file_name.encode('latin-1'))]
+            await send(message)
+
+        token = self.profiler.begin(threading.get_ident())
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - start
+            samples = self.profiler.end(token)
+            if requested or seconds >= self.threshold_seconds:
+                self.write(file_name, samples)
+
+    def write(self, file_name, samples):
+        # A request faster than the sampling interval may have no samples: its file is then empty
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, file_name)
+        with open(path + '.tmp', 'w') as handle:
+            handle.writelines(f'{stack} {count}\n' for stack, count in samples.most_common())
+        os.replace(path + '.tmp', path)
+        self.prune()
+
+    def prune(self):
+        """Delete the oldest profiles beyond 'max_files' or 'max_bytes'."""
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.collapsed'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, file_name))
+                except FileNotFoundError:     # pruned by another worker meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        entries.sort(reverse=True)
+        kept_bytes = 0
+        for position, (_, size, file_name) in enumerate(entries):
+            kept_bytes += size
+            if position >= self.max_files or kept_bytes > self.max_bytes:
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    pass
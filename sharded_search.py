@@ -0,0 +1,370 @@
+import os
+import time
+import pickle
+import socket
+import argparse
+import threading
+import socketserver
+import multiprocessing
+
+import numpy as np
+
+from vector_database import vector_database_backends, ExactSearchDatabase, catalog_version
+
+
+"""
+Vector search sharded across local processes, with scatter-gather queries.
+
+The catalog is partitioned across 'n_shards' shard processes by item id (item id modulo n_shards, which keeps the
+shards balanced). Each shard indexes its partition with any backend of vector_database_backends (Annoy, HNSW,
+IVF-PQ, exact...), and serves queries on a Unix socket in 'directory', answering with catalog item ids.
+
+ShardedSearchDatabase is the coordinator, with the same interface as the other backends (it is the 'sharded'
+backend of vector_database.py). A query is sent to every shard at once, and each replies with its k nearest items
+and their exact distances to the query, so the replies can be merged into the global top k. The shards that have
+not replied 'timeout' seconds after the query was sent (stalled, overloaded, or down) are left out: the query
+returns the best results of the others instead of failing, and is counted in 'partial_queries'.
+
+Messages are length-prefixed pickles. The socket directory is only accessible to its owner, so only processes of
+the user running the shards can connect to them.
+
+Shards load the catalog once, when they start: restart them (python sharded_search.py ...) after the catalog
+changes. ShardedSearchDatabase.load_or_build warns when they serve another catalog version.
+
+Usage:
+    python sharded_search.py --n-shards 4 --backend annoy --metrics euclidean angular
+    python sharded_search.py --n-shards 4 --catalog 1000000 --backend ivfpq
+"""
+
+shard_directory = './data/shards'
+
+
+def shard_address(directory, shard):
+    return os.path.join(directory, f'shard_{shard}.sock')
+
+
+#====================================
+# Messages
+#====================================
+def send_message(connection, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    connection.sendall(len(data).to_bytes(8, 'little') + data)
+
+
+def _receive_exactly(connection, n_bytes):
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < n_bytes:
+        count = connection.recv_into(view[received:])
+        if not count:
+            raise EOFError('Connection closed.')
+        received += count
+    return buffer
+
+
+def receive_message(connection):
+    n_bytes = int.from_bytes(_receive_exactly(connection, 8), 'little')
+    return pickle.loads(_receive_exactly(connection, n_bytes))
+
+
+#====================================
+# Shard processes
+#====================================
+def partition(map_labels_to_indices, shard, n_shards):
+    """The part of the label -> item id map held by 'shard'."""
+    return {label: index for label, index in map_labels_to_indices.items() if index % n_shards == shard}
+
+
+class ShardRequestHandler(socketserver.BaseRequestHandler):
+    """Answers the requests of one coordinator connection, one after the other, until it is closed."""
+
+    def handle(self):
+        shard = self.server.shard
+        while True:
+            try:
+                message = receive_message(self.request)
+            except (EOFError, OSError):
+                return
+            try:
+                reply = ('ok', shard.answer(message))
+            except Exception as error:
+                reply = ('error', f'{type(error).__name__}: {error}')
+            send_message(self.request, reply)
+
+
+class ShardServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Shard:
+    """
+    One partition of the catalog and its index, as served by a shard process.
+
+    Parameters:
+    shard (int): Position of the shard, from 0 to n_shards - 1.
+    n_shards (int): Number of shards the catalog is split into.
+    vectors (np.ndarray): Embeddings of the whole catalog (only the rows of the shard are indexed).
+    map_labels_to_indices (dict): Label -> item id map of the whole catalog.
+    backend (str): Backend indexing the partition, a key of vector_database_backends.
+    metrics (list): Metrics the shard supports.
+    backend_options (dict): Extra arguments of the backend.
+    index_directory (str): Where the backend persists its index files (one subdirectory per shard), if it does.
+    """
+    def __init__(self, shard, n_shards, vectors, map_labels_to_indices, backend='annoy', metrics=['euclidean'],
+                 backend_options=None, index_directory=None):
+        self.shard = shard
+        self.n_shards = n_shards
+        self.backend = backend
+        self.metrics = metrics
+        self.catalog_version = catalog_version(vectors, map_labels_to_indices)
+
+        # The partition is indexed under local ids 0..n-1, translated back to item ids by search(): Annoy allocates
+        # room for every id up to the largest one added, which would cost every shard the size of the whole catalog
+        shard_map = {label: index for label, index in partition(map_labels_to_indices, shard, n_shards).items() if index < len(vectors)}
+        self.item_ids = np.array(sorted(shard_map.values()), dtype=np.int64)
+        local_ids = {item_id: position for position, item_id in enumerate(self.item_ids.tolist())}
+        self.vectors = np.ascontiguousarray(vectors[self.item_ids], dtype=np.float32)
+        self.n_items = len(self.item_ids)
+
+        self.database = vector_database_backends[backend](dimensions=vectors.shape[1], metrics=metrics, **(backend_options or {}))
+        local_map = {label: local_ids[item_id] for label, item_id in shard_map.items()}
+        if index_directory is not None:
+            self.database.load_or_build(self.vectors, local_map, os.path.join(index_directory, f'shard_{shard}_of_{n_shards}'))
+        else:
+            self.database.add_vectors(self.vectors, local_map)
+        self.database.warm_up(metrics)
+
+        # Only used to score results, with the distances of exact search, comparable across shards
+        self.scorer = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=metrics)
+
+    def answer(self, message):
+        if message[0] == 'status':
+            return {'shard': self.shard, 'n_shards': self.n_shards, 'pid': os.getpid(), 'backend': self.backend,
+                    'metrics': self.metrics, 'n_items': self.n_items, 'catalog_version': self.catalog_version}
+        if message[0] == 'search':
+            _, metric, queries, k, search_k, target_recall = message
+            return self.search(queries, metric, k, search_k, target_recall)
+        raise ValueError(f"Unknown request '{message[0]}'.")
+
+    def search(self, queries, metric, k, search_k=None, target_recall=None):
+        """The k nearest items of the shard for every query, as [(item ids, distances), ...], closest first."""
+        neighbours = self.database.nearest_neighbors_batch(queries, metric, k, search_k=search_k, target_recall=target_recall)
+        results = []
+        for query, positions in zip(queries, neighbours):
+            positions = np.asarray(positions, dtype=np.int64)
+            prepared = self.scorer._prepare(metric, self.vectors[positions])
+            results.append((self.item_ids[positions], self.scorer._distances(query[None, :], metric, prepared)[0]))
+        return results
+
+    def serve(self, directory):
+        """Serve the shard on its Unix socket in 'directory', until the process is stopped."""
+        address = shard_address(directory, self.shard)
+        if os.path.exists(address):
+            os.remove(address)
+        with ShardServer(address, ShardRequestHandler) as server:
+            server.shard = self
+            server.serve_forever()
+
+
+def run_shard(shard, n_shards, vectors, map_labels_to_indices, directory, backend, metrics, backend_options, index_directory):
+    Shard(shard, n_shards, vectors, map_labels_to_indices, backend, metrics, backend_options, index_directory).serve(directory)
+
+
+def start_shards(vectors, map_labels_to_indices, n_shards, directory=shard_directory, backend='annoy', metrics=['euclidean'],
+                 backend_options=None, index_directory=None):
+    """
+    Start one process per shard and return them (daemon processes: they stop with the calling process).
+    The processes are forked, so they share the pages of the catalog (e.g. a memory-mapped FontCatalog) instead of
+    loading it again. Use wait_for_shards to know when they are ready.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.chmod(directory, 0o700)
+    context = multiprocessing.get_context('fork')
+    processes = []
+    for shard in range(n_shards):
+        process = context.Process(target=run_shard, name=f'shard-{shard}', daemon=True,
+                                  args=(shard, n_shards, vectors, map_labels_to_indices, directory, backend, metrics, backend_options, index_directory))
+        process.start()
+        processes.append(process)
+    return processes
+
+
+def wait_for_shards(directory, n_shards, timeout=600.0, processes=None):
+    """Wait until every shard answers its status, and return the statuses. Raises TimeoutError otherwise."""
+    coordinator = ShardedSearchDatabase(dimensions=None, n_shards=n_shards, directory=directory, timeout=1.0)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        statuses = coordinator.status()
+        if all(status is not None for status in statuses):
+            return statuses
+        if processes is not None and any(not process.is_alive() for process in processes):
+            raise RuntimeError(f'Shard processes exited: {[process.name for process in processes if not process.is_alive()]}')
+        time.sleep(0.2)
+    raise TimeoutError(f'Shards in {directory} not ready after {timeout}s.')
+
+
+#====================================
+# Coordinator
+#====================================
+class ShardedSearchDatabase:
+    """
+    Scatter-gather queries over the shard processes serving 'directory'.
+
+    Parameters:
+    dimensions (int): Dimensions of the vectors.
+    metrics (list): Metrics the shards support.
+    n_shards (int): Number of shards, 0 to n_shards - 1, all expected to answer.
+    directory (str): Directory of the shards' Unix sockets.
+    timeout (float): Seconds a query waits for the shards. The ones that have not replied by then are left out.
+    n_trees, memory_budget, search_k: Accepted (and ignored) so all backends can be constructed with the same
+        arguments. Each shard has its own settings.
+    """
+    def __init__(self, dimensions, metrics=['angular'], n_shards=4, directory=shard_directory, timeout=0.5,
+                 n_trees=None, memory_budget=None, search_k=None):
+        self.dimensions = dimensions
+        self.metrics = metrics
+        self.n_shards = n_shards
+        self.directory = directory
+        self.timeout = timeout
+        self.version = None
+
+        # Idle connections per shard, reused by the next queries
+        self.connections = [[] for _ in range(n_shards)]
+        self._lock = threading.Lock()
+        self.partial_queries = 0
+        self.shard_failures = [0] * n_shards
+
+    def add_vectors(self, vectors, map_labels_to_indices):
+        self.load_or_build(vectors, map_labels_to_indices)
+
+    def load_or_build(self, vectors, map_labels_to_indices, directory=None):
+        """
+        The shards index the catalog themselves: check that they serve this catalog, and warn otherwise.
+        Returns the catalog version.
+        """
+        self.version = catalog_version(vectors, map_labels_to_indices)
+        for shard, status in enumerate(self.status()):
+            if status is None:
+                print(f'Shard {shard} is not answering at {shard_address(self.directory, shard)}, start the shards with sharded_search.py')
+            elif status['catalog_version'] != self.version or status['n_shards'] != self.n_shards:
+                print(f"Shard {shard} serves catalog {status['catalog_version']} in {status['n_shards']} shards, "
+                      f"expected {self.version} in {self.n_shards}: restart the shards")
+        return self.version
+
+    def warm_up(self, metrics=None):
+        """The shards build or load their indexes when they start."""
+
+    def _connect(self, shard, timeout):
+        with self._lock:
+            if self.connections[shard]:
+                return self.connections[shard].pop(), True
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(shard_address(self.directory, shard))
+        return connection, False
+
+    def _send(self, shard, message, deadline):
+        """Send 'message' to 'shard' and return the connection to read the reply from, or None if it is unreachable."""
+        for _ in range(2):
+            connection = None
+            try:
+                connection, reused = self._connect(shard, max(deadline - time.monotonic(), 1e-3))
+                connection.settimeout(max(deadline - time.monotonic(), 1e-3))
+                send_message(connection, message)
+                return connection
+            except OSError:
+                if connection is not None:
+                    connection.close()
+                # An idle connection may be to a shard that restarted since: retry once with a new one
+                if not (connection is not None and reused):
+                    return None
+        return None
+
+    def _receive(self, shard, connection, deadline):
+        """The reply of 'shard', or None if it does not arrive before 'deadline'."""
+        try:
+            connection.settimeout(max(deadline - time.monotonic(), 1e-3))
+            status, reply = receive_message(connection)
+        except (OSError, EOFError):
+            # A late reply would be read by the next query: the connection is dropped
+            connection.close()
+            return None
+        with self._lock:
+            self.connections[shard].append(connection)
+        if status != 'ok':
+            print(f'Shard {shard} failed: {reply}')
+            return None
+        return reply
+
+    def _scatter_gather(self, message):
+        """Send 'message' to every shard at once, and return their replies (None for the ones that did not reply in time)."""
+        deadline = time.monotonic() + self.timeout
+        connections = [self._send(shard, message, deadline) for shard in range(self.n_shards)]
+        replies = [self._receive(shard, connection, deadline) if connection is not None else None
+                   for shard, connection in enumerate(connections)]
+        with self._lock:
+            for shard, reply in enumerate(replies):
+                if reply is None:
+                    self.shard_failures[shard] += 1
+        return replies
+
+    def status(self):
+        """The status of every shard (None for the ones not answering)."""
+        return self._scatter_gather(('status',))
+
+    def nearest_neighbors(self, query, metric, k=10, search_k=None, target_recall=None):
+        return self.nearest_neighbors_batch(query, metric, k, search_k=search_k, target_recall=target_recall)[0]
+
+    def nearest_neighbors_batch(self, queries, metric, k=10, search_k=None, target_recall=None):
+        """
+        k nearest neighbours of every row of 'queries', as a list with one list of item ids per query, merged from
+        the k nearest of every shard. Shards that do not reply in time are left out (see partial_queries).
+        """
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimensions)
+        replies = [reply for reply in self._scatter_gather(('search', metric, queries, k, search_k, target_recall)) if reply is not None]
+        if len(replies) < self.n_shards:
+            with self._lock:
+                self.partial_queries += len(queries)
+
+        neighbours = []
+        for position in range(len(queries)):
+            results = [reply[position] for reply in replies]
+            if not results:
+                neighbours.append([])
+                continue
+            item_ids = np.concatenate([item_ids for item_ids, _ in results])
+            distances = np.concatenate([distances for _, distances in results])
+            order = np.argsort(distances, kind='stable')[:k]
+            neighbours.append(item_ids[order].tolist())
+        return neighbours
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-shards', type=int, default=4)
+    parser.add_argument('--catalog', default='real', help="'real' or a number of synthetic fonts")
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--backend', default='annoy', choices=[backend for backend in vector_database_backends if backend != 'sharded'])
+    parser.add_argument('--metrics', nargs='+', default=['euclidean', 'angular', 'manhattan', 'hamming', 'dot'])
+    parser.add_argument('--n-trees', type=int, default=30)
+    parser.add_argument('--directory', default=shard_directory, help='Directory of the shard sockets')
+    parser.add_argument('--index-directory', default='./data/indexes/shards')
+    args = parser.parse_args()
+
+    from tune_annoy_index import load_catalog
+    vectors, map_labels_to_indices = load_catalog(args.catalog, args.dimensions)
+    backend_options = {'n_trees': args.n_trees}
+
+    start = time.perf_counter()
+    processes = start_shards(vectors, map_labels_to_indices, args.n_shards, args.directory, args.backend, args.metrics,
+                             backend_options, args.index_directory)
+    statuses = wait_for_shards(args.directory, args.n_shards, processes=processes)
+    print(f'{args.n_shards} {args.backend} shards of {len(vectors)} fonts ready in {time.perf_counter() - start:.1f}s '
+          f"({', '.join(str(status['n_items']) for status in statuses)} fonts each), serving {args.directory}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,105 @@
+import os
+import json
+import fcntl
+
+from font_catalog import FontCatalog, convert_font_catalog
+
+
+"""
+Shared, read-only store for the font embeddings and label maps.
+
+Every gunicorn worker used to load its own copy of font_embeddings_array and of the label <-> index
+dictionaries (and GraphManager loaded them a second time). Here the master process converts them once into a
+single font catalog file (see font_catalog.py), and every worker memory-maps that file read-only, so all
+processes share the same physical pages through the OS page cache and adding workers does not multiply
+resident memory.
+
+Deployments that ship a ready-made catalog file do not need the store at all; it exists so that the
+npz + pickle files keep working without a manual conversion step.
+"""
+
+
+class SharedFontStore:
+    """
+    A font catalog file converted from the npz embeddings and pickled label dictionary, kept in 'directory'
+    together with store.json, which records the source files it was built from to detect when it is stale.
+    """
+    store_format = 2
+    catalog_file_name = 'font_catalog.fontcat'
+
+    @classmethod
+    def catalog_path(cls, directory):
+        return os.path.join(directory, cls.catalog_file_name)
+
+    @staticmethod
+    def source_signature(font_embeddings_path, dictionary_path):
+        """Size and modification time of the source files; the store is rebuilt whenever they change."""
+        signature = {'format': SharedFontStore.store_format}
+        for name, file_path in [('embeddings', font_embeddings_path), ('dictionary', dictionary_path)]:
+            stat = os.stat(file_path)
+            signature[name] = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return signature
+
+    @classmethod
+    def is_current(cls, directory, font_embeddings_path, dictionary_path):
+        try:
+            with open(os.path.join(directory, 'store.json')) as handle:
+                current = json.load(handle) == cls.source_signature(font_embeddings_path, dictionary_path)
+        except (OSError, ValueError):
+            return False
+        return current and os.path.exists(cls.catalog_path(directory))
+
+    @classmethod
+    def populate(cls, directory, font_embeddings_path, dictionary_path):
+        """Convert the source files into the store's catalog file. Meant to run once, in the master."""
+        os.makedirs(directory, exist_ok=True)
+        convert_font_catalog(font_embeddings_path, dictionary_path, cls.catalog_path(directory))
+
+        with open(os.path.join(directory, 'store.json'), 'w') as handle:
+            json.dump(cls.source_signature(font_embeddings_path, dictionary_path), handle, indent=2)
+
+    @classmethod
+    def open_or_populate(cls, directory, font_embeddings_path, dictionary_path):
+        """
+        Open the store's FontCatalog, populating it first if it is missing or stale.
+        Under gunicorn the master has already populated it (see gunicorn.conf.py), so workers only attach;
+        the file lock covers single-process servers and workers racing on a stale store.
+        """
+        if not cls.is_current(directory, font_embeddings_path, dictionary_path):
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, '.populate.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    if not cls.is_current(directory, font_embeddings_path, dictionary_path):
+                        cls.populate(directory, font_embeddings_path, dictionary_path)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        return FontCatalog.open(cls.catalog_path(directory))
+
+
+#===================================================================
+# Memory report
+#===================================================================
+def process_memory(pid=None):
+    """
+    Resident memory of a process in bytes, split into pages only it uses ('unique', USS) and pages it shares
+    with other processes ('shared'), plus its proportional share of the shared pages ('pss').
+    """
+    import psutil
+
+    memory = psutil.Process(pid).memory_full_info()
+    return {'rss': memory.rss, 'unique': memory.uss, 'shared': memory.rss - memory.uss, 'pss': memory.pss}
+
+
+def memory_report(worker_pid, master_pid):
+    """One-line startup report for a worker, plus the total footprint (sum of PSS) of the master and all workers."""
+    import psutil
+
+    mb = 1024 ** 2
+    worker = process_memory(worker_pid)
+    processes = [psutil.Process(master_pid)] + psutil.Process(master_pid).children()
+    total_pss = sum(process_memory(process.pid)['pss'] for process in processes)
+
+    return (f"worker {worker_pid}: rss {worker['rss'] / mb:.1f}MB "
+            f"(unique {worker['unique'] / mb:.1f}MB, shared {worker['shared'] / mb:.1f}MB) | "
+            f"total across {len(processes)} processes (sum of PSS): {total_pss / mb:.1f}MB")
@@ -163,6 +163,63 @@ $('#btn-1').click(function() {
   console.log("Chosen Font index: " + font_1_index);
   console.log("Chosen Font label: " + font_1_label);
 
+  // Rebuild vis.js nodes from the columnar /graph response (parallel arrays plus shared properties)
+  function expandColumnarNodes(columns) {
+      var nodes = new Array(columns.ids.length);
+      for (var i = 0; i < columns.ids.length; i++) {
+          // Filled in like GraphManager.fill_image_template
+          var template = columns.image_templates[columns.image_template_index ? columns.image_template_index[i] : 0];
+          var image = template.replace('{label}', columns.labels[i])
+                              .replace('{fingerprint}', columns.image_fingerprints ? columns.image_fingerprints[i] : '')
+                              .replace('{x}', columns.image_x ? columns.image_x[i] : '')
+                              .replace('{y}', columns.image_y ? columns.image_y[i] : '');
+          nodes[i] = {
+              id: columns.ids[i],
+              label: columns.labels[i],
+              shape: columns.shape,
+              image: image,
+              x: columns.x[i],
+              y: columns.y[i],
+              fixed: columns.fixed
+          };
+      }
+      return nodes;
+  }
+
+  // Node images may reference a cell of a sprite atlas as 'atlas_0.webp#xywh=x,y,w,h'. Every atlas is
+  // fetched once, and each referenced cell is cropped into a data URL that vis-network can draw.
+  var atlasImages = {};
+
+  function loadAtlas(url) {
+      if (!atlasImages[url]) {
+          atlasImages[url] = new Promise(function(resolve, reject) {
+              var image = new Image();
+              image.onload = function() { resolve(image); };
+              image.onerror = reject;
+              image.src = url;
+          });
+      }
+      return atlasImages[url];
+  }
+
+  function resolveAtlasImages(nodes) {
+      return Promise.all(nodes.map(function(node) {
+          var match = /^(.*)#xywh=(\d+),(\d+),(\d+),(\d+)$/.exec(node.image);
+          if (!match) {
+              return Promise.resolve(node);
+          }
+          return loadAtlas(match[1]).then(function(atlas) {
+              var x = +match[2], y = +match[3], w = +match[4], h = +match[5];
+              var canvas = document.createElement('canvas');
+              canvas.width = w;
+              canvas.height = h;
+              canvas.getContext('2d').drawImage(atlas, x, y, w, h, 0, 0, w, h);
+              node.image = canvas.toDataURL();
+              return node;
+          });
+      }));
+  }
+
   function generateGraph(font_index, font_label) {
       $.ajax({
           url: baseUrl + '/graph',
@@ -170,63 +227,67 @@ $('#btn-1').click(function() {
           data: JSON.stringify({ 
               font_1_index: font_index,
               font_1_label: font_label,
+              response_format: 'columnar'
 
           }),
           contentType: "application/json; charset=utf-8",
           dataType: 'json',
           success: function(response) {
               // Handle the response from your server
-              console.log("Graph Response: ", JSON.stringify(response));
+              console.log("Graph Response: ", response.console_logging_status);
 
-              var nodesData = new vis.DataSet(response.visjs_nodes);
-              var edgesData = new vis.DataSet([]);  // empty, if you don't have edges
+              // Atlas cells are cropped before the network is drawn, so it never shows a whole atlas as a node image
+              resolveAtlasImages(expandColumnarNodes(response.visjs_nodes)).then(function(nodes) {
+                  var nodesData = new vis.DataSet(nodes);
+                  var edgesData = new vis.DataSet([]);  // empty, if you don't have edges
 
-              var visjsdata = {
-                  nodes: nodesData,
-                  edges: edgesData
-              };
+                  var visjsdata = {
+                      nodes: nodesData,
+                      edges: edgesData
+                  };
 
-              var options = {
-                  physics: false,
+                  var options = {
+                      physics: false,
                   
-              };
+                  };
           
-              // Use vis-network to render the graphs
-              var network = new vis.Network(MOA_network, visjsdata, options);
-
-              // Click event on the nodes
-              network.on("doubleClick", function (params) {
-                  if (params.nodes.length > 0) {
-                      var node_id = params.nodes[0];
-                      var node_index = nodesData.get(node_id).id;
-                      var node_label = nodesData.get(node_id).label;
-                      // Assuming node labels and indices are the same
-                      generateGraph(node_index, node_label);
-                  }
-              });
-
-              // Event handler for the 'hoverNode' event.
-              // This event is triggered when the mouse hovers over a node.
-              network.on('click', function(params) {
-                // params.node contains the id of the hovered node.
-                // We store it in the variable nodeId for convenience.
-                var nodeId = params.node;
-
-                // We use nodes.get(nodeId) to retrieve the node data from the DataSet.
-                // The data is an object containing all the properties of the node, like its id, label, coordinates, etc.
-                var node = nodesData.get(nodeId);
-
-                // Next, we remove the node from the DataSet using nodes.remove(nodeId).
-                // This doesn't delete the node, but it does remove it from the current visualization.
-                // Since nodes are drawn in the order they appear in the DataSet, 
-                // this node will no longer be drawn until we add it back in.
-                nodesData.remove(nodeId);
-
-                // Finally, we add the node back to the DataSet using nodes.update(node).
-                // Because we're adding it last, it will be drawn last, which means it will appear on top of any other nodes.
-                // Note that this doesn't change the node's position in the DOM or its z-index; 
-                // it's just a workaround to control the drawing order.
-                nodesData.update(node);
+                  // Use vis-network to render the graphs
+                  var network = new vis.Network(MOA_network, visjsdata, options);
+
+                  // Click event on the nodes
+                  network.on("doubleClick", function (params) {
+                      if (params.nodes.length > 0) {
+                          var node_id = params.nodes[0];
+                          var node_index = nodesData.get(node_id).id;
+                          var node_label = nodesData.get(node_id).label;
+                          // Assuming node labels and indices are the same
+                          generateGraph(node_index, node_label);
+                      }
+                  });
+
+                  // Event handler for the 'hoverNode' event.
+                  // This event is triggered when the mouse hovers over a node.
+                  network.on('click', function(params) {
+                    // params.node contains the id of the hovered node.
+                    // We store it in the variable nodeId for convenience.
+                    var nodeId = params.node;
+
+                    // We use nodes.get(nodeId) to retrieve the node data from the DataSet.
+                    // The data is an object containing all the properties of the node, like its id, label, coordinates, etc.
+                    var node = nodesData.get(nodeId);
+
+                    // Next, we remove the node from the DataSet using nodes.remove(nodeId).
+                    // This doesn't delete the node, but it does remove it from the current visualization.
+                    // Since nodes are drawn in the order they appear in the DataSet, 
+                    // this node will no longer be drawn until we add it back in.
+                    nodesData.remove(nodeId);
+
+                    // Finally, we add the node back to the DataSet using nodes.update(node).
+                    // Because we're adding it last, it will be drawn last, which means it will appear on top of any other nodes.
+                    // Note that this doesn't change the node's position in the DOM or its z-index; 
+                    // it's just a workaround to control the drawing order.
+                    nodesData.update(node);
+                  });
               });
 
           },
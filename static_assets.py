@@ -0,0 +1,238 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import StaticFiles
+
+from precompressed import accepted_encodings
+
+try:
+    import brotli
+except ImportError:     # in requirements.txt; without it (e.g. a bare checkout) only gzip siblings are written
+    brotli = None
+
+
+"""
+Content-hashed static assets.
+
+build_static_assets.py copies every file under static/ to static/dist/, with a hash of its content in the
+file name (main.js -> main.3f2a9c01d4e7.js), writes gzip/brotli siblings (main.3f2a9c01d4e7.js.gz, .br) of the
+compressible ones, and a manifest mapping every original path to its fingerprinted name.
+
+A fingerprinted URL never changes content, so ImmutableStaticFiles serves them with a year long
+'Cache-Control: immutable': browsers then skip revalidating them altogether, and a repeat visit makes no
+asset or font image requests. Templates and GraphManager resolve URLs through AssetManifest.url; assets
+missing from the manifest (or no manifest at all) keep their plain /static URL.
+"""
+
+manifest_format = 1
+compressible_extensions = ['.css', '.js', '.json', '.svg', '.html', '.txt', '.pdf']
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+
+def fingerprinted_name(asset_path, digest):
+    root, extension = os.path.splitext(asset_path)
+    return f'{root}.{digest}{extension}'
+
+
+def rewrite_css_urls(css, asset_path, assets):
+    """Point relative url(...) references of the stylesheet 'asset_path' at the fingerprinted copies in 'assets'."""
+    css_directory = posixpath.dirname(asset_path)
+
+    def rewrite(match):
+        quote, reference = match.group(1), match.group(2)
+        referenced_path = posixpath.normpath(posixpath.join(css_directory, reference))
+        if reference.startswith(('data:', 'http:', 'https:', '/', '#')) or referenced_path not in assets:
+            return match.group(0)
+        return f'url({quote}{posixpath.relpath(assets[referenced_path], css_directory or ".")}{quote})'
+
+    return re.sub(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""", rewrite, css)
+
+
+def write_compressed_siblings(file_path):
+    """Write .gz (and .br) next to 'file_path', skipping any that would not be smaller than the original."""
+    with open(file_path, 'rb') as handle:
+        body = handle.read()
+
+    variants = {'.gz': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(body, quality=11)
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(body):
+            with open(file_path + suffix, 'wb') as handle:
+                handle.write(compressed)
+
+
+def build_asset_manifest(static_directory, output_directory, exclude=()):
+    """
+    Fingerprint every file under 'static_directory' into 'output_directory' and write its manifest.json.
+
+    Parameters:
+    static_directory (str): The directory served at /static.
+    output_directory (str): Where fingerprinted copies go, normally a 'dist' directory inside 'static_directory'.
+    exclude (list): Paths relative to 'static_directory' to skip, in addition to 'output_directory' itself.
+
+    Returns:
+    dict: The manifest, {'version': ..., 'assets': {original path: fingerprinted path}}, paths relative to
+          'static_directory' and 'output_directory' respectively.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    skipped = {os.path.abspath(output_directory)} | {os.path.abspath(os.path.join(static_directory, path)) for path in exclude}
+
+    manifest_path = os.path.join(output_directory, 'manifest.json')
+    previous_assets = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as handle:
+            previous_assets = json.load(handle).get('assets', {})
+
+    asset_paths = []
+    for directory, subdirectories, file_names in os.walk(static_directory):
+        subdirectories[:] = sorted(name for name in subdirectories if os.path.abspath(os.path.join(directory, name)) not in skipped)
+        for file_name in sorted(file_names):
+            if file_name.startswith('.'):   # .DS_Store and the like
+                continue
+            asset_paths.append(os.path.relpath(os.path.join(directory, file_name), static_directory).replace(os.sep, '/'))
+
+    # Stylesheets go last: the url(...) references inside them are rewritten to the fingerprinted names
+    asset_paths.sort(key=lambda asset_path: asset_path.endswith('.css'))
+
+    assets = {}
+    for asset_path in asset_paths:
+        source_path = os.path.join(static_directory, asset_path)
+        if asset_path.endswith('.css'):
+            with open(source_path, encoding='utf-8') as handle:
+                body = rewrite_css_urls(handle.read(), asset_path, assets).encode('utf-8')
+        else:
+            with open(source_path, 'rb') as handle:
+                body = handle.read()
+
+        target_name = fingerprinted_name(asset_path, hashlib.sha1(body).hexdigest()[:12])
+        target_path = os.path.join(output_directory, target_name)
+
+        # Same name means same content, so files from an earlier build are reused as they are
+        if not os.path.exists(target_path):
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path + '.tmp', 'wb') as handle:
+                handle.write(body)
+            os.replace(target_path + '.tmp', target_path)
+            if os.path.splitext(asset_path)[1].lower() in compressible_extensions:
+                write_compressed_siblings(target_path)
+        assets[asset_path] = target_name
+
+    manifest = {'version': manifest_format, 'assets': assets}
+    with open(manifest_path + '.tmp', 'w') as handle:
+        json.dump(manifest, handle)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    # Pages rendered just before this build may still reference the previous generation, keep it one more round
+    kept = {os.path.normpath(os.path.join(output_directory, name)) for name in [*assets.values(), *previous_assets.values()]}
+    for directory, _, file_names in os.walk(output_directory):
+        for file_name in file_names:
+            file_path = os.path.normpath(os.path.join(directory, file_name))
+            original_path = file_path[:-3] if file_path.endswith(('.gz', '.br')) else file_path
+            if original_path not in kept and file_name != 'manifest.json':
+                os.remove(file_path)
+
+    return manifest
+
+
+class AssetManifest:
+    """
+    Resolves static asset URLs to their fingerprinted copies.
+
+    Parameters:
+    manifest_path (str): Path of the manifest.json written by build_asset_manifest. When it does not exist every
+                         URL resolves to itself.
+    static_url (str): URL the static directory is mounted at.
+    dist_url (str): URL the fingerprinted copies are mounted at.
+    """
+    def __init__(self, manifest_path, static_url='/static', dist_url='/static/dist'):
+        self.static_url = static_url
+        self.dist_url = dist_url
+        self.assets = {}
+        self.version = 'unbuilt'
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rb') as handle:
+                content = handle.read()
+            manifest = json.loads(content)
+            if manifest.get('version') == manifest_format:
+                self.assets = manifest['assets']
+                # Changes with every asset build, for caches of anything that embeds asset URLs
+                self.version = hashlib.sha1(content).hexdigest()[:16]
+
+    def __bool__(self):
+        return bool(self.assets)
+
+    def url(self, asset_path):
+        """URL of an asset given by its path inside the static directory, e.g. 'main.js'."""
+        asset_path = asset_path.lstrip('/')
+        if asset_path in self.assets:
+            return f'{self.dist_url}/{self.assets[asset_path]}'
+        return f'{self.static_url}/{asset_path}'
+
+    def _split(self, static_url):
+        # ('all_font_images/Abel_Aa.png', '#xywh=...') for a URL into the static directory, (None, ...) otherwise
+        path, hash_sign, fragment = static_url.partition('#')
+        prefix, separator, asset_path = path.partition('static/')
+        if not separator or prefix.strip('./'):
+            return None, hash_sign + fragment
+        return asset_path, hash_sign + fragment
+
+    def resolve(self, static_url):
+        """
+        Rewrite a URL into the static directory ('./static/all_font_images/Abel_Aa.png', '/static/main.js', ...)
+        to its fingerprinted URL, keeping any '#fragment'. URLs of unknown assets are returned unchanged.
+        """
+        asset_path, fragment = self._split(static_url)
+        if asset_path not in self.assets:
+            return static_url
+        return f'{self.dist_url}/{self.assets[asset_path]}{fragment}'
+
+    def fingerprint(self, static_url):
+        """The content digest in the fingerprinted name of the asset at 'static_url', None for unknown assets."""
+        asset_path, fragment = self._split(static_url)
+        if asset_path not in self.assets:
+            return None
+        return os.path.splitext(self.assets[asset_path])[0].rsplit('.', 1)[1]
+
+    def resolve_template(self, static_url_template):
+        """
+        resolve for a URL template ('./static/all_font_images/{label}_Aa.png'): the fingerprinted URL template,
+        with '{fingerprint}' standing for the digest given by fingerprint(). Templates outside the static
+        directory are returned unchanged.
+        """
+        asset_path, fragment = self._split(static_url_template)
+        if asset_path is None:
+            return static_url_template
+        return f'{self.dist_url}/{fingerprinted_name(asset_path, "{fingerprint}")}{fragment}'
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """
+    StaticFiles for fingerprinted assets: cached for a year without revalidation, and served from a
+    precompressed .br/.gz sibling when the client accepts that encoding.
+    """
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        full_path = os.fspath(full_path)
+        encodings = accepted_encodings(Headers(scope=scope).get('accept-encoding', ''))
+
+        response = None
+        for encoding, suffix in [('br', '.br'), ('gzip', '.gz')]:
+            if encoding in encodings and os.path.isfile(full_path + suffix):
+                response = FileResponse(full_path + suffix, status_code=status_code, method=scope['method'],
+                                        media_type=mimetypes.guess_type(full_path)[0] or 'text/plain',
+                                        headers={'Content-Encoding': encoding})
+                break
+        if response is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+
+        response.headers['Cache-Control'] = immutable_cache_control
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
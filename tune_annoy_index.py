@@ -0,0 +1,173 @@
+"""
+Recall / latency tuning of the Annoy indexes: grids of n_trees and search_k, measured against exact search.
+
+For every n_trees in the grid an index is built per metric, and a sample of catalog fonts is queried with every
+search_k in the grid (given per requested neighbour, as Annoy's search_k grows with k: its default is n_trees * k).
+recall@k is the fraction of returned neighbours that are at least as close as the exact k-th neighbour, which
+keeps ties (common with hamming) from counting as misses.
+
+The operating point is the fastest (n_trees, search_k) reaching --target-recall on every metric. For the real
+catalog it is saved next to the index files (annoy_operating_point.json in ./data/indexes) together with the
+measured recall curves, and the indexes are built with its n_trees: MultiMetricDatabase.load_or_build adopts it,
+and nearest_neighbors(..., target_recall=0.9) picks a search_k from the curves. Synthetic catalogs are only
+reported.
+
+Usage:
+    python tune_annoy_index.py
+    python tune_annoy_index.py --metrics euclidean angular --n-trees 10 30 100 --target-recall 0.95
+    python tune_annoy_index.py --catalog 100000 --k 50
+"""
+import os
+import json
+import argparse
+import time
+
+import numpy as np
+
+from vector_database import MultiMetricDatabase, ExactSearchDatabase, catalog_version
+
+
+font_catalog_path = './data/embeddings/all_fonts.fontcat'
+font_embeddings_path = './data/embeddings/all_font_embeddings.npz'
+dictionary_path = './data/embeddings/font_name_to_index.pickle'
+index_directory = './data/indexes'
+
+
+def load_catalog(catalog, dimensions):
+    if catalog != 'real':
+        from benchmark_load import synthetic_catalog
+        return synthetic_catalog(int(catalog), dimensions)
+
+    if os.path.exists(font_catalog_path):
+        from font_catalog import FontCatalog
+        font_catalog = FontCatalog.open(font_catalog_path)
+        return np.asarray(font_catalog.font_embeddings_array), dict(font_catalog.dict_font_labels_to_indices)
+
+    from utils import load_data_dict, load_npz
+    return load_npz(file_path= font_embeddings_path), load_data_dict(dictionary_path)
+
+
+def exact_kth_distances(exact_db, queries, metric, k):
+    """Exact distances of every query to all items, and the distance of its exact k-th neighbour."""
+    distances = exact_db._distances(np.asarray(queries, dtype=np.float32), metric)
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+    return distances, kth
+
+
+def measure(database, metric, queries, item_ids, distances, kth, k, search_k):
+    """Mean recall@k and mean seconds per query of 'database' at 'search_k'."""
+    get_nns_by_vector = database.get_index(metric).get_nns_by_vector
+    start = time.perf_counter()
+    results = [get_nns_by_vector(query, k, search_k=search_k) for query in queries]
+    seconds = (time.perf_counter() - start) / len(queries)
+
+    # Columns of 'distances' follow the exact database's rows, which are sorted by item id
+    tolerance = 1e-5 * np.maximum(1.0, np.abs(kth))
+    recalls = [np.sum(distances[row, np.searchsorted(item_ids, neighbours)] <= kth[row] + tolerance[row]) / k
+               for row, neighbours in enumerate(results)]
+    return float(np.mean(recalls)), seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--catalog', default='real', help="'real' or a number of synthetic fonts")
+    parser.add_argument('--metrics', nargs='+', default=['euclidean'])
+    parser.add_argument('--k', type=int, default=200)
+    parser.add_argument('--n-trees', type=int, nargs='+', default=[5, 10, 30, 100])
+    parser.add_argument('--search-k', type=float, nargs='+', default=[1, 2, 5, 10, 20, 50, 100, 200], help='Per requested neighbour')
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--n-queries', type=int, default=200)
+    parser.add_argument('--dimensions', type=int, default=9, help='Embedding size of synthetic catalogs')
+    parser.add_argument('--directory', default=index_directory)
+    parser.add_argument('--output', default=None, help='JSON report, data/benchmarks/tune_annoy_<time>.json by default')
+    args = parser.parse_args()
+
+    vectors, map_labels_to_indices = load_catalog(args.catalog, args.dimensions)
+    k = min(args.k, len(vectors))
+    rng = np.random.default_rng(42)
+    query_positions = rng.choice(len(vectors), size=min(args.n_queries, len(vectors)), replace=False)
+
+    exact_db = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=args.metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = exact_db.vectors[query_positions]
+
+    # results[n_trees][metric] = [[search_k per neighbour, recall, seconds per query], ...]
+    results = {}
+    exact_seconds = {}
+    print(f'catalog {args.catalog}: {len(vectors)} fonts, recall@{k} over {len(queries)} queries')
+    for metric in args.metrics:
+        distances, kth = exact_kth_distances(exact_db, queries, metric, k)
+        start = time.perf_counter()
+        exact_db.nearest_neighbors_batch(queries, metric, k)
+        exact_seconds[metric] = (time.perf_counter() - start) / len(queries)
+        print(f'  {metric}: exact search {exact_seconds[metric] * 1e6:.0f}us per query')
+
+        for n_trees in args.n_trees:
+            database = MultiMetricDatabase(dimensions=vectors.shape[1], metrics=[metric], n_trees=n_trees)
+            database.add_vectors(vectors, map_labels_to_indices)
+            build_start = time.perf_counter()
+            database.warm_up()
+            build_seconds = time.perf_counter() - build_start
+
+            curve = []
+            for per_neighbour in args.search_k:
+                recall, seconds = measure(database, metric, queries, exact_db.item_ids, distances, kth, k, int(np.ceil(per_neighbour * k)))
+                curve.append([per_neighbour, recall, seconds])
+                print(f'    n_trees {n_trees:4d} (built in {build_seconds:5.2f}s)  search_k {per_neighbour:6g}k  '
+                      f'recall {recall:.3f}  {seconds * 1e6:8.0f}us per query')
+            results.setdefault(n_trees, {})[metric] = curve
+
+    # Fastest n_trees / search_k reaching the target on every metric, by total query time over the metrics
+    candidates = []
+    for n_trees, curves in results.items():
+        chosen = {}
+        for metric, curve in curves.items():
+            reaching = [point for point in curve if point[1] >= args.target_recall]
+            if reaching:
+                chosen[metric] = min(reaching, key=lambda point: point[2])
+        if len(chosen) == len(args.metrics):
+            candidates.append((sum(point[2] for point in chosen.values()), n_trees, chosen))
+
+    n_trees, chosen = None, {}
+    if candidates:
+        _, n_trees, chosen = min(candidates, key=lambda candidate: candidate[:2])
+        print(f'operating point: n_trees {n_trees}, ' + ', '.join(
+            f'{metric} search_k {point[0]:g}k (recall {point[1]:.3f}, {point[2] * 1e6:.0f}us)' for metric, point in chosen.items()))
+    else:
+        print(f'No point of the grid reaches recall {args.target_recall}: extend --n-trees or --search-k')
+
+    output = args.output or f"./data/benchmarks/tune_annoy_{time.strftime('%Y%m%dT%H%M%S')}.json"
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as handle:
+        json.dump({'catalog': args.catalog, 'n_fonts': len(vectors), 'k': k, 'n_queries': len(queries),
+                   'target_recall': args.target_recall, 'exact_seconds_per_query': exact_seconds,
+                   'grid': {str(trees): curves for trees, curves in results.items()},
+                   'operating_point': {'n_trees': n_trees, 'search_k': {metric: point[0] for metric, point in chosen.items()}}},
+                  handle, indent=2)
+    print(f'Report written to {output}')
+
+    if not candidates:
+        raise SystemExit(1)
+    if args.catalog != 'real':
+        raise SystemExit(0)
+
+    # Recall only grows with search_k, up to measurement noise, so the curve is kept monotonic for lookups
+    recall_curves = {}
+    for metric in args.metrics:
+        curve = sorted(results[n_trees][metric])
+        recall_curves[metric] = [[point[0], float(np.maximum.accumulate([p[1] for p in curve])[position])] for position, point in enumerate(curve)]
+
+    MultiMetricDatabase.save_operating_point(args.directory, {
+        'catalog_version': catalog_version(vectors, map_labels_to_indices),
+        'k': k,
+        'target_recall': args.target_recall,
+        'n_trees': n_trees,
+        'search_k': {metric: point[0] for metric, point in chosen.items()},
+        'recall_curves': recall_curves,
+    })
+
+    # Build the index files with the chosen n_trees, so the app only has to mmap them
+    font_vector_db = MultiMetricDatabase(dimensions=vectors.shape[1], metrics=args.metrics)
+    version = font_vector_db.load_or_build(vectors, map_labels_to_indices, args.directory)
+    font_vector_db.warm_up()
+    print(f'Saved the operating point and built the indexes (version {version}) in {args.directory}')
@@ -2,12 +2,9 @@ import numpy as np
 import random
 import os
 import pickle
-import matplotlib.pyplot as plt
-import torch
-from torch import nn
-import torchvision
-#import torchvision.models as pretrained_models
-import torch.nn.functional as F
+
+# torch, torchvision and matplotlib are only needed by the training and plotting helpers, which import them
+# themselves: the web app imports this module for the loaders alone, and must not pay for them (see benchmark_startup.py)
 
 """TO DO:
     - FIX combine_all_vectors_and_labels() to do what it says in the comment.
@@ -59,6 +56,10 @@ def combine_all_vectors_and_labels(path):
 
 
 def show_transformed_images(dataset):
+    import torch
+    import torchvision
+    import matplotlib.pyplot as plt
+
     loader = torch.utils.data.DataLoader(dataset, batch_size = 6, shuffle = True)
     batch = next(iter(loader))
     images, labels = batch
@@ -84,6 +85,9 @@ def plot_ae_outputs(encoder, decoder, test_dataset, device, n=8, indices=None):
     - The first row includes the original images from the test dataset
     - The second row includes the reconstructed images by the autoencoder
     """
+    import torch
+    import matplotlib.pyplot as plt
+
     if indices is None:
         # Randomly sample 'n' indices if not provided
         indices = random.sample(range(len(test_dataset)), n)
@@ -132,6 +136,9 @@ def visualize_first_layer_filters(vae, num_filters_to_plot=8):
     num_filters_to_plot : int, optional
         The number of filters to display from the first layer. The default value is 8, which corresponds to all filters in the first layer.
     """
+    from torch import nn
+    import matplotlib.pyplot as plt
+
     # Make sure that the first layer of the encoder part of the VAE is a Conv2d layer
     assert isinstance(vae.encoder.encoder_conv1[0], nn.Conv2d)
     
@@ -178,6 +185,9 @@ def visualize_first_layer_filter_outputs(vae, test_dataset, device, num_filters_
     num_filters_to_plot : int, optional
         The number of filter outputs to display. The default value is 8, which corresponds to all filters in the first layer.
     """
+    from torch import nn
+    import matplotlib.pyplot as plt
+
     # Make sure that the first layer of the encoder part of the VAE is a Conv2d layer
     assert isinstance(vae.encoder.encoder_conv1[0], nn.Conv2d)
 
@@ -244,6 +254,9 @@ def visualize_deeper_layer_filter_outputs(vae, test_dataset, device, layer_index
         - Layer 3: Any value from 1 to 256.
         It's recommended to keep this number relatively small (e.g., 16 or 32), as deeper layers can have a large number of filters (e.g., 256), and visualizing them all at once can be overwhelming.
     """
+    from torch import nn
+    import matplotlib.pyplot as plt
+
     # Get all the Conv2d layers in the encoder
     conv_layers = [module for module in vae.encoder.modules() if isinstance(module, nn.Conv2d)]
 
@@ -309,6 +322,8 @@ def plot_loss_progression(train_losses, val_losses, window_size=50):
     This function receives lists of training and validation losses and plots them.
     It applies a moving average filter for smoothing and also calculates the moving standard deviation.
     """
+    import matplotlib.pyplot as plt
+
     # Check if there's enough data to apply a moving average
     if len(train_losses) >= window_size:
         # Apply moving average and moving standard deviation
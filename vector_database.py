@@ -2,9 +2,18 @@
 #%%
 import numpy as np
 from annoy import AnnoyIndex
-import pandas as pd
 import os
 import pickle
+import hashlib
+import json
+import fcntl
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+from hnsw_index import HNSWIndex
+from ivfpq_index import IVFPQIndex
 
 
 """ TO DO:
@@ -27,35 +36,916 @@ def save_data_dict(file_name, map_labels_to_indices):
     pass
 
 
+# Bump whenever the layout of saved index artifacts changes, so old files are treated as stale
+annoy_artifact_format = 1
+
+# Approximate index engines MultiMetricDatabase can build per metric. They share AnnoyIndex's interface
+index_engines = {
+    'annoy': AnnoyIndex,
+    'hnsw': HNSWIndex,
+    'ivfpq': IVFPQIndex,
+}
+
+
+def catalog_version(vectors, map_labels_to_indices):
+    """
+    Return a short fingerprint of a font catalog, i.e. its vectors and label -> index map.
+    Anything precomputed from the catalog (index files, neighbour tables) records it, to detect when it is stale.
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+    for label, index in sorted(map_labels_to_indices.items(), key=lambda item: item[1]):
+        fingerprint.update(f'{label}\x00{index}\x00'.encode())
+    return fingerprint.hexdigest()[:16]
+
+
 class MultiMetricDatabase:
-    def __init__(self, dimensions, metrics=['angular'], n_trees=10):
+    """
+    Annoy indexes over the same vectors for several distance metrics.
+
+    'metrics' declares which metrics the database supports; the index of a metric is only built
+    (or memory-mapped from disk, see load_or_build) the first time it is queried. With a 'memory_budget'
+    (in bytes), the least recently used indexes are dropped once their total size exceeds the budget,
+    and transparently rebuilt or reloaded on their next use.
+
+    Queries inspect 'search_k' nodes (Annoy's default, -1, is n_trees * k): more nodes means better recall and
+    slower queries. tune_annoy_index.py measures that trade-off and saves an operating point next to the index
+    files, which load_or_build adopts: its n_trees, a default search_k per metric, and the measured recall
+    curves that let a query ask for a target recall instead of a search_k.
+
+    Annoy indexes are immutable once built, so add_vector / remove_label keep changes in a small delta segment,
+    searched exactly, and a set of tombstoned item ids, filtered out of the index results. Queries merge both.
+    Once the delta holds 'delta_max_size' changes, or its oldest change is 'delta_max_age' seconds old, a
+    background thread compacts it: the held indexes are rebuilt over the merged vectors and swapped in, while
+    queries keep using the old index and delta until then.
+
+    'engine' picks the index built per metric (see index_engines): Annoy forests by default, HNSW graphs
+    (hnsw_index.py), or IVF-PQ compressed codes (ivfpq_index.py) for catalogs too large for either, created
+    with 'engine_options'. search_k is the ef of a query with HNSW and the number of inverted lists scanned
+    (nprobe) with IVF-PQ; both ignore n_trees, and operating points are tuned for Annoy only.
+    See benchmark_ann_engines.py and benchmark_ivfpq.py to compare them.
+
+    Compressed engines (IVF-PQ) are meant for catalogs whose float32 vectors are too large to hold, so with them
+    the database keeps no per-label dictionary, builds by reading the vectors a chunk at a time, and drops its
+    reference to them once every metric's index is built (and saved, or never evicted). Compaction then encodes
+    the delta with the quantizers of the current indexes instead of rebuilding them.
+    """
+    def __init__(self, dimensions, metrics=['angular'], n_trees=10, memory_budget=None, search_k=-1, delta_max_size=1000, delta_max_age=600.0,
+                 engine='annoy', engine_options=None):
+        assert engine in index_engines, f"Index engine '{engine}' is not supported."
         self.dimensions = dimensions
         self.n_trees = n_trees
         self.metrics = metrics
-        self.databases = {}
+        self.memory_budget = memory_budget
+        self.search_k = search_k
+        self.delta_max_size = delta_max_size
+        self.delta_max_age = delta_max_age
+        self.engine = engine
+        self.engine_options = engine_options or {}
+        self.compressed = getattr(index_engines[engine], 'compressed', False)
 
-        for metric in metrics:
-            index = AnnoyIndex(dimensions, metric)
-            self.databases[metric] = index
+        # From the operating point: metric -> search_k per requested neighbour, and
+        # metric -> [[search_k per requested neighbour, recall], ...] sorted by search_k
+        self.tuned_search_k = {}
+        self.recall_curves = {}
+
+        # metric -> index (AnnoyIndex or HNSWIndex) for the indexes currently held, least recently used first
+        self.databases = OrderedDict()
+        self.index_sizes = {}
+        self.index_directory = None
+        self.version = None
+        self._lock = threading.Lock()
+        self._update_lock = threading.Lock()
 
     def add_vectors(self, vectors, map_labels_to_indices):
         assert vectors.shape[1] == self.dimensions, "Vectors dimension mismatch."
         
-        # Create a dictionary to map labels to vectors
+        self._map_labels_to_vectors(vectors, map_labels_to_indices)
+        self.index_directory = None
+
+    def _map_labels_to_vectors(self, vectors, map_labels_to_indices):
+        if self.compressed:
+            # No dictionary of row views: at millions of items it takes more memory than the compressed index
+            self.map_labels_to_index = None
+            self.n_items = int(self._item_ids(vectors, map_labels_to_indices).max()) + 1
+        else:
+            # Create a dictionary to map labels to vectors
+            self.map_labels_to_index = {}
+            for label, index in map_labels_to_indices.items():
+                if index < len(vectors):
+                    self.map_labels_to_index[label] = vectors[index]
+            self.n_items = max(map_labels_to_indices[label] for label in self.map_labels_to_index) + 1
+
+        # Kept so that indexes can be built lazily, on first use
+        self.vectors = vectors
+        self.map_labels_to_indices = map_labels_to_indices
+        with self._lock:
+            self.databases.clear()
+            self.index_sizes.clear()
+        self._reset_delta()
+
+    def _new_index(self, metric):
+        return index_engines[self.engine](self.dimensions, metric, **self.engine_options)
+
+    @staticmethod
+    def _item_ids(vectors, map_labels_to_indices):
+        """Sorted item ids of the labels that have a vector."""
+        item_ids = np.fromiter(map_labels_to_indices.values(), dtype=np.int64, count=len(map_labels_to_indices))
+        return np.unique(item_ids[item_ids < len(vectors)])
+
+    def _build_index(self, metric, vectors, map_labels_to_indices):
+        assert vectors is not None, f"The vectors of the '{metric}' index were dropped after the build, reload the catalog to rebuild it."
+        index = self._new_index(metric)
+        if hasattr(index, 'build_from'):
+            # Reads the vectors (e.g. the memory-mapped catalog) a chunk at a time instead of copying them
+            index.build_from(vectors, self._item_ids(vectors, map_labels_to_indices))
+            return index
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        item_ids = [item_id for item_id in map_labels_to_indices.values() if item_id < len(vectors)]
+        if hasattr(index, 'add_items'):
+            # One call rather than one per item, which matters at millions of items
+            index.add_items(item_ids, vectors[item_ids])
+        else:
+            # AnnoyIndex.add_item accepts the float32 rows directly, no need for a tolist() copy per item
+            for item_id in item_ids:
+                index.add_item(item_id, vectors[item_id])
+        index.build(self.n_trees)
+        return index
+
+    #====================================
+    # Lazy construction and LRU eviction
+    #====================================
+    def get_index(self, metric):
+        """Return the index of 'metric', building or loading it on first use and marking it most recently used."""
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        with self._lock:
+            if metric in self.databases:
+                self.databases.move_to_end(metric)
+                return self.databases[metric]
+
+            if self.index_directory is None:
+                index = self._build_index(metric, self.vectors, self.map_labels_to_indices)
+                self.index_sizes[metric] = self._index_size(metric, index)
+            else:
+                index = self._load_or_build_index(metric)
+                self.index_sizes[metric] = os.path.getsize(self.index_path(self.index_directory, metric, self.version))
+
+            self.databases[metric] = index
+            self._evict(keep=metric)
+            self._release_vectors()
+            return index
+
+    def warm_up(self, metrics=None):
+        """Build or load the indexes of 'metrics' (all supported metrics by default) ahead of their first query."""
+        for metric in metrics or self.metrics:
+            self.get_index(metric)
+
+    def _estimate_index_size(self, metric):
+        """
+        Rough size in bytes of an in-memory Annoy index: one node per item plus the split nodes of every tree.
+        Annoy stores each vector as float32 (packed uint64 words for hamming) next to ~12 bytes of bookkeeping,
+        and packs up to about dimensions + 2 items per leaf.
+        """
+        vector_bytes = 8 * -(-self.dimensions // 64) if metric == 'hamming' else 4 * self.dimensions
+        node_bytes = 12 + vector_bytes
+        split_nodes_per_tree = 2 * self.n_items / (self.dimensions + 2)
+        return int(node_bytes * (self.n_items + self.n_trees * split_nodes_per_tree))
+
+    def _index_size(self, metric, index):
+        """Bytes held by a built index: measured by the NumPy engines, estimated for Annoy."""
+        if hasattr(index, 'memory_bytes'):
+            return index.memory_bytes()
+        return self._estimate_index_size(metric)
+
+    def _evict(self, keep):
+        """
+        Drop least recently used indexes until the held ones fit in the memory budget.
+        Indexes are not unloaded explicitly: a query that still holds a reference keeps working,
+        and the memory is released when the last reference goes away.
+        """
+        if self.memory_budget is None:
+            return
+        if self.vectors is None and self.index_directory is None:
+            return     # neither rebuilt nor reloaded once dropped
+        while sum(self.index_sizes[metric] for metric in self.databases) > self.memory_budget:
+            metric = next(iter(self.databases))
+            if metric == keep:
+                break
+            del self.databases[metric]
+
+    def _release_vectors(self):
+        """
+        With a compressed engine, drop the reference to the vectors once no index needs to be built from them again:
+        every metric's index is saved in the index directory, or held with no memory budget to evict it.
+        """
+        if not self.compressed or self.vectors is None:
+            return
+        if self.index_directory is not None:
+            built = all(os.path.exists(self.index_path(self.index_directory, metric, self.version)) for metric in self.metrics)
+        else:
+            built = self.memory_budget is None and all(metric in self.databases for metric in self.metrics)
+        if built:
+            self.vectors = None
+
+    #====================================
+    # Persisted index artifacts
+    #====================================
+    def index_version(self, vectors, map_labels_to_indices):
+        """
+        Return a short fingerprint of everything an Annoy index depends on: the catalog (vectors and label -> index map),
+        the dimensions, n_trees and the artifact format, and the engine and its options when it is not Annoy.
+        An artifact whose version differs from this one is stale.
+        """
+        fingerprint = hashlib.sha1()
+        fingerprint.update(f'{annoy_artifact_format}:{self.dimensions}:{self.n_trees}:'.encode())
+        if self.engine != 'annoy':
+            # Options that only affect queries (e.g. HNSW's ef) do not change the index
+            query_options = getattr(index_engines[self.engine], 'query_options', [])
+            build_options = {name: value for name, value in self.engine_options.items() if name not in query_options}
+            fingerprint.update(f'{self.engine}:{json.dumps(build_options, sort_keys=True)}:'.encode())
+        fingerprint.update(catalog_version(vectors, map_labels_to_indices).encode())
+        return fingerprint.hexdigest()[:16]
+
+    def index_path(self, directory, metric, version):
+        extension = getattr(index_engines[self.engine], 'file_extension', 'ann')
+        return os.path.join(directory, f'font_index_{metric}_{version}.{extension}')
+
+    def save(self, directory, version):
+        """
+        Write one versioned index file per built metric (plus a small JSON sidecar describing it) into 'directory'.
+        Files are written under a temporary name and renamed into place, so a reader never sees a partial index.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for metric, index in list(self.databases.items()):
+            self._save_index(directory, metric, version, index)
+
+    def _save_index(self, directory, metric, version, index):
+        path = self.index_path(directory, metric, version)
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        index.save(temporary_path)
+        os.replace(temporary_path, path)
+
+        metadata = {
+            'format': annoy_artifact_format,
+            'version': version,
+            'metric': metric,
+            'engine': self.engine,
+            'engine_options': self.engine_options,
+            'dimensions': self.dimensions,
+            'n_trees': self.n_trees,
+            'n_items': index.get_n_items(),
+        }
+        with open(f'{path}.json', 'w') as handle:
+            json.dump(metadata, handle, indent=2)
+
+        # Drop artifacts of older versions of this metric
+        prefix = f'font_index_{metric}_'
+        for file_name in os.listdir(directory):
+            if file_name.startswith(prefix) and not file_name.startswith(os.path.basename(path)):
+                os.remove(os.path.join(directory, file_name))
+
+    def _load_index(self, directory, metric, version, n_items):
+        """Memory-map a saved index, or return None if it is missing or does not match the expected version."""
+        path = self.index_path(directory, metric, version)
+        if not (os.path.exists(path) and os.path.exists(f'{path}.json')):
+            return None
+
+        with open(f'{path}.json') as handle:
+            metadata = json.load(handle)
+        if metadata.get('format') != annoy_artifact_format or metadata.get('version') != version:
+            return None
+        if metadata.get('engine', 'annoy') != self.engine:
+            return None
+
+        index = self._new_index(metric)
+        # Both engines mmap the file, so every worker loading it shares the same pages via the OS page cache
+        index.load(path)
+        if index.get_n_items() != n_items:
+            index.unload()
+            return None
+        return index
+
+    def _load_or_build_index(self, metric):
+        """
+        Memory-map the persisted index of 'metric', (re)building and saving it if it is missing or stale.
+        A file lock per directory makes concurrent workers wait for the first one to finish building,
+        instead of all of them building the same index.
+        """
+        directory = self.index_directory
+        index = self._load_index(directory, metric, self.version, self.n_items)
+        if index is not None:
+            return index
+
+        with open(os.path.join(directory, '.build.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # Another worker may have built it while we were waiting for the lock
+                index = self._load_index(directory, metric, self.version, self.n_items)
+                if index is None:
+                    index = self._build_index(metric, self.vectors, self.map_labels_to_indices)
+                    self._save_index(directory, metric, self.version, index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return index
+
+    def load_or_build(self, vectors, map_labels_to_indices, directory):
+        """
+        Use the versioned index files in 'directory' for every metric: each one is memory-mapped on first use,
+        and (re)built and saved there if it is missing or stale. Returns the index version.
+        An operating point saved in 'directory' for this catalog (see tune_annoy_index.py) is adopted first, by the
+        Annoy engine.
+        """
+        assert vectors.shape[1] == self.dimensions, "Vectors dimension mismatch."
+
+        operating_point = None
+        if self.engine == 'annoy':
+            operating_point = self.load_operating_point(directory, catalog_version(vectors, map_labels_to_indices))
+        if operating_point is not None:
+            self.n_trees = operating_point['n_trees']
+            self.tuned_search_k = operating_point['search_k']
+            self.recall_curves = operating_point['recall_curves']
+
+        self._map_labels_to_vectors(vectors, map_labels_to_indices)
+        self.version = self.index_version(vectors, map_labels_to_indices)
+        self.index_directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        return self.version
+
+    #====================================
+    # Recall / speed operating point
+    #====================================
+    @staticmethod
+    def operating_point_path(directory):
+        return os.path.join(directory, 'annoy_operating_point.json')
+
+    @classmethod
+    def load_operating_point(cls, directory, catalog):
+        """The operating point saved in 'directory', or None if there is none or it was tuned on another catalog."""
+        path = cls.operating_point_path(directory)
+        if not os.path.exists(path):
+            return None
+        with open(path) as handle:
+            operating_point = json.load(handle)
+        if operating_point.get('format') != annoy_artifact_format or operating_point.get('catalog_version') != catalog:
+            return None
+        return operating_point
+
+    @classmethod
+    def save_operating_point(cls, directory, operating_point):
+        os.makedirs(directory, exist_ok=True)
+        path = cls.operating_point_path(directory)
+        with open(f'{path}.tmp', 'w') as handle:
+            json.dump({'format': annoy_artifact_format, **operating_point}, handle, indent=2)
+        os.replace(f'{path}.tmp', path)
+
+    def resolve_search_k(self, metric, k, search_k=None, target_recall=None):
+        """
+        The search_k of a query: an explicit 'search_k' wins, then the smallest search_k whose measured recall
+        reaches 'target_recall', then the tuned default of the metric, then the constructor's search_k.
+        search_k scales with k, so the tuned values are stored per requested neighbour.
+        """
+        if search_k is not None:
+            return search_k
+        if target_recall is not None and metric in self.recall_curves:
+            curve = self.recall_curves[metric]
+            per_neighbour = next((point for point, recall in curve if recall >= target_recall), curve[-1][0])
+            return int(np.ceil(per_neighbour * k))
+        if metric in self.tuned_search_k:
+            return int(np.ceil(self.tuned_search_k[metric] * k))
+        return self.search_k
+
+    #====================================
+    # Incremental updates
+    #====================================
+    def _reset_delta(self):
+        # Replaced, never mutated, so queries can read them without the lock:
+        # delta = (item ids, (n, dimensions) float32 vectors), tombstones = frozenset of item ids
+        self.delta = (np.empty(0, dtype=np.int64), np.empty((0, self.dimensions), dtype=np.float32))
+        self.delta_labels = {}     # label -> item id, for the labels added since the last compaction
+        self.tombstones = frozenset()
+        self.oldest_change = None
+        self.next_item_id = self.n_items
+        self.compaction = None
+
+    def label_to_item_id(self, label):
+        """Item id of 'label', or None if the database does not hold it."""
+        if label in self.delta_labels:
+            return self.delta_labels[label]
+        item_id = self.map_labels_to_indices.get(label)
+        if item_id is None or item_id >= self.n_items or item_id in self.tombstones:
+            return None
+        return item_id
+
+    def add_vector(self, label, vector):
+        """
+        Add (or replace) the vector of 'label' without rebuilding any index, and return its new item id.
+        A replaced label gets a new item id, and its old one is tombstoned.
+        """
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, self.dimensions)
+        with self._update_lock:
+            previous = self.label_to_item_id(label)
+            item_id = self.next_item_id
+            self.next_item_id += 1
+
+            ids, vectors = self.delta
+            if previous is not None and previous in ids:
+                keep = ids != previous
+                ids, vectors = ids[keep], vectors[keep]
+            self.delta = (np.append(ids, item_id), np.vstack([vectors, vector]))
+            if previous is not None:
+                self.tombstones = self.tombstones | {previous}
+            self.delta_labels[label] = item_id
+            if self.map_labels_to_index is not None:
+                self.map_labels_to_index[label] = vector[0]
+            self.oldest_change = self.oldest_change or time.time()
+        self.maybe_compact()
+        return item_id
+
+    def remove_label(self, label):
+        """Remove 'label' from the results of every query. Returns False if the database does not hold it."""
+        with self._update_lock:
+            item_id = self.label_to_item_id(label)
+            if item_id is None:
+                return False
+
+            ids, vectors = self.delta
+            if item_id in ids:
+                keep = ids != item_id
+                self.delta = (ids[keep], vectors[keep])
+            # Tombstoned even when it was only in the delta, in case a running compaction is folding it into the index
+            self.tombstones = self.tombstones | {item_id}
+            self.delta_labels.pop(label, None)
+            if self.map_labels_to_index is not None:
+                self.map_labels_to_index.pop(label, None)
+            self.oldest_change = self.oldest_change or time.time()
+        self.maybe_compact()
+        return True
+
+    def maybe_compact(self):
+        """Start a background compaction if the delta is over its size or age threshold. Cheap otherwise."""
+        if self.oldest_change is None or self.compaction is not None:
+            return False
+        if len(self.delta[0]) + len(self.tombstones) < self.delta_max_size and time.time() - self.oldest_change < self.delta_max_age:
+            return False
+        return self.compact(wait=False)
+
+    def compact(self, wait=True):
+        """Fold the delta and tombstones into freshly built indexes, in a background thread unless 'wait'."""
+        with self._update_lock:
+            if self.compaction is not None:
+                return False
+            compaction = self.compaction = threading.Thread(target=self._compact, name='annoy-compaction', daemon=True)
+            compaction.start()
+        if wait:
+            compaction.join()
+        return True
+
+    def _compact(self):
+        try:
+            with self._update_lock:
+                (delta_ids, delta_vectors), tombstones = self.delta, self.tombstones
+                delta_labels = dict(self.delta_labels)
+                base_vectors, base_map, base_n_items = self.vectors, self.map_labels_to_indices, self.n_items
+
+            # Merged catalog: the base items that are still alive, plus the delta, under stable item ids
+            n_items = max(base_n_items, int(delta_ids.max()) + 1 if len(delta_ids) else 0)
+            map_labels_to_indices = {label: item_id for label, item_id in base_map.items()
+                                     if item_id < base_n_items and item_id not in tombstones}
+            map_labels_to_indices.update(delta_labels)
+
+            if base_vectors is None:
+                # Compressed indexes whose vectors were dropped: every metric's index encodes the delta with its quantizers
+                databases = OrderedDict()
+                for metric in self.metrics:
+                    index = self.databases.get(metric) or self._load_index(self.index_directory, metric, self.version, base_n_items)
+                    databases[metric] = index.updated(delta_ids, delta_vectors, removed=tombstones)
+                vectors = None
+            else:
+                n_items = max(n_items, len(base_vectors))
+                vectors = np.zeros((n_items, self.dimensions), dtype=np.float32)
+                vectors[:len(base_vectors)] = base_vectors
+                vectors[delta_ids] = delta_vectors
+                # Only the indexes currently held are rebuilt now, the others are built from the merged vectors on first use
+                databases = OrderedDict((metric, self._build_index(metric, vectors, map_labels_to_indices)) for metric in list(self.databases))
+
+            with self._update_lock, self._lock:
+                self.vectors, self.map_labels_to_indices = vectors, map_labels_to_indices
+                self.n_items = n_items
+                # The merged indexes exist only in memory: evicted ones are rebuilt, not reloaded from stale files
+                self.index_directory, self.version = None, None
+                self.databases = databases
+                self.index_sizes = {metric: self._index_size(metric, index) for metric, index in databases.items()}
+
+                # Changes made while compacting stay in the delta
+                ids, delta = self.delta
+                keep = ~np.isin(ids, delta_ids)
+                self.delta = (ids[keep], delta[keep])
+                self.tombstones = self.tombstones - tombstones
+                self.delta_labels = {label: item_id for label, item_id in self.delta_labels.items() if delta_labels.get(label) != item_id}
+                self.oldest_change = time.time() if len(self.delta[0]) or self.tombstones else None
+        finally:
+            self.compaction = None
+
+    def _delta_distances(self, query, vectors, metric):
+        """Distances from 'query' to the delta vectors, on the same scale as Annoy's include_distances."""
+        if metric == 'euclidean':
+            return np.sqrt(((vectors - query) ** 2).sum(axis=1))
+        if metric == 'angular':
+            cosine = (vectors @ query) / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(query), np.finfo(np.float32).tiny)
+            return np.sqrt(np.maximum(0.0, 2.0 - 2.0 * cosine))
+        if metric == 'manhattan':
+            return np.abs(vectors - query).sum(axis=1)
+        if metric == 'hamming':
+            return ((vectors > 0.5) != (query > 0.5)).sum(axis=1).astype(np.float32)
+        if metric == 'dot':
+            return vectors @ query
+        raise ValueError(f"Metric '{metric}' is not supported.")
+
+    def _search(self, get_nns_by_vector, query, metric, k, search_k):
+        (delta_ids, delta_vectors), tombstones = self.delta, self.tombstones
+        if not len(delta_ids) and not tombstones:
+            return get_nns_by_vector(query, k, search_k=search_k)
+
+        # Ask the index for enough extra neighbours to make up for the tombstoned ones
+        n_base = k + len(tombstones)
+        ids, distances = get_nns_by_vector(query, n_base, search_k=search_k if search_k < 0 else search_k * n_base // k,
+                                           include_distances=True)
+        candidates = [(distance, item_id) for item_id, distance in zip(ids, distances) if item_id not in tombstones]
+        query = np.asarray(query, dtype=np.float32)
+        candidates += zip(self._delta_distances(query, delta_vectors, metric).tolist(), delta_ids.tolist())
+
+        # Annoy ranks 'dot' by decreasing inner product, every other metric by increasing distance
+        candidates.sort(key=lambda candidate: -candidate[0] if metric == 'dot' else candidate[0])
+        return [item_id for _, item_id in candidates[:k]]
+
+    def nearest_neighbors(self, query, metric, k=10, search_k=None, target_recall=None):
+        index = self.get_index(metric)
+        self.maybe_compact()
+        return self._search(index.get_nns_by_vector, query, metric, k, self.resolve_search_k(metric, k, search_k, target_recall))
+
+    def nearest_neighbors_batch(self, queries, metric, k=10, search_k=None, target_recall=None):
+        """
+        k nearest neighbours of every row of 'queries', as a list with one list of item ids per query.
+        Annoy has no batched query, so this looks up the index once and loops over the rows.
+        """
+        get_nns_by_vector = self.get_index(metric).get_nns_by_vector
+        self.maybe_compact()
+        search_k = self.resolve_search_k(metric, k, search_k, target_recall)
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimensions)
+        return [self._search(get_nns_by_vector, query, metric, k, search_k) for query in queries]
+
+
+class ExactSearchDatabase:
+    """
+    Brute-force alternative to MultiMetricDatabase with the same add_vectors / nearest_neighbors API.
+
+    Every query is answered with one vectorized distance pass over all stored vectors followed by an
+    argpartition, so results are exact. For small catalogs (the ~915 fonts with 9-dimensional embeddings)
+    this is cheaper than building and holding an Annoy forest per metric.
+
+    The metrics mirror Annoy's semantics so the two backends are interchangeable:
+    - 'angular': cosine distance (largest cosine similarity first)
+    - 'euclidean': L2 distance
+    - 'manhattan': L1 distance
+    - 'dot': largest inner product first
+    - 'hamming': number of differing bits, after binarising each component with the same > 0.5 threshold Annoy uses
+    """
+    supported_metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    # Bound of the (n_queries, n_vectors, d) temporary that manhattan and hamming distances broadcast, in bytes
+    broadcast_bytes = 64 * 1024**2
+
+    def __init__(self, dimensions, metrics=['angular'], n_trees=None, memory_budget=None, search_k=None):
+        # n_trees, memory_budget and search_k are accepted (and ignored) so both backends can be constructed with the same
+        # arguments. The per-metric arrays prepared here are at most the size of the vectors themselves.
+        for metric in metrics:
+            assert metric in self.supported_metrics, f"Metric '{metric}' is not supported."
+        self.dimensions = dimensions
+        self.n_trees = n_trees
+        self.metrics = metrics
+        self.databases = {}
+
+    def add_vectors(self, vectors, map_labels_to_indices):
+        assert vectors.shape[1] == self.dimensions, "Vectors dimension mismatch."
+
+        # Same label -> vector bookkeeping as MultiMetricDatabase
         self.map_labels_to_index = {}
         for label, index in map_labels_to_indices.items():
             if index < len(vectors):
                 self.map_labels_to_index[label] = vectors[index]
 
-        for metric, index in self.databases.items():
-            for label, vector in self.map_labels_to_index.items():
-                index.add_item(map_labels_to_indices[label], vector.tolist())
-            index.build(self.n_trees)
+        # Keep the stored rows in item-id order, so a row position can be translated back to the item id
+        self.item_ids = np.array(sorted(map_labels_to_indices[label] for label in self.map_labels_to_index), dtype=np.int64)
+        self.vectors = np.ascontiguousarray(vectors[self.item_ids], dtype=np.float32)
+
+        # Whatever each metric needs is precomputed on its first query, instead of per query
+        self.databases = {}
+
+    def load_or_build(self, vectors, map_labels_to_indices, directory=None):
+        """There is no index to persist for exact search, so this simply adds the vectors."""
+        self.add_vectors(vectors, map_labels_to_indices)
 
-    def nearest_neighbors(self, query, metric, k=10):
+    def warm_up(self, metrics=None):
+        """Precompute the arrays of 'metrics' (all supported metrics by default) ahead of their first query."""
+        for metric in metrics or self.metrics:
+            if metric not in self.databases:
+                self.databases[metric] = self._prepare(metric, self.vectors)
+
+    def _prepare(self, metric, vectors):
+        if metric == 'euclidean':
+            return {'vectors': vectors, 'squared_norms': np.einsum('ij,ij->i', vectors, vectors)}
+        if metric == 'angular':
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            return {'vectors': vectors / np.maximum(norms, np.finfo(np.float32).tiny)}
+        if metric == 'hamming':
+            return {'vectors': vectors > 0.5}
+        return {'vectors': vectors}
+
+    def _distances(self, queries, metric, prepared=None):
+        """
+        Return a (n_queries, n_vectors) matrix of distances, where a smaller value means a closer neighbour.
+        Monotonic transforms are skipped (no sqrt for euclidean, no arccos for angular), as only the ordering matters.
+        'prepared' (from _prepare) defaults to the arrays of all stored vectors.
+        """
+        if prepared is None:
+            if metric not in self.databases:
+                self.databases[metric] = self._prepare(metric, self.vectors)
+            prepared = self.databases[metric]
+        vectors = prepared['vectors']
+
+        if metric == 'euclidean':
+            query_squared_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+            return prepared['squared_norms'][None, :] - 2.0 * (queries @ vectors.T) + query_squared_norms
+        if metric == 'angular':
+            query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            queries = queries / np.maximum(query_norms, np.finfo(np.float32).tiny)
+            return -(queries @ vectors.T)
+        if metric == 'dot':
+            return -(queries @ vectors.T)
+        if metric in ('manhattan', 'hamming'):
+            # No matmul form: pairs are broadcast over the dimensions, so the vectors are taken a chunk at a time
+            # to keep the temporary within broadcast_bytes
+            if metric == 'hamming':
+                queries = queries > 0.5
+            distances = np.empty((len(queries), len(vectors)), dtype=np.float32 if metric == 'manhattan' else np.int32)
+            chunk_size = max(1, self.broadcast_bytes // (4 * max(1, len(queries) * self.dimensions)))
+            for start in range(0, len(vectors), chunk_size):
+                chunk = vectors[None, start:start + chunk_size, :]
+                if metric == 'manhattan':
+                    distances[:, start:start + chunk_size] = np.abs(queries[:, None, :] - chunk).sum(axis=2)
+                else:
+                    distances[:, start:start + chunk_size] = (chunk != queries[:, None, :]).sum(axis=2)
+            return distances
+        raise ValueError(f"Metric '{metric}' is not supported.")
+
+    def _top_k(self, distances, k):
+        """Return the row positions of the k smallest distances of each row, closest first."""
+        n_vectors = distances.shape[1]
+        k = min(k, n_vectors)
+        if k < n_vectors:
+            candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(n_vectors), distances.shape)
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1, kind='stable')
+        return np.take_along_axis(candidates, order, axis=1)
+
+    def nearest_neighbors(self, query, metric, k=10, search_k=None, target_recall=None):
+        # search_k and target_recall are accepted for API compatibility with MultiMetricDatabase: results are exact
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        queries = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        positions = self._top_k(self._distances(queries, metric), k)[0]
+        # Return plain Python ints, like AnnoyIndex.get_nns_by_vector
+        return self.item_ids[positions].tolist()
+
+    def nearest_neighbors_batch(self, queries, metric, k=10, batch_size=256, search_k=None, target_recall=None):
+        """
+        Exact k nearest neighbours of every row of 'queries', as an (n_queries, k) array of item ids, closest first.
+        Queries are processed in batches of 'batch_size' rows, to bound the size of the distance matrix.
+        """
         assert metric in self.metrics, f"Metric '{metric}' is not supported."
-        index = self.databases[metric]
-        return index.get_nns_by_vector(query, k)
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimensions)
+        k = min(k, len(self.item_ids))
+
+        neighbours = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            neighbours[start:start + batch_size] = self.item_ids[self._top_k(self._distances(batch, metric), k)]
+        return neighbours
+
+
+def quantize_embeddings(vectors, quantization, scales=None, offsets=None):
+    """
+    Compact copy of 'vectors' for QuantizedSearchDatabase, as (codes, scales, offsets).
+
+    'float16' halves the size and needs no scale. 'int8' divides it by four, with a per-dimension linear mapping
+    of [min, max] onto the 256 code values: x ~= offsets + scales * (codes + 128). The mapping is fitted on
+    'vectors' unless 'scales' and 'offsets' are given. Scales and offsets are None for float16.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if quantization == 'float16':
+        return vectors.astype(np.float16), None, None
+    if quantization != 'int8':
+        raise ValueError(f"Quantization '{quantization}' is not supported, use 'float16' or 'int8'.")
+
+    if scales is None:
+        offsets = vectors.min(axis=0)
+        scales = (vectors.max(axis=0) - offsets) / 255.0
+        scales[scales == 0] = 1.0     # constant dimensions
+    codes = np.clip(np.rint((vectors - offsets) / scales) - 128, -128, 127).astype(np.int8)
+    return codes, np.asarray(scales, dtype=np.float32), np.asarray(offsets, dtype=np.float32)
+
+
+def dequantize_embeddings(codes, scales, offsets):
+    """Float32 approximation of the vectors 'codes' were quantized from."""
+    if scales is None:
+        return codes.astype(np.float32)
+    return (codes.astype(np.float32) + 128) * scales + offsets
+
+
+class QuantizedSearchDatabase(ExactSearchDatabase):
+    """
+    ExactSearchDatabase over a float16 or int8 copy of the vectors, with exact re-ranking.
+
+    Candidates are searched on the compact codes, 'rerank_factor' * k per query, and re-ranked with their
+    full-precision vectors, which are only read for those candidates. The full-precision array is not copied: with
+    the memory-mapped catalog of main.py, the only per-process memory is the codes (a half or a quarter of a float32
+    copy). Codes are decoded 'chunk_size' rows at a time, so no full-size float32 array is ever allocated, nor
+    cached per metric.
+
+    Results can differ from exact search when a true neighbour does not make it into the candidates;
+    benchmark_quantization.py measures that recall against the memory saved.
+    """
+    def __init__(self, dimensions, metrics=['angular'], quantization='int8', rerank_factor=4, chunk_size=65536,
+                 n_trees=None, memory_budget=None, search_k=None):
+        super().__init__(dimensions, metrics, n_trees=n_trees, memory_budget=memory_budget, search_k=search_k)
+        assert quantization in ('float16', 'int8'), f"Quantization '{quantization}' is not supported."
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.chunk_size = chunk_size
+
+    def add_vectors(self, vectors, map_labels_to_indices):
+        assert vectors.shape[1] == self.dimensions, "Vectors dimension mismatch."
+
+        # Same label -> vector bookkeeping as MultiMetricDatabase
+        self.map_labels_to_index = {}
+        for label, index in map_labels_to_indices.items():
+            if index < len(vectors):
+                self.map_labels_to_index[label] = vectors[index]
+
+        self.item_ids = np.array(sorted(map_labels_to_indices[label] for label in self.map_labels_to_index), dtype=np.int64)
+        self.full_vectors = vectors
+
+        # The int8 mapping is fitted on all vectors first, then rows are encoded chunk by chunk, so a
+        # memory-mapped source is never loaded whole
+        chunks = [slice(start, start + self.chunk_size) for start in range(0, len(self.item_ids), self.chunk_size)]
+        self.scales = self.offsets = None
+        if self.quantization == 'int8':
+            minimums = np.min([np.asarray(vectors[self.item_ids[chunk]]).min(axis=0) for chunk in chunks], axis=0)
+            maximums = np.max([np.asarray(vectors[self.item_ids[chunk]]).max(axis=0) for chunk in chunks], axis=0)
+            _, self.scales, self.offsets = quantize_embeddings(np.stack([minimums, maximums]), 'int8')
+
+        self.codes = np.empty((len(self.item_ids), self.dimensions), dtype=np.float16 if self.quantization == 'float16' else np.int8)
+        for chunk in chunks:
+            self.codes[chunk], _, _ = quantize_embeddings(vectors[self.item_ids[chunk]], self.quantization, self.scales, self.offsets)
+        self.databases = {}
+
+    def warm_up(self, metrics=None):
+        # Nothing is precomputed per metric: that would be a full-size float32 array again
+        pass
+
+    def memory_bytes(self):
+        """Bytes held by this database besides the (shared) full-precision vectors."""
+        return sum(array.nbytes for array in (self.codes, self.scales, self.offsets, self.item_ids) if array is not None)
+
+    def _candidates(self, queries, metric, n_candidates):
+        """Row positions of the 'n_candidates' closest codes of each query, in no particular order."""
+        positions, distances = [], []
+        for start in range(0, len(self.codes), self.chunk_size):
+            chunk = dequantize_embeddings(self.codes[start:start + self.chunk_size], self.scales, self.offsets)
+            chunk_distances = self._distances(queries, metric, self._prepare(metric, chunk))
+            if n_candidates < chunk_distances.shape[1]:
+                chunk_positions = np.argpartition(chunk_distances, n_candidates - 1, axis=1)[:, :n_candidates]
+                chunk_distances = np.take_along_axis(chunk_distances, chunk_positions, axis=1)
+            else:
+                chunk_positions = np.broadcast_to(np.arange(chunk_distances.shape[1]), chunk_distances.shape)
+            positions.append(chunk_positions + start)
+            distances.append(chunk_distances)
+
+        positions, distances = np.concatenate(positions, axis=1), np.concatenate(distances, axis=1)
+        if n_candidates < positions.shape[1]:
+            best = np.argpartition(distances, n_candidates - 1, axis=1)[:, :n_candidates]
+            positions = np.take_along_axis(positions, best, axis=1)
+        return positions
+
+    def _rerank_distances(self, queries, rows, metric):
+        """Full-precision distances between each query (n_queries, d) and its own candidates 'rows' (n_queries, c, d)."""
+        if metric == 'euclidean':
+            return np.einsum('qcd,qcd->qc', rows - queries[:, None, :], rows - queries[:, None, :])
+        if metric == 'angular':
+            dots = np.einsum('qcd,qd->qc', rows, queries)
+            norms = np.linalg.norm(rows, axis=2) * np.linalg.norm(queries, axis=1, keepdims=True)
+            return -dots / np.maximum(norms, np.finfo(np.float32).tiny)
+        if metric == 'dot':
+            return -np.einsum('qcd,qd->qc', rows, queries)
+        if metric in ('manhattan', 'hamming'):
+            # Summed one dimension at a time, so the only (n_queries, c, d) array is 'rows' itself
+            distances = np.zeros(rows.shape[:2], dtype=np.float32)
+            for dimension in range(self.dimensions):
+                if metric == 'manhattan':
+                    distances += np.abs(rows[:, :, dimension] - queries[:, None, dimension])
+                else:
+                    distances += (rows[:, :, dimension] > 0.5) != (queries[:, None, dimension] > 0.5)
+            return distances
+        raise ValueError(f"Metric '{metric}' is not supported.")
+
+    def _search(self, queries, metric, k):
+        n_candidates = min(max(k, int(np.ceil(k * self.rerank_factor))), len(self.item_ids))
+        candidates = self._candidates(queries, metric, n_candidates)
+
+        # Only the candidates' full-precision rows are read, from the (possibly memory-mapped) source array
+        rows = np.asarray(self.full_vectors[self.item_ids[candidates].ravel()], dtype=np.float32)
+        rows = rows.reshape(*candidates.shape, self.dimensions)
+        distances = self._rerank_distances(queries, rows, metric)
+        return np.take_along_axis(candidates, self._top_k(distances, k), axis=1)
+
+    def nearest_neighbors(self, query, metric, k=10, search_k=None, target_recall=None):
+        # search_k and target_recall are accepted for API compatibility with MultiMetricDatabase
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        queries = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        return self.item_ids[self._search(queries, metric, k)[0]].tolist()
+
+    def nearest_neighbors_batch(self, queries, metric, k=10, batch_size=256, search_k=None, target_recall=None):
+        """k nearest neighbours of every row of 'queries', as an (n_queries, k) array of item ids, closest first."""
+        assert metric in self.metrics, f"Metric '{metric}' is not supported."
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimensions)
+        k = min(k, len(self.item_ids))
+
+        neighbours = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), batch_size):
+            neighbours[start:start + batch_size] = self.item_ids[self._search(queries[start:start + batch_size], metric, k)]
+        return neighbours
+
+
+class NeighbourTable:
+    """
+    Precomputed exact top-k neighbours of every font in the catalog (see build_neighbour_table.py).
+
+    The table is a compact (n_fonts, k) integer matrix whose row i holds the item ids of the nearest
+    neighbours of font i, closest first, so looking up the neighbours of a catalog font is a single row slice.
+    It is only valid for the metric and catalog version it was built with.
+    """
+    def __init__(self, table, metric, version):
+        self.table = table
+        self.metric = metric
+        self.version = version
+        self.k = table.shape[1]
+
+    @classmethod
+    def build(cls, vectors, map_labels_to_indices, metric='euclidean', k=200):
+        exact_db = ExactSearchDatabase(dimensions=vectors.shape[1], metrics=[metric])
+        exact_db.add_vectors(vectors, map_labels_to_indices)
+        neighbours = exact_db.nearest_neighbors_batch(vectors, metric, k)
+
+        # int16 is enough for catalogs of up to 32767 fonts, and halves the size of the table
+        dtype = np.int16 if len(vectors) <= np.iinfo(np.int16).max else np.int32
+        return cls(neighbours.astype(dtype), metric, catalog_version(vectors, map_labels_to_indices))
+
+    def save(self, file_path):
+        np.savez(file_path, array=self.table, metric=self.metric, version=self.version)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data['array'], str(data['metric']), str(data['version']))
+
+    def covers(self, metric, k, version):
+        """Whether this table can answer a query for 'k' neighbours under 'metric' on the catalog 'version'."""
+        return metric == self.metric and k <= self.k and version == self.version
+
+    def nearest_neighbors(self, item_id, k=10):
+        return self.table[item_id, :k].tolist()
+
+    def nearest_neighbors_batch(self, item_ids, k=10):
+        return self.table[item_ids, :k]
+
+
+def sharded_search_database(*args, **kwargs):
+    # Imported on use: sharded_search.py builds its shards with the backends below
+    from sharded_search import ShardedSearchDatabase
+    return ShardedSearchDatabase(*args, **kwargs)
+
+
+# Backends selectable by name, e.g. from main.py
+vector_database_backends = {
+    'annoy': MultiMetricDatabase,
+    'hnsw': functools.partial(MultiMetricDatabase, engine='hnsw'),
+    'ivfpq': functools.partial(MultiMetricDatabase, engine='ivfpq'),
+    'exact': ExactSearchDatabase,
+    'quantized': QuantizedSearchDatabase,
+    'sharded': sharded_search_database,
+}
 
 
 def test_multimetricdatabase():
@@ -95,3 +985,296 @@ def test_multimetricdatabase():
     print("All tests passed.")
 
 
+def test_exactsearchdatabase():
+    # Initialize test parameters
+    dimensions = 9
+    metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    n_vectors = 500
+
+    vectors = np.random.rand(n_vectors, dimensions).astype('float32')
+    map_labels_to_indices = {f'font_{i}': i for i in range(n_vectors)}
+
+    db = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+    db.add_vectors(vectors, map_labels_to_indices)
+
+    query = np.random.rand(dimensions).astype('float32')
+
+    # Reference distances computed directly, one metric at a time
+    reference_distances = {
+        'euclidean': np.linalg.norm(vectors - query, axis=1),
+        'manhattan': np.abs(vectors - query).sum(axis=1),
+        'angular': -(vectors @ query) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)),
+        'dot': -(vectors @ query),
+        'hamming': ((vectors > 0.5) != (query > 0.5)).sum(axis=1),
+    }
+
+    for metric in metrics:
+        result = db.nearest_neighbors(query, metric=metric, k=10)
+        assert len(result) == 10, f"Query with metric '{metric}' did not return correct number of results."
+        assert all(isinstance(i, int) for i in result), f"Query with metric '{metric}' returned non-integer results."
+        expected = np.sort(reference_distances[metric])[:10]
+        assert np.allclose(reference_distances[metric][result], expected, atol=1e-4), f"Query with metric '{metric}' is not exact."
+
+    # Asking for more neighbours than vectors returns every vector
+    assert len(db.nearest_neighbors(query, metric='euclidean', k=n_vectors + 10)) == n_vectors
+
+    # Broadcast metrics computed a few vectors at a time give the same distances
+    queries = np.random.rand(20, dimensions).astype('float32')
+    for metric in ['manhattan', 'hamming']:
+        distances = db._distances(queries, metric)
+        db.broadcast_bytes = 1000
+        assert np.allclose(db._distances(queries, metric), distances), f"Chunked '{metric}' distances differ."
+        del db.broadcast_bytes
+
+    print("All tests passed.")
+
+
+def test_quantizedsearchdatabase():
+    # Initialize test parameters
+    dimensions = 9
+    metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    n_vectors = 2000
+
+    vectors = np.random.rand(n_vectors, dimensions).astype('float32')
+    map_labels_to_indices = {f'font_{i}': i for i in range(n_vectors)}
+
+    exact_db = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+
+    queries = np.random.rand(20, dimensions).astype('float32')
+    for quantization in ['float16', 'int8']:
+        # Small chunks, to go through the merge of per-chunk candidates
+        db = QuantizedSearchDatabase(dimensions=dimensions, metrics=metrics, quantization=quantization, chunk_size=300)
+        db.add_vectors(vectors, map_labels_to_indices)
+        assert db.memory_bytes() < vectors.nbytes, f"{quantization} codes are not smaller than the vectors."
+
+        for metric in metrics:
+            result = db.nearest_neighbors(queries[0], metric=metric, k=10)
+            assert len(result) == 10, f"Query with metric '{metric}' did not return correct number of results."
+            assert all(isinstance(i, int) for i in result), f"Query with metric '{metric}' returned non-integer results."
+
+            # Re-ranked distances are exact, so the candidates found are in exact order
+            exact_distances = exact_db._distances(queries, metric)
+            neighbours = db.nearest_neighbors_batch(queries, metric=metric, k=10)
+            found = np.take_along_axis(exact_distances, neighbours, axis=1)
+            assert np.all(np.diff(found, axis=1) >= -1e-4), f"Query with metric '{metric}' is not re-ranked."
+            if metric != 'hamming':     # ties make hamming neighbours ambiguous
+                expected = np.sort(exact_distances, axis=1)[:, :10]
+                assert np.mean(np.isclose(found, expected, atol=1e-4)) > 0.95, f"Query with metric '{metric}' has a low recall."
+
+    print("All tests passed.")
+
+
+def test_incremental_updates():
+    # Initialize test parameters
+    dimensions = 9
+    metrics = ['angular', 'euclidean', 'dot']
+    n_vectors = 500
+
+    vectors = np.random.rand(n_vectors, dimensions).astype('float32')
+    map_labels_to_indices = {f'font_{i}': i for i in range(n_vectors)}
+
+    db = MultiMetricDatabase(dimensions=dimensions, metrics=metrics, n_trees=10, delta_max_size=10**6, delta_max_age=10**6)
+    db.add_vectors(vectors, map_labels_to_indices)
+
+    # New fonts, one replaced font and a few removed ones, without any rebuild
+    expected = dict(map_labels_to_indices)
+    all_vectors = list(vectors)
+    for i in range(30):
+        label = f'new_font_{i}' if i else 'font_7'
+        item_id = db.add_vector(label, np.random.rand(dimensions))
+        assert item_id == len(all_vectors), "Item ids are not assigned in sequence."
+        all_vectors.append(db.map_labels_to_index[label])
+        expected[label] = item_id
+    for label in ['font_1', 'font_2', 'new_font_3']:
+        assert db.remove_label(label), f"'{label}' was not removed."
+        del expected[label]
+    assert not db.remove_label('font_1'), "A removed label was removed twice."
+    assert len(db.databases) == 0, "An index was built by an update."
+
+    # Reference: exact search over the fonts that are still alive
+    alive_ids = np.array(sorted(expected.values()))
+    reference = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+    reference.add_vectors(np.array(all_vectors), {label: item_id for label, item_id in expected.items()})
+
+    def check(search_k):
+        query = np.random.rand(dimensions).astype('float32')
+        for metric in metrics:
+            result = db.nearest_neighbors(query, metric=metric, k=20, search_k=search_k)
+            assert len(result) == 20, f"Query with metric '{metric}' did not return correct number of results."
+            assert set(result) <= set(alive_ids.tolist()), f"Query with metric '{metric}' returned a removed font."
+            assert result == reference.nearest_neighbors(query, metric=metric, k=20), f"Query with metric '{metric}' missed updates."
+
+    # Inspecting every node makes Annoy exact, so results must match the reference
+    check(search_k=10 * 10 * len(all_vectors))
+    assert db.compact(), "Compaction did not run."
+    assert len(db.delta[0]) == 0 and not db.tombstones, "Compaction left changes in the delta."
+    check(search_k=10 * 10 * len(all_vectors))
+
+    print("All tests passed.")
+
+
+def test_hnsw_engine():
+    import tempfile
+
+    # Initialize test parameters
+    dimensions = 9
+    metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    n_vectors = 1000
+
+    vectors = np.random.rand(n_vectors, dimensions).astype('float32')
+    map_labels_to_indices = {f'font_{i}': i for i in range(n_vectors)}
+
+    exact_db = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = np.random.rand(20, dimensions).astype('float32')
+
+    # Like AnnoyIndex, an index counts its items before it is built
+    index = HNSWIndex(dimensions, 'euclidean')
+    assert index.get_n_items() == 0, "An empty index has items."
+    index.add_item(4, vectors[4])
+    assert index.get_n_items() == 5, "Items added before build() are not counted."
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = vector_database_backends['hnsw'](dimensions=dimensions, metrics=metrics, engine_options={'M': 8})
+        db.load_or_build(vectors, map_labels_to_indices, directory)
+        for metric in metrics:
+            assert isinstance(db.get_index(metric), HNSWIndex), f"Metric '{metric}' is not indexed with HNSW."
+            neighbours = db.nearest_neighbors_batch(queries, metric=metric, k=10, search_k=100)
+            assert all(len(result) == 10 for result in neighbours), f"Query with metric '{metric}' did not return correct number of results."
+            if metric != 'hamming':     # ties make hamming neighbours ambiguous
+                exact_distances = exact_db._distances(queries, metric)
+                found = np.take_along_axis(exact_distances, np.array(neighbours), axis=1)
+                expected = np.sort(exact_distances, axis=1)[:, :10]
+                assert np.mean(np.isclose(found, expected, atol=1e-4)) > 0.95, f"Query with metric '{metric}' has a low recall."
+        assert all(file_name.endswith(('.hnsw', '.hnsw.json', '.build.lock')) for file_name in os.listdir(directory)), "Unexpected index files."
+
+        # A second database memory-maps the saved graphs and answers the same
+        loaded_db = vector_database_backends['hnsw'](dimensions=dimensions, metrics=metrics, engine_options={'M': 8})
+        loaded_db.load_or_build(vectors, map_labels_to_indices, directory)
+        for metric in metrics:
+            assert loaded_db.get_index(metric).buffer is not None, f"The '{metric}' index was rebuilt instead of loaded."
+            assert loaded_db.nearest_neighbors(queries[0], metric=metric, k=10, search_k=100) == db.nearest_neighbors(queries[0], metric=metric, k=10, search_k=100)
+
+    print("All tests passed.")
+
+
+def test_ivfpq_engine():
+    import tempfile
+
+    # Initialize test parameters
+    dimensions = 9
+    metrics = ['angular', 'euclidean', 'manhattan', 'hamming', 'dot']
+    n_vectors = 3000
+
+    vectors = np.random.rand(n_vectors, dimensions).astype('float32')
+    map_labels_to_indices = {f'font_{i}': i for i in range(n_vectors)}
+
+    exact_db = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+    exact_db.add_vectors(vectors, map_labels_to_indices)
+    queries = np.random.rand(20, dimensions).astype('float32')
+
+    with tempfile.TemporaryDirectory() as directory:
+        # One dimension per subspace: codes are 9 bytes per vector, against 36 for float32
+        db = vector_database_backends['ivfpq'](dimensions=dimensions, metrics=metrics, engine_options={'n_lists': 32, 'n_subquantizers': 9})
+        db.load_or_build(vectors, map_labels_to_indices, directory)
+        for metric in metrics:
+            index = db.get_index(metric)
+            assert isinstance(index, IVFPQIndex), f"Metric '{metric}' is not indexed with IVF-PQ."
+            assert index.codes.dtype == np.uint8 and index.codes.shape == (n_vectors, 9), f"Unexpected '{metric}' codes."
+
+            # Scanning every list leaves only the quantization error
+            neighbours = db.nearest_neighbors_batch(queries, metric=metric, k=10, search_k=32)
+            assert all(len(result) == 10 for result in neighbours), f"Query with metric '{metric}' did not return correct number of results."
+            if metric != 'hamming':     # ties make hamming neighbours ambiguous
+                exact_distances = exact_db._distances(queries, metric)
+                kth = np.sort(exact_distances, axis=1)[:, 9:10]
+                found = np.take_along_axis(exact_distances, np.array(neighbours), axis=1)
+                assert np.mean(found <= kth + 1e-4) > 0.9, f"Query with metric '{metric}' has a low recall."
+
+            # Fewer lists scanned, fewer candidates, still k results
+            assert len(db.nearest_neighbors(queries[0], metric=metric, k=10, search_k=4)) == 10
+
+        # A second database memory-maps the saved codes and answers the same
+        loaded_db = vector_database_backends['ivfpq'](dimensions=dimensions, metrics=metrics, engine_options={'n_lists': 32, 'n_subquantizers': 9})
+        loaded_db.load_or_build(vectors, map_labels_to_indices, directory)
+        for metric in metrics:
+            assert loaded_db.get_index(metric).buffer is not None, f"The '{metric}' index was rebuilt instead of loaded."
+            assert loaded_db.nearest_neighbors(queries[0], metric=metric, k=10) == db.nearest_neighbors(queries[0], metric=metric, k=10)
+
+        # Every index is saved, so the vectors are dropped; compaction then encodes the changes with the existing quantizers
+        assert db.vectors is None and db.map_labels_to_index is None, "The compressed database kept the vectors."
+        item_id = db.add_vector('font_new', queries[0])
+        assert db.remove_label('font_0'), "Removing an indexed label failed."
+        db.compact()
+        assert not len(db.delta[0]) and not db.tombstones, "The changes were not compacted."
+        for metric in metrics:
+            neighbours = db.nearest_neighbors(queries[0], metric=metric, k=10, search_k=32)
+            assert 0 not in neighbours, f"Removed item returned with metric '{metric}'."
+            assert db.get_index(metric).get_n_items() == item_id + 1, f"The compacted '{metric}' index misses the added item."
+        assert db.nearest_neighbors(queries[0], metric='euclidean', k=1, search_k=32) == [item_id], "The added item is not its own nearest neighbour."
+
+    print("All tests passed.")
+
+
+def test_shardedsearchdatabase():
+    import socket
+    import tempfile
+    from sharded_search import start_shards, wait_for_shards, shard_address
+
+    # Initialize test parameters
+    dimensions = 9
+    metrics = ['euclidean', 'dot']
+    n_vectors = 3000
+    n_shards = 4
+
+    vectors = np.random.rand(n_vectors, dimensions).astype('float32')
+    map_labels_to_indices = {f'font_{i}': i for i in range(n_vectors)}
+
+    reference = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+    reference.add_vectors(vectors, map_labels_to_indices)
+    queries = np.random.rand(10, dimensions).astype('float32')
+
+    with tempfile.TemporaryDirectory() as directory:
+        processes = start_shards(vectors, map_labels_to_indices, n_shards, directory, backend='exact', metrics=metrics)
+        try:
+            wait_for_shards(directory, n_shards, processes=processes)
+            db = vector_database_backends['sharded'](dimensions=dimensions, metrics=metrics, n_shards=n_shards, directory=directory, timeout=2.0)
+            db.load_or_build(vectors, map_labels_to_indices)
+            for metric in metrics:
+                # Exact shards, merged on exact distances: the same results as one exact database
+                assert db.nearest_neighbors_batch(queries, metric=metric, k=10) == reference.nearest_neighbors_batch(queries, metric=metric, k=10).tolist(), \
+                    f"Query with metric '{metric}' does not match unsharded search."
+            assert db.partial_queries == 0, "Queries were partial with every shard answering."
+
+            # Replace the last shard with one that accepts connections but never replies
+            processes[-1].terminate()
+            processes[-1].join()
+            os.remove(shard_address(directory, n_shards - 1))
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stalled.bind(shard_address(directory, n_shards - 1))
+            stalled.listen()
+
+            # The stalled shard times out: the query returns the best results of the other shards, after the timeout
+            db = vector_database_backends['sharded'](dimensions=dimensions, metrics=metrics, n_shards=n_shards, directory=directory, timeout=0.3)
+            start = time.perf_counter()
+            result = db.nearest_neighbors(queries[0], metric='euclidean', k=10)
+            assert 0.3 <= time.perf_counter() - start < 1.0, "The query did not wait for the timeout only."
+            alive_ids = [item_id for item_id in range(n_vectors) if item_id % n_shards != n_shards - 1]
+            partial_reference = ExactSearchDatabase(dimensions=dimensions, metrics=metrics)
+            partial_reference.add_vectors(vectors, {f'font_{i}': i for i in alive_ids})
+            assert result == partial_reference.nearest_neighbors(queries[0], metric='euclidean', k=10), "Partial results are not the best of the other shards."
+            assert db.partial_queries == 1 and db.shard_failures[n_shards - 1] == 1, "The timeout was not counted."
+
+            # A shard that is down is left out without waiting
+            processes[0].terminate()
+            processes[0].join()
+            start = time.perf_counter()
+            result = db.nearest_neighbors(queries[0], metric='euclidean', k=10)
+            assert all(item_id % n_shards not in (0, n_shards - 1) for item_id in result) and len(result) == 10, "Down shard not left out."
+            stalled.close()
+        finally:
+            for process in processes:
+                process.terminate()
+
+    print("All tests passed.")